@@ -0,0 +1,53 @@
+"""
+Benchmark of distance, angle and dihedral measurements.
+
+Compares measurements of single coordinates called in a loop with measurements of arrays of coordinates.
+
+Run using `vmd -python -dispdev none -e benchmarks/measure.py -args [count]`.
+"""
+import sys
+import time
+
+import numpy
+
+from pyvmd import measure
+
+# Number of measured coordinates
+COUNT = 100000
+# Number of frames for arrays of shape (frames, atoms, 3)
+FRAMES = 100
+
+
+def _timeit(function, *args):
+    """
+    Returns time of the function call in seconds.
+    """
+    started = time.time()
+    function(*args)
+    return time.time() - started
+
+
+def _loop(function, *coords):
+    """
+    Calls the function for every coordinate.
+    """
+    return [function(*args) for args in zip(*coords)]
+
+
+def main(count):
+    random = numpy.random.RandomState(42)
+    coords = random.uniform(-10.0, 10.0, (4, count, 3))
+    # The same coordinates split into frames
+    frames = coords[:, :count // FRAMES * FRAMES].reshape(4, FRAMES, -1, 3)
+    print '%-10s %10s %10s %10s %10s' % ('', 'loop [s]', 'array [s]', 'frames [s]', 'speedup')
+    for name, single, array, arity in (('distance', measure.coords_distance, measure.coords_distances, 2),
+                                       ('angle', measure.coords_angle, measure.coords_angles, 3),
+                                       ('dihedral', measure.coords_dihedral, measure.coords_dihedrals, 4)):
+        loop_time = _timeit(_loop, single, *coords[:arity])
+        array_time = _timeit(array, *coords[:arity])
+        frames_time = _timeit(array, *frames[:arity])
+        print '%-10s %10.4f %10.4f %10.4f %9.0fx' % (name, loop_time, array_time, frames_time, loop_time / array_time)
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else COUNT)
@@ -1,30 +1,111 @@
 """
 Analyzer - performs analysis throughout trajectory.
 """
+import io
 import logging
+import multiprocessing
+import os
+import pickle
+import Queue
+import threading
+import time
+import traceback
 from collections import namedtuple
+from datetime import timedelta
 
-from .molecules import Molecule
+import numpy
 
-__all__ = ['Analyzer', 'Step']
+from .atoms import Selection
+from .dcd import DCDReader
+from .frame_index import get_frame_index
+from .molecules import _vmdnumpy, Molecule
+
+__all__ = ['AnalysisError', 'AnalysisStats', 'Analyzer', 'CallbackStats', 'Chunk', 'ParallelAnalyzer', 'Progress',
+           'Step', 'log_progress']
 
 
 LOGGER = logging.getLogger(__name__)
 
 
-class Step(object):
+class AnalysisError(Exception):
+    """
+    Analysis in a worker process failed.
+    """
+
+
+class _CoordsWriter(object):
+    """
+    Writes coordinates read by a native reader into the molecule, which contains only a single frame.
+
+    If `vmdnumpy` is available, the coordinates are written into the VMD timestep in place. Otherwise they are set
+    through atomsel, which is created only once.
+    """
+    def __init__(self, molecule):
+        self.molecule = molecule
+        self._atomsel = None
+
+    def write(self, coords):
+        """
+        Sets coordinates of all atoms in the frame of the molecule.
+        """
+        if _vmdnumpy is not None:
+            _vmdnumpy.timestep(self.molecule.molid, 0)[:] = coords
+            return
+        if self._atomsel is None:
+            self._atomsel = Selection('all', self.molecule).atomsel
+        for dim, name in enumerate(('x', 'y', 'z')):
+            self._atomsel.set(name, coords[:, dim].tolist())
+
+
+class MemoMixin(object):
+    """
+    Mixin which provides cache for results shared by the collectors and callbacks.
+    """
+    def memoize(self, key, function, *args, **kwargs):
+        """
+        Returns result of the function. The function is called only once for each key, later calls return the cached
+        result.
+
+        @param key: Key of the result, e.g. tuple (selection, operation)
+        @type key: Hashable
+        @param function: Function which computes the result
+        """
+        try:
+            return self._memo[key]
+        except KeyError:
+            result = self._memo[key] = function(*args, **kwargs)
+            return result
+
+
+class Step(MemoMixin):
     """
     Container with information about ongoing analysis.
 
+    Results cached by `memoize` are cleared when the analysis moves to the next frame.
+
     @ivar molecule: Molecule object
     @ivar frame: Currently analyzed frame (total count).
     """
-    def __init__(self, molecule):
+    def __init__(self, molecule, writer=None):
+        """
+        @param writer: Writer of coordinates read by a native reader into the molecule. If `None`, the coordinates
+                       are not copied into the molecule.
+        @type writer: _CoordsWriter or None
+        """
         self.molecule = molecule
+        self._writer = writer
         # Total frame count
         self.frame = -1
+        # Coordinates of the current frame
+        self._coords = None
+        # Cache of results for the current frame
+        self._memo = {}
         # Frame number of the currently loaded frame
         self._chunk_frame = -1
+        # Coordinates of the chunk read by a native reader
+        self._chunk = None
+        # Unit cells of the chunk read by a native reader
+        self._unitcells = None
 
     def __repr__(self):
         return '<%s: %d>' % (type(self).__name__, self.frame)
@@ -32,11 +113,46 @@ class Step(object):
     def __str__(self):
         return 'Step %d' % self.frame
 
-    def next_chunk(self):
+    def next_chunk(self, coords=None, unitcells=None):
         """
         New chunk is loaded.
+
+        @param coords: Coordinates of the chunk if it was read by a native reader.
+        @type coords: numpy array of shape (frames, atoms, 3) or None
+        @param unitcells: Unit cells of the chunk if it was read by a native reader.
+        @type unitcells: numpy array of shape (frames, 6) or None
         """
         self._chunk_frame = -1
+        self._chunk = coords
+        self._unitcells = unitcells
+        self._coords = None
+
+    @property
+    def coords(self):
+        """
+        Returns coordinates of all atoms in currently analyzed frame.
+
+        The array is a view of the VMD timestep or of the chunk read by a native reader if possible. It may change or
+        become invalid once the callback returns, make a copy to keep the coordinates.
+
+        @rtype: numpy array of shape (atoms, 3)
+        """
+        if self._coords is None:
+            self._coords = self.molecule.get_coords(self._chunk_frame)
+        return self._coords
+
+    @property
+    def unitcell(self):
+        """
+        Returns unit cell of currently analyzed frame.
+
+        @return: Tuple (a, b, c, alpha, beta, gamma) or None if the frame doesn't have periodic cell.
+        """
+        if self._chunk is None:
+            return self.molecule.get_unitcell(self._chunk_frame)
+        if self._unitcells is None:
+            return None
+        return tuple(self._unitcells[self._chunk_frame])
 
     def next_frame(self):
         """
@@ -44,34 +160,488 @@ class Step(object):
         """
         self.frame += 1
         self._chunk_frame += 1
-        self.molecule.frame = self._chunk_frame
+        self._memo.clear()
+        if self._chunk is None:
+            self._coords = None
+            self.molecule.frame = self._chunk_frame
+        else:
+            self._coords = self._chunk[self._chunk_frame]
+            if self._writer is not None:
+                # Copy the coordinates into the molecule, so the callbacks can use it as usual.
+                self._writer.write(self._coords)
+
+
+class Chunk(MemoMixin):
+    """
+    Container with information about loaded chunk of frames.
+
+    Results cached by `memoize` are kept for the chunk.
+
+    @ivar molecule: Molecule object
+    @ivar frames: Numbers of frames in the chunk (total count).
+    """
+    def __init__(self, molecule, frames, coords=None, unitcells=None, writer=None):
+        """
+        @param coords: Coordinates of the chunk if it was read by a native reader.
+        @type coords: numpy array of shape (frames, atoms, 3) or None
+        @param unitcells: Unit cells of the chunk if it was read by a native reader.
+        @type unitcells: numpy array of shape (frames, 6) or None
+        @param writer: Writer of coordinates read by a native reader into the molecule.
+        @type writer: _CoordsWriter or None
+        """
+        self.molecule = molecule
+        self.frames = frames
+        self._coords = coords
+        self._unitcells = unitcells
+        self._writer = writer
+        # Cache of results for the chunk
+        self._memo = {}
+        # Whether the frames are loaded in the molecule
+        self._loaded = coords is None
+
+    def __repr__(self):
+        return '<%s: %s>' % (type(self).__name__, ', '.join(str(f) for f in self.frames))
+
+    def __len__(self):
+        return len(self.frames)
+
+    @property
+    def coords(self):
+        """
+        Returns coordinates of all atoms in all frames of the chunk.
+
+        If the frames are loaded in the molecule, the coordinates are copied and kept for the chunk. The copy is not
+        included in the memory estimate of the analyzer, use `atom_coords` or `frame_coords` where possible.
+
+        @rtype: numpy array of shape (frames, atoms, 3)
+        """
+        if self._coords is None:
+            coords = numpy.empty((len(self), self.molecule.numatoms, 3), dtype=numpy.float32)
+            for index in xrange(len(self)):
+                coords[index] = self.molecule.get_coords(index)
+            self._coords = coords
+        return self._coords
+
+    def atom_coords(self, indices):
+        """
+        Returns coordinates of the atoms in all frames of the chunk.
+
+        Only coordinates of the requested atoms are copied if the frames are loaded in the molecule.
+
+        @param indices: Atom indexes
+        @type indices: numpy array of integers
+        @rtype: numpy array of shape (frames, len(indices), 3)
+        """
+        if self._coords is not None:
+            return self._coords[:, indices]
+        coords = numpy.empty((len(self), len(indices), 3), dtype=numpy.float32)
+        for index in xrange(len(self)):
+            coords[index] = self.molecule.get_coords(index)[indices]
+        return coords
+
+    def frame_coords(self, index):
+        """
+        Returns coordinates of all atoms in the frame of the chunk.
+
+        @param index: Index of the frame within the chunk
+        @type index: Non-negative integer
+        @rtype: numpy array of shape (atoms, 3)
+        """
+        if self._coords is not None:
+            return self._coords[index]
+        return self.molecule.get_coords(index)
+
+    @property
+    def unitcells(self):
+        """
+        Returns unit cells of all frames in the chunk.
+
+        @return: Unit cells (a, b, c, alpha, beta, gamma) or None if the frames don't have periodic cell.
+        @rtype: numpy array of shape (frames, 6) or None
+        """
+        if self._loaded:
+            return self.memoize('unitcells', self._molecule_unitcells)
+        return self._unitcells
+
+    def _molecule_unitcells(self):
+        # Returns unit cells of the frames loaded in the molecule
+        unitcells = [self.molecule.get_unitcell(index) for index in xrange(len(self))]
+        if not unitcells or None in unitcells:
+            return None
+        return numpy.array(unitcells)
+
+    def update_atomsel(self, atomsel, index):
+        """
+        Updates VMD atomsel to the frame of the chunk.
+
+        @param atomsel: VMD atomsel
+        @param index: Index of the frame within the chunk
+        @type index: Non-negative integer
+        """
+        if self._loaded:
+            atomsel.frame = index
+        else:
+            # The frame is not loaded in the molecule, copy its coordinates there.
+            if self._writer is None:
+                self._writer = _CoordsWriter(self.molecule)
+            self._writer.write(self._coords[index])
+        atomsel.update()
 
 
 # Internal structure which maintains callback information in analyzer
 Callback = namedtuple('Callback', ('function', 'args', 'kwargs'))
 
 
+class Progress(object):
+    """
+    Progress of the analysis.
+
+    @ivar frames: Number of analyzed frames
+    @ivar total: Total number of frames to be analyzed, `None` if not known. It's estimated from size of the trajectory
+                 files if the trajectory is loaded by VMD.
+    @ivar elapsed: Time since the start of the analysis in seconds
+    """
+    def __init__(self, frames, total, elapsed):
+        self.frames = frames
+        self.total = total
+        self.elapsed = elapsed
+
+    def __repr__(self):
+        return '<%s: %d/%s>' % (type(self).__name__, self.frames, self.total)
+
+    @property
+    def fps(self):
+        """
+        Returns number of analyzed frames per second.
+        """
+        if not self.elapsed:
+            return 0.0
+        return self.frames / self.elapsed
+
+    @property
+    def eta(self):
+        """
+        Returns estimated time to the end of the analysis in seconds or `None` if it can't be estimated.
+        """
+        if self.total is None or not self.fps:
+            return None
+        return max(self.total - self.frames, 0) / self.fps
+
+
+def log_progress(progress):
+    """
+    Progress callback which logs the progress of the analysis.
+    """
+    if progress.total is None:
+        LOGGER.info('Analyzed %d frames, %.1f frames/s', progress.frames, progress.fps)
+    elif progress.eta is None:
+        LOGGER.info('Analyzed %d of %d frames', progress.frames, progress.total)
+    else:
+        LOGGER.info('Analyzed %d of %d frames, %.1f frames/s, ETA %s', progress.frames, progress.total, progress.fps,
+                    timedelta(seconds=int(progress.eta)))
+
+
+class ProgressCallback(object):
+    """
+    Progress callback with its reporting rate.
+    """
+    def __init__(self, callback, frames, interval):
+        self.callback = callback
+        self.frames = frames
+        self.interval = interval
+        # Number of frames and time of the last report
+        self.last_frames = 0
+        self.last_time = 0.0
+
+    def update(self, progress, force=False):
+        """
+        Calls the callback if it's time to report the progress.
+        """
+        if not force and (self.frames is None or progress.frames - self.last_frames < self.frames) and \
+                (self.interval is None or progress.elapsed - self.last_time < self.interval):
+            return
+        self.last_frames = progress.frames
+        self.last_time = progress.elapsed
+        self.callback(progress)
+
+
+def _memory_usage():
+    """
+    Returns resident memory of the process in bytes or `None` if it can't be determined.
+    """
+    try:
+        with open('/proc/self/statm') as handle:
+            return int(handle.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (IOError, OSError, ValueError, IndexError):
+        return None
+
+
+def _peak_memory():
+    """
+    Returns peak resident memory of the process in bytes or `None` if it can't be determined.
+    """
+    try:
+        import resource
+    except ImportError:
+        return None
+    # Linux reports the size in kilobytes
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def _callback_name(function):
+    """
+    Returns name of the callback function.
+    """
+    name = getattr(function, '__name__', None) or repr(function)
+    owner = getattr(function, '__self__', None)
+    if owner is not None:
+        name = '%s.%s' % (type(owner).__name__, name)
+    return name
+
+
+class CallbackStats(object):
+    """
+    Timing statistics of a callback.
+
+    @ivar name: Name of the callback
+    @ivar calls: Number of calls
+    @ivar time: Cumulative time spent in the callback in seconds
+    """
+    def __init__(self, name):
+        self.name = name
+        self.calls = 0
+        self.time = 0.0
+
+    def __repr__(self):
+        return '<%s: %s>' % (type(self).__name__, self)
+
+    def __str__(self):
+        return '%s: %d calls, %.3f s' % (self.name, self.calls, self.time)
+
+
+class AnalysisStats(object):
+    """
+    Timing statistics of the analysis.
+
+    @ivar frames: Number of analyzed frames
+    @ivar chunks: Number of loaded chunks
+    @ivar time: Wall time of the analysis in seconds
+    @ivar load_time: Time spent loading the trajectory in seconds
+    @ivar delete_time: Time spent deleting frames from the molecule in seconds
+    @ivar chunk_callbacks: List of `CallbackStats` for chunk callbacks
+    @ivar callbacks: List of `CallbackStats` for frame callbacks
+    @ivar chunk_size: Number of frames in chunk at the end of the analysis
+    @ivar peak_memory: Peak resident memory of the process in bytes or `None` if not known
+    """
+    def __init__(self, chunk_callbacks=(), callbacks=()):
+        """
+        @param chunk_callbacks: Chunk callbacks of the analyzer
+        @param callbacks: Frame callbacks of the analyzer
+        """
+        self.frames = 0
+        self.chunks = 0
+        self.time = 0.0
+        self.load_time = 0.0
+        self.delete_time = 0.0
+        self.chunk_callbacks = [CallbackStats(_callback_name(c.function)) for c in chunk_callbacks]
+        self.callbacks = [CallbackStats(_callback_name(c.function)) for c in callbacks]
+        self.chunk_size = None
+        self.peak_memory = None
+
+    def __repr__(self):
+        return '<%s: %s>' % (type(self).__name__, self)
+
+    def __str__(self):
+        return '%d frames in %.3f s (%.1f frames/s): load %.3f s, delete %.3f s, compute %.3f s' % (
+            self.frames, self.time, self.fps, self.load_time, self.delete_time, self.compute_time)
+
+    @property
+    def fps(self):
+        """
+        Returns number of analyzed frames per second.
+        """
+        if not self.time:
+            return 0.0
+        return self.frames / self.time
+
+    @property
+    def compute_time(self):
+        """
+        Returns time spent in callbacks in seconds.
+        """
+        return sum(c.time for c in self.chunk_callbacks) + sum(c.time for c in self.callbacks)
+
+    def report(self):
+        """
+        Returns text report with statistics of all callbacks.
+        """
+        lines = [str(self)]
+        if self.peak_memory is None:
+            lines.append('  chunk size %s frames' % self.chunk_size)
+        else:
+            lines.append('  chunk size %s frames, peak memory %.1f MB'
+                         % (self.chunk_size, self.peak_memory / 2.0 ** 20))
+        lines.extend('  chunk callback %s' % c for c in self.chunk_callbacks)
+        lines.extend('  callback %s' % c for c in self.callbacks)
+        return '\n'.join(lines)
+
+    def merge(self, other):
+        """
+        Adds statistics of other analysis of the same callbacks, e.g. from the worker process.
+
+        Wall time is not added, since the analyses may run in parallel.
+        """
+        self.frames += other.frames
+        self.chunks += other.chunks
+        self.load_time += other.load_time
+        self.delete_time += other.delete_time
+        if other.chunk_size is not None:
+            self.chunk_size = min(self.chunk_size or other.chunk_size, other.chunk_size)
+        if other.peak_memory is not None:
+            self.peak_memory = max(self.peak_memory, other.peak_memory)
+        for mine, theirs in zip(self.chunk_callbacks + self.callbacks, other.chunk_callbacks + other.callbacks):
+            mine.calls += theirs.calls
+            mine.time += theirs.time
+
+
+class Prefetcher(threading.Thread):
+    """
+    Reads trajectory files ahead of VMD, so the data are ready in the OS cache when VMD loads them.
+
+    VMD can not load data outside of its main thread, so the prefetcher only reads the files into a scratch buffer
+    while the callbacks are running. Files are read sequentially, every request reads the next block of the file.
+    """
+    # Size of the scratch buffer
+    buffer_size = 1 << 20
+
+    def __init__(self):
+        super(Prefetcher, self).__init__(name='pyvmd-prefetcher')
+        self.daemon = True
+        self._requests = Queue.Queue()
+
+    def request(self, filename, size, offset=None):
+        """
+        Requests next `size` bytes of the file to be read.
+
+        @param offset: Position in the file to start from. If `None`, reading continues where the last request ended.
+        """
+        self._requests.put((filename, size, offset))
+
+    def stop(self):
+        """
+        Stops the prefetcher and waits until it finishes.
+        """
+        self._requests.put(None)
+        self.join()
+
+    def run(self):
+        buf = bytearray(self.buffer_size)
+        filename = None
+        handle = None
+        while True:
+            item = self._requests.get()
+            if item is None:
+                break
+            try:
+                if item[0] != filename:
+                    # Switch to the next file
+                    if handle is not None:
+                        handle.close()
+                        handle = None
+                    filename = item[0]
+                    handle = io.open(filename, 'rb')
+                elif handle is None:
+                    # The file couldn't be opened
+                    continue
+                filename, size, offset = item
+                if offset is not None:
+                    handle.seek(offset)
+                while size > 0:
+                    read = handle.readinto(buf)
+                    if not read:
+                        # End of file
+                        break
+                    size -= read
+            except IOError as error:
+                # Prefetching is only an optimization, VMD will report the problem once it gets to the file.
+                LOGGER.warning("Prefetching of '%s' failed: %s", filename, error)
+        if handle is not None:
+            handle.close()
+
+
 class Analyzer(object):
     """
     Iteratively loads the trajectory files and performs analysis.
     """
-    def __init__(self, molecule, traj_files, step=1, chunk=100):
+    # Estimated size of a frame in trajectory file per atom - three single precision coordinates.
+    frame_atom_size = 12
+    # Estimated size of a frame header in trajectory file.
+    frame_header_size = 80
+    # Estimated memory used by a loaded frame in addition to the coordinates.
+    frame_memory_overhead = 1024
+
+    def __init__(self, molecule, traj_files, step=1, chunk=100, prefetch=False, reader=None, stats_interval=None,
+                 checkpoint=None, checkpoint_interval=600, index=False, memory=None):
         """
         @param molecule: Molecule used for loading the trajectory.
-        @param traj_files: List of trajectory files
+        @param traj_files: List of trajectory files. Items can also be tuples `(filename, start, stop)` or
+                           `(filename, start, stop, step)` to analyze only range of frames from the file.
+                           The `stop` frame is not included, `None` means end of file.
         @param step: Load every 'step'th frame from trajectory.
         @type step: Positive integer
         @param chunk: Number of frames to load at once
         @type chunk: Positive integer
+        @param memory: Memory budget for the loaded chunk in bytes. If set, number of frames in chunk is derived
+                       from the budget and `chunk` is ignored. It's reduced if the frames use more memory than
+                       expected and enlarged again if they use much less.
+        @type memory: Positive integer or None
+        @param prefetch: Whether to read next chunk of the trajectory while the current one is analyzed. Only DCD files
+                         are prefetched without frame indexes.
+        @type prefetch: Boolean
+        @param reader: Native reader of trajectory files, e.g. `DCDReader`. If `None`, trajectory is loaded by VMD.
+        @type reader: Callable which takes filename and returns trajectory reader or None
+        @param stats_interval: Log timing statistics every `stats_interval` seconds. If `None`, they are not logged.
+        @type stats_interval: Positive number or None
+        @param checkpoint: Name of the file where the state of the analysis is saved, see `resume`.
+        @type checkpoint: String or None
+        @param checkpoint_interval: Save the state of the analysis every `checkpoint_interval` seconds.
+        @type checkpoint_interval: Positive number
+        @param index: Whether to use frame indexes of trajectory files, see `pyvmd.frame_index`.
+                      They provide exact number of frames and positions of frames for prefetching. They don't speed
+                      up loading of frames by VMD, which accepts only frame numbers.
+        @type index: Boolean
         """
         assert isinstance(molecule, Molecule)
         assert step > 0
         assert chunk > 0
+        assert memory is None or memory > 0
+        assert stats_interval is None or stats_interval > 0
+        assert checkpoint_interval > 0
         self.molecule = molecule
         self.traj_files = traj_files
         self.step = step
         self.chunk = chunk
+        self.memory = memory
+        # Current number of frames in chunk
+        self._chunk = chunk
+        # Estimated memory used by a loaded frame
+        self._frame_memory = None
+        self.prefetch = prefetch
+        self.reader = reader
+        self.stats_interval = stats_interval
+        self.checkpoint = checkpoint
+        self.checkpoint_interval = checkpoint_interval
+        self.index = index
+        # Frame indexes of the trajectory files
+        self._indexes = {}
+        # Positions of frames in DCD files, `None` for files in other formats
+        self._dcd_offsets = {}
+        # Timing statistics of the last analysis
+        self.stats = None
         self._callbacks = []
+        self._chunk_callbacks = []
+        self._progress_callbacks = []
+        self._datasets = []
 
     def add_callback(self, callback, *args, **kwargs):
         """
@@ -83,44 +653,663 @@ class Analyzer(object):
         """
         self._callbacks.append(Callback(callback, args, kwargs))
 
+    def add_chunk_callback(self, callback, *args, **kwargs):
+        """
+        Add callback to be called on every chunk of frames, before callbacks for individual frames.
+
+        @param callback: A function to be called on every chunk. It must expect `Chunk` object as first argument.
+        @param *args: Additional positional arguments a function is called with.
+        @param **kwargs: Additional keyword arguments a function is called with.
+        """
+        self._chunk_callbacks.append(Callback(callback, args, kwargs))
+
+    def add_progress_callback(self, callback, frames=None, interval=None):
+        """
+        Add callback to be called with the progress of the analysis.
+
+        The progress is checked after every chunk and once the analysis is finished.
+
+        @param callback: A function to be called with `Progress` object, e.g. `log_progress`.
+        @param frames: Report the progress every `frames` frames.
+        @type frames: Positive integer or None
+        @param interval: Report the progress every `interval` seconds.
+        @type interval: Positive number or None
+        """
+        assert frames is None or frames > 0
+        assert interval is None or interval > 0
+        assert frames is not None or interval is not None
+        self._progress_callbacks.append(ProgressCallback(callback, frames, interval))
+
     def add_dataset(self, dataset):
         """
         Registers dataset for analysis.
         """
+        self._chunk_callbacks.append(Callback(dataset.collect_chunk, (), {}))
         self._callbacks.append(Callback(dataset.collect, (), {}))
+        self._datasets.append(dataset)
 
-    def analyze(self):
+    def _frames_in_molecule(self):
         """
-        Run the analysis.
+        Returns whether frame callbacks need the analyzed frame in the molecule.
+
+        Frames read by a native reader have to be copied into the molecule only for frame callbacks other than
+        datasets and for collectors which don't support batches.
+        """
+        dataset_callbacks = [dataset.collect for dataset in self._datasets]
+        if any(callback.function not in dataset_callbacks for callback in self._callbacks):
+            return True
+        return any(not collector.batch for dataset in self._datasets for collector in dataset.collectors)
+
+    def _segments(self):
+        """
+        Returns list of trajectory segments to be analyzed.
+
+        @return: List of (filename, start, stop, step) tuples. The `stop` frame is not included, `None` means end of
+                 file.
+        """
+        segments = []
+        for item in self.traj_files:
+            if isinstance(item, basestring):
+                segments.append((item, 0, None, self.step))
+            else:
+                filename, start, stop = item[:3]
+                step = item[3] if len(item) > 3 else self.step
+                assert start >= 0
+                assert stop is None or stop >= 0
+                assert step > 0
+                segments.append((filename, start, stop, step))
+        return segments
+
+    def _frame_index(self, filename):
+        """
+        Returns frame index of the trajectory file.
+        """
+        if filename not in self._indexes:
+            self._indexes[filename] = get_frame_index(filename)
+        return self._indexes[filename]
+
+    def _length(self, filename):
+        """
+        Returns number of frames in the trajectory file or `None` if it is not known in advance.
+        """
+        if self.reader is not None:
+            trajectory = self.reader(filename)
+            try:
+                return len(trajectory)
+            finally:
+                trajectory.close()
+        if self.index:
+            return len(self._frame_index(filename))
+        # VMD doesn't provide number of frames in a file without loading it.
+        return None
+
+    def _count_frames(self, segments):
+        """
+        Returns number of frames which will be analyzed in the trajectory segments.
+
+        @return: Number of frames or `None` if it is not known in advance.
+        """
+        frames = 0
+        for filename, start, end, step in segments:
+            length = self._length(filename)
+            if length is None:
+                return None
+            end = length if end is None else min(end, length)
+            frames += len(xrange(start, end, step))
+        return frames
+
+    def _estimate_frames(self, segments):
+        """
+        Returns estimated number of frames which will be analyzed in the trajectory segments.
+
+        @return: Number of frames or `None` if it can't be estimated.
+        """
+        frames = self._count_frames(segments)
+        if frames is not None:
+            return frames
+        # Estimate the number of frames from the size of the files
+        frame_size = self.molecule.numatoms * self.frame_atom_size + self.frame_header_size
+        frames = 0
+        for filename, start, end, step in segments:
+            try:
+                end = os.path.getsize(filename) // frame_size if end is None else end
+            except OSError:
+                return None
+            frames += len(xrange(start, end, step))
+        return frames
+
+    def _frame_offsets(self, filename):
+        """
+        Returns positions of frames in the DCD file or `None` if the file is not a DCD file.
+        """
+        if filename not in self._dcd_offsets:
+            try:
+                self._dcd_offsets[filename] = DCDReader(filename).frame_offsets()
+            except (IOError, ValueError):
+                self._dcd_offsets[filename] = None
+        return self._dcd_offsets[filename]
+
+    def _byte_range(self, filename, start, stop):
+        """
+        Returns position and size of the frames in the trajectory file.
+
+        Positions are taken from the frame index or from the header of DCD files. Frames in other formats may differ
+        in size, so their positions are not known without the index.
+
+        @return: Tuple (offset, size) or `None` if the positions of the frames are not known.
+        """
+        if self.index:
+            return self._frame_index(filename).byte_range(start, stop)
+        offsets = self._frame_offsets(filename)
+        if offsets is None:
+            return None
+        numframes = len(offsets) - 1
+        start = min(start, numframes)
+        stop = min(stop, numframes)
+        return int(offsets[start]), int(max(offsets[stop] - offsets[start], 0))
+
+    def _request_prefetch(self, prefetcher, filename, start, stop):
+        """
+        Requests the frames to be prefetched, if their positions in the file are known.
+        """
+        byte_range = self._byte_range(filename, start, stop)
+        if byte_range is None:
+            LOGGER.debug("Positions of frames in '%s' are not known, they are not prefetched.", filename)
+            return
+        offset, size = byte_range
+        prefetcher.request(filename, size, offset)
+
+    def _estimate_frame_memory(self):
+        """
+        Returns estimated memory used by a loaded frame in bytes.
+        """
+        return self.molecule.numatoms * self.frame_atom_size + self.frame_memory_overhead
+
+    def _initial_chunk(self):
+        """
+        Returns number of frames in the first chunk.
+        """
+        if self.memory is None:
+            return self.chunk
+        return max(self.memory // self._estimate_frame_memory(), 1)
+
+    def _adapt_chunk(self, loaded, used):
+        """
+        Adjusts the chunk size to the memory budget if the loaded frames used more memory than expected.
+
+        If the chunk was reduced and the frames use less than half of the memory expected, the chunk is enlarged again,
+        up to the size derived from the initial estimate.
+
+        @param loaded: Number of loaded frames
+        @param used: Memory used by loading the frames in bytes
+        """
+        if self.memory is None or used is None or not loaded:
+            return
+        estimate = self._estimate_frame_memory()
+        if self._frame_memory is None:
+            self._frame_memory = estimate
+        if used > self._frame_memory * loaded:
+            self._frame_memory = used // loaded
+        elif used * 2 < self._frame_memory * loaded and self._frame_memory > estimate:
+            self._frame_memory = max(used // loaded, estimate)
+        else:
+            return
+        chunk = max(self.memory // self._frame_memory, 1)
+        if chunk != self._chunk:
+            LOGGER.debug('Frames use %d bytes, chunk %s from %d to %d frames.', self._frame_memory,
+                         'reduced' if chunk < self._chunk else 'enlarged', self._chunk, chunk)
+            self._chunk = chunk
+
+    def _load_chunks(self, segments):
+        """
+        Loads the trajectory segments into the molecule by chunks.
+
+        Yields number of loaded frames, `None` as coordinates and unit cells, they are loaded in the molecule, and
+        segments which remain to be analyzed after the chunk.
         """
         # Clear the molecule frames
         del self.molecule.frames[:]
 
-        step = Step(self.molecule)
-        for filename in self.traj_files:
-            start = 0
-            while True:
-                # Load 'chunk' frames
-                stop = start + self.step * self.chunk - 1
-                LOGGER.debug('Loading %s from %d to %d, every %d', filename, start, stop, self.step)
-                self.molecule.load(filename, start=start, stop=stop, step=self.step)
-                loaded = len(self.molecule.frames)
-                if not loaded:
-                    # No frames were loaded
-                    break
+        prefetcher = None
+        if self.prefetch and segments:
+            prefetcher = Prefetcher()
+            prefetcher.start()
+            filename, start, dummy, step = segments[0]
+            self._request_prefetch(prefetcher, filename, start, start + step * self._chunk)
+
+        try:
+            for index, (filename, start, end, step) in enumerate(segments):
+                while end is None or start < end:
+                    # Load 'chunk' frames
+                    stop = start + step * self._chunk - 1
+                    if end is not None:
+                        stop = min(stop, end - 1)
+                    # Number of frames expected to be loaded
+                    expected = len(xrange(start, stop + 1, step))
+                    LOGGER.debug('Loading %s from %d to %d, every %d', filename, start, stop, step)
+                    memory = _memory_usage() if self.memory is not None else None
+                    started = time.time()
+                    self.molecule.load(filename, start=start, stop=stop, step=step)
+                    self.stats.load_time += time.time() - started
+                    loaded = len(self.molecule.frames)
+                    if not loaded:
+                        # No frames were loaded
+                        break
+
+                    next_start = start + step * self._chunk
+                    if memory is not None:
+                        used = _memory_usage()
+                        self._adapt_chunk(loaded, used - memory if used is not None else None)
+                    finished = loaded < expected or (end is not None and next_start >= end)
+                    if prefetcher is not None:
+                        # Read the next chunk while the callbacks are running
+                        if not finished:
+                            prefetch = (filename, next_start, next_start + step * self._chunk)
+                        elif index + 1 < len(segments):
+                            next_filename, next_file_start, dummy, next_step = segments[index + 1]
+                            prefetch = (next_filename, next_file_start, next_file_start + next_step * self._chunk)
+                        else:
+                            prefetch = None
+                        if prefetch is not None:
+                            self._request_prefetch(prefetcher, *prefetch)
+
+                    if finished:
+                        remaining = segments[index + 1:]
+                    else:
+                        remaining = [(filename, next_start, end, step)] + segments[index + 1:]
+                    yield loaded, None, None, remaining
+
+                    # Prepare for next iteration - delete all frames
+                    started = time.time()
+                    del self.molecule.frames[:]
+                    self.stats.delete_time += time.time() - started
+                    if loaded < expected:
+                        # Nothing else to be loaded for this filename
+                        break
+                    start = next_start
+        finally:
+            if prefetcher is not None:
+                prefetcher.stop()
+
+    def _read_chunks(self, segments):
+        """
+        Reads the trajectory segments by native reader by chunks.
+
+        Yields number of read frames, their coordinates and unit cells and segments which remain to be analyzed after
+        the chunk.
+        """
+        # Keep only single frame in the molecule, it will hold the coordinates of the analyzed frame.
+        if len(self.molecule.frames):
+            del self.molecule.frames[1:]
+        elif segments:
+            self.molecule.load(segments[0][0], start=0, stop=0)
+
+        for index, (filename, start, end, step) in enumerate(segments):
+            trajectory = self.reader(filename)
+            try:
+                end = len(trajectory) if end is None else min(end, len(trajectory))
+                chunk_start = start
+                while chunk_start < end:
+                    stop = min(chunk_start + step * self._chunk, end)
+                    LOGGER.debug('Reading %s from %d to %d, every %d', filename, chunk_start, stop - 1, step)
+                    started = time.time()
+                    coords = trajectory.read(chunk_start, stop, step)
+                    unitcells = trajectory.unitcells(chunk_start, stop, step)
+                    self.stats.load_time += time.time() - started
+                    if stop < end:
+                        remaining = [(filename, stop, end, step)] + segments[index + 1:]
+                    else:
+                        remaining = segments[index + 1:]
+                    yield len(coords), coords, unitcells, remaining
+                    chunk_start = stop
+            finally:
+                trajectory.close()
+
+    def _save_checkpoint(self, segments, step):
+        """
+        Saves the state of the analysis into the checkpoint file.
+
+        @param segments: Segments which remain to be analyzed
+        """
+        state = {'traj_files': self.traj_files, 'step': self.step, 'chunk': self.chunk, 'segments': segments,
+                 'frame': step.frame, 'datasets': [dataset.get_state() for dataset in self._datasets]}
+        # Write the checkpoint into a temporary file first, so the last checkpoint survives a crash during the save.
+        tmp_filename = self.checkpoint + '.tmp'
+        with open(tmp_filename, 'wb') as handle:
+            pickle.dump(state, handle, pickle.HIGHEST_PROTOCOL)
+        os.rename(tmp_filename, self.checkpoint)
+        LOGGER.debug("Checkpoint saved at frame %d", step.frame)
+
+    def _load_checkpoint(self):
+        """
+        Loads the state of the analysis from the checkpoint file.
+        """
+        with open(self.checkpoint, 'rb') as handle:
+            state = pickle.load(handle)
+        if (state['traj_files'], state['step'], state['chunk']) != (self.traj_files, self.step, self.chunk):
+            raise ValueError("Checkpoint '%s' was created by different analysis." % self.checkpoint)
+        if len(state['datasets']) != len(self._datasets):
+            raise ValueError("Checkpoint '%s' contains %d datasets, analyzer has %d." % (
+                self.checkpoint, len(state['datasets']), len(self._datasets)))
+        return state
+
+    def _run(self, segments, state=None, first_frame=0):
+        """
+        Runs the analysis of the trajectory segments.
+
+        @param state: State of the analysis to continue from, see `_save_checkpoint`.
+        @param first_frame: Number of the first analyzed frame, used by tasks of parallel analysis.
+        @type first_frame: Non-negative integer
+        @return: Number of the frame following the last analyzed frame
+        """
+        stats = self.stats = AnalysisStats(self._chunk_callbacks, self._callbacks)
+        started = logged = checkpointed = time.time()
+        self._chunk = self._initial_chunk()
+        self._frame_memory = None
+        writer = None
+        if self.reader is not None:
+            writer = _CoordsWriter(self.molecule)
+        step = Step(self.molecule, writer if self._frames_in_molecule() else None)
+        step.frame = first_frame - 1
+        if state is not None:
+            step.frame = state['frame']
+        total = None
+        if self._progress_callbacks:
+            total = self._estimate_frames(segments)
+            for progress_callback in self._progress_callbacks:
+                progress_callback.last_frames = 0
+                progress_callback.last_time = 0.0
+        frames = self._count_frames(segments)
+        for index, dataset in enumerate(self._datasets):
+            dataset.prepare(self.molecule)
+            if state is not None:
+                dataset.set_state(state['datasets'][index])
+            if frames is not None:
+                dataset.reserve(frames)
+        if self.reader is None:
+            chunks = self._load_chunks(segments)
+        else:
+            chunks = self._read_chunks(segments)
+
+        # Pairs of callbacks and their statistics
+        chunk_callbacks = zip(self._chunk_callbacks, stats.chunk_callbacks)
+        callbacks = zip(self._callbacks, stats.callbacks)
+        try:
+            for loaded, coords, unitcells, remaining in chunks:
+                # Call the chunk callbacks
+                chunk = Chunk(self.molecule, numpy.arange(step.frame + 1, step.frame + 1 + loaded), coords, unitcells,
+                              writer)
+                for callback, callback_stats in chunk_callbacks:
+                    callback_started = time.time()
+                    callback.function(chunk, *callback.args, **callback.kwargs)
+                    callback_stats.time += time.time() - callback_started
+                    callback_stats.calls += 1
 
                 # Call the callback
-                step.next_chunk()
+                step.next_chunk(coords, unitcells)
                 for dummy in xrange(0, loaded):
                     step.next_frame()
-                    LOGGER.info('Analyzing frame %d', step.frame)
-                    for callback in self._callbacks:
+                    LOGGER.debug('Analyzing frame %d', step.frame)
+                    for callback, callback_stats in callbacks:
+                        callback_started = time.time()
                         callback.function(step, *callback.args, **callback.kwargs)
+                        callback_stats.time += time.time() - callback_started
+                        callback_stats.calls += 1
+
+                stats.chunks += 1
+                stats.frames += loaded
+                now = time.time()
+                stats.time = now - started
+                if self.stats_interval is not None and now - logged >= self.stats_interval:
+                    LOGGER.info('Analysis statistics: %s', stats)
+                    logged = now
+                if self._progress_callbacks:
+                    progress = Progress(stats.frames, total, stats.time)
+                    for progress_callback in self._progress_callbacks:
+                        progress_callback.update(progress)
+                if self.checkpoint is not None and now - checkpointed >= self.checkpoint_interval:
+                    self._save_checkpoint(remaining, step)
+                    checkpointed = now
+        finally:
+            chunks.close()
+            stats.time = time.time() - started
+            stats.chunk_size = self._chunk
+            stats.peak_memory = _peak_memory()
+        for dataset in self._datasets:
+            dataset.flush()
+        if self.checkpoint is not None:
+            # Save the final state, so the finished analysis can be resumed too.
+            self._save_checkpoint([], step)
+        # Report the final progress, unless it was already reported
+        progress = Progress(stats.frames, stats.frames, stats.time)
+        for progress_callback in self._progress_callbacks:
+            if progress_callback.last_frames != stats.frames:
+                progress_callback.update(progress, force=True)
+        return step.frame + 1
+
+    def analyze(self):
+        """
+        Run the analysis.
+        """
+        frames = self._run(self._segments())
+        LOGGER.info('Analyzed %s frames.', frames)
+        LOGGER.debug('Analysis statistics: %s', self.stats.report())
+
+    def resume(self):
+        """
+        Resume the analysis from the checkpoint.
+
+        If the checkpoint doesn't exist, the analysis starts from the beginning.
+
+        Callbacks, datasets and their collectors have to be registered in the same way as in the original analysis.
+        """
+        assert self.checkpoint is not None
+        if not os.path.exists(self.checkpoint):
+            LOGGER.info("Checkpoint '%s' doesn't exist, starting the analysis.", self.checkpoint)
+            self.analyze()
+            return
+        state = self._load_checkpoint()
+        LOGGER.info("Resuming the analysis from frame %d.", state['frame'] + 1)
+        frames = self._run(state['segments'], state)
+        LOGGER.info('Analyzed %s frames.', frames)
+        LOGGER.debug('Analysis statistics: %s', self.stats.report())
+
+
+# Analyzer used by worker processes. It is set before the workers are forked, so they inherit it.
+_WORKER_ANALYZER = None
+# Interval in seconds in which the workers are checked while their results are waited for.
+_WORKER_POLL_INTERVAL = 1
+
+
+def _analyze_task(segments, first_frame=None):
+    """
+    Analyzes the task in the worker process.
+
+    @param segments: List of segments to be analyzed.
+    @param first_frame: Number of the first frame of the task or `None` if it's not known.
+    @return: Tuple with number of analyzed frames, data of datasets, states of their collectors and timing statistics.
+    """
+    try:
+        first_frame = first_frame or 0
+        frames = _WORKER_ANALYZER._run(segments, first_frame=first_frame) - first_frame  # pylint: disable=W0212
+        datasets = _WORKER_ANALYZER._datasets  # pylint: disable=protected-access
+        return (frames, [dataset.records for dataset in datasets],
+                [[c.get_state() for c in dataset.collectors] for dataset in datasets], _WORKER_ANALYZER.stats)
+    except Exception:
+        # Exceptions with tracebacks can't be passed from the workers, so format them here.
+        raise AnalysisError("Analysis of %s failed:\n%s" % (
+            ', '.join('%s from %d to %s' % segment[:3] for segment in segments), traceback.format_exc()))
+
+
+def _run_worker(index, segments, first_frame, results):
+    """
+    Analyzes the task in the worker process and puts the result or the error into the queue.
+    """
+    try:
+        result = _analyze_task(segments, first_frame)
+    except AnalysisError as error:
+        result = error
+    results.put((index, result))
+
+
+class ParallelAnalyzer(Analyzer):
+    """
+    Performs analysis in multiple processes.
+
+    Trajectory is split into tasks, either by files or by frame ranges if number of frames in the files is known, i.e.
+    the trajectory is read by native reader or frame indexes are used.
+    Tasks are analyzed in worker processes forked from the current process, so each one contains its own copy of the
+    molecule. Data collected by datasets are merged back in the order of frames. Other callbacks are run in the worker
+    processes, so their side effects are not visible in the main process.
+
+    Frames in the tasks are numbered from the start of the trajectory if the number of frames in the preceding tasks is
+    known, otherwise they are numbered from the start of the task. Progress callbacks report the progress of the tasks.
+
+    Checkpoints are not supported, `checkpoint` and `checkpoint_interval` arguments are not accepted and `resume` raises
+    `TypeError`.
+    """
+    def __init__(self, molecule, traj_files, step=1, chunk=100, prefetch=False, reader=None, stats_interval=None,
+                 index=False, memory=None, processes=None):
+        """
+        @param processes: Number of worker processes. Default is number of CPUs.
+        @type processes: Positive integer or None
+        """
+        assert processes is None or processes > 0
+        super(ParallelAnalyzer, self).__init__(molecule, traj_files, step=step, chunk=chunk, prefetch=prefetch,
+                                               reader=reader, stats_interval=stats_interval, index=index,
+                                               memory=memory)
+        self.processes = processes or multiprocessing.cpu_count()
+
+    def _tasks(self):
+        """
+        Splits the trajectory into tasks.
+
+        @return: List of tasks, each is a list of segments.
+        """
+        segments = self._segments()
+        if len(segments) >= self.processes:
+            # Split by files
+            return [[segment] for segment in segments]
+        lengths = [self._length(filename) for filename, dummy_start, dummy_stop, dummy_step in segments]
+        if None in lengths:
+            # Number of frames is not known, split by files
+            return [[segment] for segment in segments]
+
+        # Split files by frame ranges. Ranges have to start on chunk boundaries to get the same frames as serial run.
+        ranges = []
+        for (filename, start, end, step), length in zip(segments, lengths):
+            ranges.append((filename, start, length if end is None else min(end, length), step))
+        task_size = max(sum(max(end - start, 0) for dummy, start, end, dummy_step in ranges) // self.processes, 1)
+        tasks = []
+        for filename, start, end, step in ranges:
+            chunk_size = step * self._initial_chunk()
+            size = (task_size + chunk_size - 1) // chunk_size * chunk_size
+            for task_start in xrange(start, end, size):
+                tasks.append([(filename, task_start, min(task_start + size, end), step)])
+        return tasks
+
+    def _first_frames(self, tasks):
+        """
+        Returns numbers of the first frames of the tasks.
+
+        @return: List with the number of the first frame of each task or `None` if it's not known in advance.
+        """
+        first_frames = []
+        frames = 0
+        for segments in tasks:
+            first_frames.append(frames)
+            if frames is not None:
+                count = self._count_frames(segments)
+                frames = None if count is None else frames + count
+        return first_frames
+
+    def _run_tasks(self, tasks, first_frames):
+        """
+        Analyzes the tasks in worker processes.
+
+        Every task is analyzed in a new process, so datasets are empty at the start of each task. Workers are watched
+        while their results are waited for, so the analysis fails if any of them dies.
+
+        @return: List of results of the tasks, see `_analyze_task`.
+        """
+        queue = multiprocessing.Queue()
+        pending = list(enumerate(zip(tasks, first_frames)))
+        workers = {}
+        results = {}
+        try:
+            while len(results) < len(tasks):
+                while pending and len(workers) < self.processes:
+                    index, (segments, first_frame) = pending.pop(0)
+                    worker = multiprocessing.Process(target=_run_worker, args=(index, segments, first_frame, queue))
+                    worker.daemon = True
+                    worker.start()
+                    workers[index] = worker
+                try:
+                    index, result = queue.get(timeout=_WORKER_POLL_INTERVAL)
+                except Queue.Empty:
+                    for index, worker in workers.items():
+                        if worker.exitcode:
+                            if worker.exitcode < 0:
+                                reason = 'was killed by signal %d' % -worker.exitcode
+                            else:
+                                reason = 'exited with code %d' % worker.exitcode
+                            raise AnalysisError("Worker analyzing %s %s." % (
+                                ', '.join('%s from %d to %s' % segment[:3] for segment in tasks[index]), reason))
+                    continue
+                workers.pop(index).join()
+                if isinstance(result, AnalysisError):
+                    raise result
+                results[index] = result
+        finally:
+            for worker in workers.values():
+                if worker.is_alive():
+                    worker.terminate()
+                worker.join()
+        return [results[index] for index in xrange(len(tasks))]
+
+    def resume(self):
+        """
+        Parallel analysis doesn't support checkpoints, use `analyze` instead.
+
+        @raise TypeError: Always
+        """
+        raise TypeError("%s doesn't support checkpoints, use analyze() instead." % type(self).__name__)
+
+    def analyze(self):
+        """
+        Run the analysis.
+        """
+        global _WORKER_ANALYZER  # pylint: disable=global-statement
+        tasks = self._tasks()
+        first_frames = self._first_frames(tasks)
+        LOGGER.info('Analyzing %d tasks in %d processes.', len(tasks), self.processes)
+
+        started = time.time()
+        _WORKER_ANALYZER = self
+        try:
+            results = self._run_tasks(tasks, first_frames)
+        finally:
+            _WORKER_ANALYZER = None
 
-                # Prepare for next iteration - delete all frames
-                del self.molecule.frames[:]
-                if loaded < self.chunk:
-                    # Nothing else to be loaded for this filename
-                    break
-                start += self.step * self.chunk
-        LOGGER.info('Analyzed %s frames.', step.frame + 1)
+        # Merge the data in the order of tasks
+        for index, dataset in enumerate(self._datasets):
+            # Columns of some collectors depend on the molecule
+            dataset.prepare(self.molecule)
+            dataset.reserve(sum(len(data[index]) for dummy, data, dummy_states, dummy_stats in results))
+        frames = 0
+        self.stats = AnalysisStats(self._chunk_callbacks, self._callbacks)
+        for (task_frames, data, states, task_stats), first_frame in zip(results, first_frames):
+            for dataset, task_data, task_states in zip(self._datasets, data, states):
+                if first_frame is None:
+                    # Shift frame numbers by number of frames in previous tasks, frame is always the first column.
+                    task_data[task_data.dtype.names[0]] += frames
+                dataset._add_rows(task_data)  # pylint: disable=protected-access
+                for collector, state in zip(dataset.collectors, task_states):
+                    collector.merge_state(state)
+            frames += task_frames
+            self.stats.merge(task_stats)
+        for dataset in self._datasets:
+            dataset.flush()
+        self.stats.time = time.time() - started
+        LOGGER.info('Analyzed %s frames.', frames)
+        LOGGER.debug('Analysis statistics: %s', self.stats.report())
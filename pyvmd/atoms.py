@@ -7,7 +7,7 @@ from atomsel import atomsel as _atomsel
 from numpy import array
 from VMD import molecule as _molecule
 
-from .molecules import Molecule, MOLECULES
+from .molecules import _vmdnumpy, Molecule, MOLECULES
 
 __all__ = ['Atom', 'Chain', 'Residue', 'Segment', 'Selection', 'NOW']
 
@@ -291,6 +291,10 @@ class Atom(StaticSelection):
     z = _object_property('z', doc="Coordinate in 'z' dimension.")
 
     def _get_coords(self):
+        if _vmdnumpy is not None:
+            # Index directly into the VMD timestep
+            frame = self._molecule.frame if self._frame == NOW else self._frame
+            return array(_vmdnumpy.timestep(self._molecule.molid, frame)[self._index], dtype=float)
         # XXX: This is unintuitive, but very fast. The atom's center is the location of the atom.
         # Apparently getting the coordinates all at once has lower overhead than underlying conputation of the center.
         return array(self.atomsel.center())
@@ -2,12 +2,16 @@
 Data collectors for trajectory analysis.
 """
 import logging
+import re
+
+import numpy
 
 from . import measure
-from .atoms import Selection
+from .atoms import NOW, Selection
 
-__all__ = ['AngleCollector', 'Collector', 'DihedralCollector', 'DistanceCollector', 'FrameCollector', 'RMSDCollector',
-           'XCoordCollector', 'YCoordCollector', 'ZCoordCollector']
+__all__ = ['AngleCollector', 'Collector', 'DihedralCollector', 'DistanceCollector', 'FrameCollector',
+           'GyrationCollector', 'MultiXYZCollector', 'PairDistanceCollector', 'RMSDCollector', 'RMSFCollector',
+           'TorsionCollector', 'XCoordCollector', 'XYZCollector', 'YCoordCollector', 'ZCoordCollector']
 
 
 LOGGER = logging.getLogger(__name__)
@@ -21,6 +25,16 @@ class Collector(object):
     header_fmt = '%10s'
     # Format of the data in the output
     data_fmt = '%10.4f'
+    # Data type used to store the data, e.g. `numpy.float32` halves the memory used by the data.
+    dtype = numpy.float64
+    # Whether the collector can collect data for whole chunk of frames, see `collect_chunk`.
+    batch = False
+    # Names of the columns if the collector returns vector of fixed length, `None` if it returns single value.
+    columns = None
+    # Whether the columns depend on the molecule and are not known until `prepare` is called.
+    columns_deferred = False
+    # Whether the columns are stored in a single field of shape (columns, ) instead of a field for each column.
+    block = False
 
     # Counter for automatic name generation.
     auto_name_counter = 0
@@ -36,14 +50,77 @@ class Collector(object):
             name = 'data%05d' % Collector.auto_name_counter
         self.name = name
 
+    @property
+    def column_names(self):
+        """
+        Returns names of the columns of the collector.
+
+        Columns of collectors which return vectors are named '<name>.<column>'.
+        """
+        if self.columns is None:
+            return [self.name]
+        return ['%s.%s' % (self.name, column) for column in self.columns]
+
+    @property
+    def fields(self):
+        """
+        Returns names of the fields in dataset. Collectors which store columns in a block have a single field named
+        by the collector, other have a field for each column.
+        """
+        if self.block:
+            return [self.name]
+        return self.column_names
+
     def collect(self, step):
         """
         Performs the analysis on the frame.
 
         Derived class must implement this method.
+
+        @return: Single value or vector with value for each column, if the collector defines `columns`.
+        """
+        raise NotImplementedError
+
+    def prepare(self, molecule):
+        """
+        Prepares the collector for the analysis of the molecule, e.g. resolves the selections.
+
+        Called once when the analysis starts.
+        """
+
+    def collect_chunk(self, chunk):
+        """
+        Performs the analysis on all frames of the chunk.
+
+        Derived class may implement this method and set `batch` to `True`.
+
+        @type chunk: Chunk
+        @return: Array with data for each frame of the chunk, of shape (frames, columns) if the collector defines
+                 `columns`.
         """
         raise NotImplementedError
 
+    def get_state(self):
+        """
+        Returns state of the collector, which can be pickled. Used for checkpoints of the analysis.
+
+        Derived class which accumulates data over frames has to implement this method and `set_state`.
+        """
+        return None
+
+    def set_state(self, state):
+        """
+        Restores the state of the collector.
+        """
+
+    def merge_state(self, state):
+        """
+        Merges the state of the collector from the analysis of other frames. Used by `ParallelAnalyzer` to combine
+        results of worker processes.
+
+        Derived class which accumulates data over frames has to implement this method.
+        """
+
 
 class FrameCollector(Collector):
     """
@@ -51,25 +128,208 @@ class FrameCollector(Collector):
     """
     header_fmt = '%8s'
     data_fmt = '%8d'
+    dtype = numpy.int64
+    batch = True
 
     def collect(self, step):
         return step.frame
 
+    def collect_chunk(self, chunk):
+        return chunk.frames
+
+
+# Selection keywords which depend on coordinates, selections containing them have to be evaluated for every frame.
+# This also covers `same ... as` selections which contain such keywords.
+DYNAMIC_KEYWORDS = re.compile(r'\b(x|y|z|vx|vy|vz|ufx|ufy|ufz|phi|psi|pucker|within|exwithin|pbwithin|'
+                              r'user|user2|user3|user4)\b')
 
-def _selection_center(selection_text, molecule):
+
+class CompiledSelection(object):
     """
-    Utility method to get center of selection.
+    Selection used by collectors, which is resolved once per analysis.
+
+    Selection which doesn't depend on coordinates is resolved only once into array of atom indexes.
+    Selections which depend on coordinates are evaluated again for every frame.
+
+    @ivar selection: Selection text
+    @ivar dynamic: Whether the selection depends on coordinates
     """
-    sel = Selection(selection_text, molecule)
-    if not len(sel):
-        raise ValueError("Selection '%s' doesn't match any atoms." % selection_text)
-    return measure.center(sel)
+    def __init__(self, selection):
+        """
+        @param selection: Selection text
+        @type selection: String
+        """
+        self.selection = selection
+        self.dynamic = bool(DYNAMIC_KEYWORDS.search(selection))
+        self._molecule = None
+        # VMD atomsel of the selection in the active frame
+        self._atomsel = None
+        # Indexes of selected atoms
+        self._indices = None
+
+    def __repr__(self):
+        return "<%s: '%s'>" % (type(self).__name__, self.selection)
+
+    def prepare(self, molecule):
+        """
+        Resolves the selection for the molecule.
+        """
+        self._molecule = molecule
+        self._atomsel = Selection(self.selection, molecule).atomsel
+        if not self.dynamic:
+            self._update()
+
+    def _update(self):
+        # Update atom indexes from atomsel
+        self._indices = numpy.fromiter(self._atomsel, dtype=int)
+        if not len(self._indices):
+            raise ValueError("Selection '%s' doesn't match any atoms." % self.selection)
+
+    def atomsel(self, molecule):
+        """
+        Returns VMD atomsel of the selection in the active frame of the molecule.
+        """
+        if molecule != self._molecule:
+            self.prepare(molecule)
+        elif self.dynamic:
+            self._atomsel.update()
+            self._update()
+        return self._atomsel
+
+    def indices(self, molecule):
+        """
+        Returns array of atom indexes of the selection in the active frame of the molecule.
+        """
+        self.atomsel(molecule)
+        return self._indices
+
+    def center(self, step):
+        """
+        Returns center of the selection in the analyzed frame.
+
+        The result is shared with other selections with the same text for the frame.
+        """
+        return step.memoize((self.selection, 'center'), self._center, step)
+
+    def _center(self, step):
+        return self.coords(step).mean(axis=0, dtype=numpy.float64)
+
+    def coords(self, step):
+        """
+        Returns coordinates of the selection in the analyzed frame.
+
+        The result is shared with other selections with the same text for the frame.
+
+        @rtype: numpy array of shape (atoms, 3)
+        """
+        return step.memoize((self.selection, 'coords'), self._coords, step)
+
+    def _coords(self, step):
+        return step.coords[self.indices(step.molecule)]
+
+    def chunk_indices(self, chunk):
+        """
+        Returns atom indexes of the selection for all frames of the chunk.
+
+        @return: Array of atom indexes for static selection, list of arrays for each frame for dynamic selection.
+        """
+        if chunk.molecule != self._molecule:
+            self.prepare(chunk.molecule)
+        if not self.dynamic:
+            return self._indices
+        return chunk.memoize((self.selection, 'indices'), self._chunk_indices, chunk)
+
+    def _chunk_indices(self, chunk):
+        # Evaluates dynamic selection in all frames of the chunk
+        result = []
+        for index in xrange(len(chunk)):
+            chunk.update_atomsel(self._atomsel, index)
+            self._update()
+            result.append(self._indices)
+        # Reset the atomsel back to the active frame
+        self._atomsel.frame = NOW
+        return result
+
+    def chunk_centers(self, chunk):
+        """
+        Returns centers of the selection in all frames of the chunk.
+
+        The result is shared with other selections with the same text for the chunk.
+
+        @rtype: numpy array of shape (frames, 3)
+        """
+        return chunk.memoize((self.selection, 'centers'), self._chunk_centers, chunk)
+
+    def _chunk_centers(self, chunk):
+        indices = self.chunk_indices(chunk)
+        if not self.dynamic:
+            return chunk.atom_coords(indices).mean(axis=1)
+        return numpy.array([chunk.frame_coords(index)[atoms].mean(axis=0) for index, atoms in enumerate(indices)])
+
+
+class SelectionGroup(object):
+    """
+    Group of selections whose centers are computed at once.
+
+    Centers of static selections are computed for all selections together, dynamic selections are handled one by one.
+    """
+    def __init__(self, selections):
+        """
+        @param selections: Selection texts
+        @type selections: Sequence of strings
+        """
+        self.selections = [CompiledSelection(selection) for selection in selections]
+        # Indexes of atoms of all selections, start of each selection and number of its atoms
+        self._indices = None
+        self._starts = None
+        self._counts = None
+
+    def __len__(self):
+        return len(self.selections)
+
+    def prepare(self, molecule):
+        """
+        Resolves the selections for the molecule.
+        """
+        for selection in self.selections:
+            selection.prepare(molecule)
+        if any(s.dynamic for s in self.selections):
+            self._indices = None
+        else:
+            indices = [s.indices(molecule) for s in self.selections]
+            self._counts = numpy.array([len(i) for i in indices])
+            self._starts = numpy.concatenate(([0], numpy.cumsum(self._counts)[:-1]))
+            self._indices = numpy.concatenate(indices)
+
+    def centers(self, step):
+        """
+        Returns centers of the selections in the analyzed frame.
+
+        @rtype: numpy array of shape (selections, 3)
+        """
+        if self._indices is None:
+            return numpy.array([s.center(step) for s in self.selections])
+        sums = numpy.add.reduceat(step.coords[self._indices], self._starts, axis=0, dtype=numpy.float64)
+        return sums / self._counts[:, None]
+
+    def chunk_centers(self, chunk):
+        """
+        Returns centers of the selections in all frames of the chunk.
+
+        @rtype: numpy array of shape (frames, selections, 3)
+        """
+        if self._indices is None:
+            return numpy.stack([s.chunk_centers(chunk) for s in self.selections], axis=1)
+        sums = numpy.add.reduceat(chunk.atom_coords(self._indices), self._starts, axis=1, dtype=numpy.float64)
+        return sums / self._counts[:, None]
 
 
 class BaseCoordCollector(Collector):
     """
     Base class for collectors of X, Y and Z coordinates.
     """
+    batch = True
+
     def __init__(self, selection, name=None):
         """
         Creates coordinate collector.
@@ -79,6 +339,10 @@ class BaseCoordCollector(Collector):
         """
         super(BaseCoordCollector, self).__init__(name)
         self.selection = selection
+        self._selection = CompiledSelection(selection)
+
+    def prepare(self, molecule):
+        self._selection.prepare(molecule)
 
 
 class XCoordCollector(BaseCoordCollector):
@@ -86,7 +350,10 @@ class XCoordCollector(BaseCoordCollector):
     Collects X coordinate of atom or center of selection.
     """
     def collect(self, step):
-        return _selection_center(self.selection, step.molecule)[0]
+        return self._selection.center(step)[0]
+
+    def collect_chunk(self, chunk):
+        return self._selection.chunk_centers(chunk)[:, 0]
 
 
 class YCoordCollector(BaseCoordCollector):
@@ -94,7 +361,10 @@ class YCoordCollector(BaseCoordCollector):
     Collects Y coordinate of atom or center of selection.
     """
     def collect(self, step):
-        return _selection_center(self.selection, step.molecule)[1]
+        return self._selection.center(step)[1]
+
+    def collect_chunk(self, chunk):
+        return self._selection.chunk_centers(chunk)[:, 1]
 
 
 class ZCoordCollector(BaseCoordCollector):
@@ -102,14 +372,92 @@ class ZCoordCollector(BaseCoordCollector):
     Collects Z coordinate of atom or center of selection.
     """
     def collect(self, step):
-        return _selection_center(self.selection, step.molecule)[2]
+        return self._selection.center(step)[2]
+
+    def collect_chunk(self, chunk):
+        return self._selection.chunk_centers(chunk)[:, 2]
+
+
+class XYZCollector(BaseCoordCollector):
+    """
+    Collects X, Y and Z coordinates of atom or center of selection in three columns.
+    """
+    columns = ('x', 'y', 'z')
+
+    def collect(self, step):
+        return self._selection.center(step)
+
+    def collect_chunk(self, chunk):
+        return self._selection.chunk_centers(chunk)
+
+
+class MultiXYZCollector(Collector):
+    """
+    Collects X, Y and Z coordinates of atoms or centers of many selections.
+
+    Centers of static selections are computed at once for all selections.
+    """
+    batch = True
+
+    def __init__(self, selections, labels=None, block=False, name=None):
+        """
+        Creates coordinate collector for many selections.
+
+        @param selections: Selection texts for collector.
+        @type selections: Sequence of strings
+        @param labels: Labels of the selections used in column names, indexes of the selections by default.
+        @type labels: Sequence of strings or None
+        @param block: Whether to store the coordinates in a single field of shape (selections * 3, ).
+        @type block: Boolean
+        """
+        assert selections
+        assert labels is None or len(labels) == len(selections)
+        super(MultiXYZCollector, self).__init__(name)
+        self.selections = selections
+        if labels is None:
+            labels = [str(index) for index in xrange(len(selections))]
+        self.labels = labels
+        self.block = block
+        self.columns = ['%s.%s' % (label, dim) for label in labels for dim in ('x', 'y', 'z')]
+        self._group = SelectionGroup(selections)
+
+    def prepare(self, molecule):
+        self._group.prepare(molecule)
+
+    def collect(self, step):
+        return self._group.centers(step).ravel()
+
+    def collect_chunk(self, chunk):
+        return self._group.chunk_centers(chunk).reshape(len(chunk), -1)
+
+
+def _step_unitcell(step):
+    """
+    Returns unit cell of the analyzed frame for periodic collectors.
+    """
+    unitcell = step.unitcell
+    if unitcell is None:
+        raise ValueError("Frame %d doesn't have unit cell." % step.frame)
+    return unitcell
+
+
+def _chunk_unitcells(chunk):
+    """
+    Returns unit cells of the chunk for periodic collectors.
+    """
+    unitcells = chunk.unitcells
+    if unitcells is None:
+        raise ValueError("Frames %d-%d don't have unit cell." % (chunk.frames[0], chunk.frames[-1]))
+    return unitcells
 
 
 class DistanceCollector(Collector):
     """
     Collects distance between two atoms or centers of atoms.
     """
-    def __init__(self, selection1, selection2, name=None):
+    batch = True
+
+    def __init__(self, selection1, selection2, pbc=False, name=None):
         """
         Creates distance collector.
 
@@ -117,22 +465,102 @@ class DistanceCollector(Collector):
         @type selection1: String
         @param selection2: Selection text for collector.
         @type selection2: String
+        @param pbc: Whether to use minimum image convention in the unit cell of the frame.
+        @type pbc: Boolean
         """
         super(DistanceCollector, self).__init__(name)
         self.selection1 = selection1
         self.selection2 = selection2
+        self.pbc = pbc
+        self._selections = (CompiledSelection(selection1), CompiledSelection(selection2))
+
+    def prepare(self, molecule):
+        for selection in self._selections:
+            selection.prepare(molecule)
+
+    def collect(self, step):
+        unitcell = _step_unitcell(step) if self.pbc else None
+        return measure.coords_distance(*[s.center(step) for s in self._selections], unitcell=unitcell)
+
+    def collect_chunk(self, chunk):
+        unitcells = _chunk_unitcells(chunk) if self.pbc else None
+        return measure.coords_distances(*[s.chunk_centers(chunk) for s in self._selections], unitcell=unitcells)
+
+
+class PairDistanceCollector(Collector):
+    """
+    Collects distances between many pairs of atoms or centers of selections.
+
+    Distances are computed at once for all pairs. Centers of selections used in more pairs are computed only once.
+    """
+    batch = True
+
+    def __init__(self, pairs, labels=None, block=False, name=None):
+        """
+        Creates distance collector for many pairs.
+
+        @param pairs: Pairs of atom indexes or pairs of selection texts.
+        @type pairs: Sequence of pairs or numpy array of shape (pairs, 2)
+        @param labels: Labels of the pairs used in column names, indexes of the pairs by default.
+        @type labels: Sequence of strings or None
+        @param block: Whether to store the distances in a single field of shape (pairs, ).
+        @type block: Boolean
+        """
+        assert len(pairs)
+        assert labels is None or len(labels) == len(pairs)
+        super(PairDistanceCollector, self).__init__(name)
+        if labels is None:
+            labels = [str(index) for index in xrange(len(pairs))]
+        self.labels = labels
+        self.block = block
+        self.columns = labels
+        if isinstance(pairs[0][0], basestring):
+            self.pairs = [tuple(pair) for pair in pairs]
+            selections = sorted(set(s for pair in self.pairs for s in pair))
+            positions = dict((s, index) for index, s in enumerate(selections))
+            self._group = SelectionGroup(selections)
+            self._atoms = None
+            # Positions of the selections of the pairs in the group
+            self._first = numpy.array([positions[first] for first, second in self.pairs])
+            self._second = numpy.array([positions[second] for first, second in self.pairs])
+        else:
+            self.pairs = numpy.asarray(pairs, dtype=int)
+            assert self.pairs.ndim == 2 and self.pairs.shape[1] == 2
+            self._group = None
+            # Only coordinates of atoms in pairs are gathered, pairs are stored as positions in `_atoms`
+            self._atoms, positions = numpy.unique(self.pairs, return_inverse=True)
+            positions = positions.reshape(-1, 2)
+            self._first = positions[:, 0]
+            self._second = positions[:, 1]
+
+    def prepare(self, molecule):
+        if self._group is not None:
+            self._group.prepare(molecule)
+        elif self.pairs.min() < 0 or self.pairs.max() >= molecule.numatoms:
+            raise ValueError("Pairs contain atoms which don't exist in '%s'." % molecule)
 
     def collect(self, step):
-        center1 = _selection_center(self.selection1, step.molecule)
-        center2 = _selection_center(self.selection2, step.molecule)
-        return measure.coords_distance(center1, center2)
+        if self._group is None:
+            coords = step.coords[self._atoms]
+        else:
+            coords = self._group.centers(step)
+        return measure.coords_distances(coords[self._first], coords[self._second])
+
+    def collect_chunk(self, chunk):
+        if self._group is None:
+            coords = chunk.atom_coords(self._atoms)
+        else:
+            coords = self._group.chunk_centers(chunk)
+        return measure.coords_distances(coords[:, self._first], coords[:, self._second])
 
 
 class AngleCollector(Collector):
     """
     Collects angle between three atoms or centers of atoms.
     """
-    def __init__(self, selection1, selection2, selection3, name=None):
+    batch = True
+
+    def __init__(self, selection1, selection2, selection3, pbc=False, name=None):
         """
         Creates distance collector.
 
@@ -142,24 +570,37 @@ class AngleCollector(Collector):
         @type selection2: String
         @param selection3: Selection text for collector.
         @type selection3: String
+        @param pbc: Whether to use minimum image convention in the unit cell of the frame.
+        @type pbc: Boolean
         """
         super(AngleCollector, self).__init__(name)
         self.selection1 = selection1
         self.selection2 = selection2
         self.selection3 = selection3
+        self.pbc = pbc
+        self._selections = (CompiledSelection(selection1), CompiledSelection(selection2),
+                            CompiledSelection(selection3))
+
+    def prepare(self, molecule):
+        for selection in self._selections:
+            selection.prepare(molecule)
 
     def collect(self, step):
-        center1 = _selection_center(self.selection1, step.molecule)
-        center2 = _selection_center(self.selection2, step.molecule)
-        center3 = _selection_center(self.selection3, step.molecule)
-        return measure.coords_angle(center1, center2, center3)
+        unitcell = _step_unitcell(step) if self.pbc else None
+        return measure.coords_angle(*[s.center(step) for s in self._selections], unitcell=unitcell)
+
+    def collect_chunk(self, chunk):
+        unitcells = _chunk_unitcells(chunk) if self.pbc else None
+        return measure.coords_angles(*[s.chunk_centers(chunk) for s in self._selections], unitcell=unitcells)
 
 
 class DihedralCollector(Collector):
     """
     Collects dihedral angle of four atoms or centers of atoms.
     """
-    def __init__(self, selection1, selection2, selection3, selection4, name=None):
+    batch = True
+
+    def __init__(self, selection1, selection2, selection3, selection4, pbc=False, name=None):
         """
         Creates distance collector.
 
@@ -171,60 +612,417 @@ class DihedralCollector(Collector):
         @type selection3: String
         @param selection4: Selection text for collector.
         @type selection4: String
+        @param pbc: Whether to use minimum image convention in the unit cell of the frame.
+        @type pbc: Boolean
         """
         super(DihedralCollector, self).__init__(name)
         self.selection1 = selection1
         self.selection2 = selection2
         self.selection3 = selection3
         self.selection4 = selection4
+        self.pbc = pbc
+        self._selections = (CompiledSelection(selection1), CompiledSelection(selection2),
+                            CompiledSelection(selection3), CompiledSelection(selection4))
+
+    def prepare(self, molecule):
+        for selection in self._selections:
+            selection.prepare(molecule)
 
     def collect(self, step):
-        center1 = _selection_center(self.selection1, step.molecule)
-        center2 = _selection_center(self.selection2, step.molecule)
-        center3 = _selection_center(self.selection3, step.molecule)
-        center4 = _selection_center(self.selection4, step.molecule)
-        return measure.coords_dihedral(center1, center2, center3, center4)
+        unitcell = _step_unitcell(step) if self.pbc else None
+        return measure.coords_dihedral(*[s.center(step) for s in self._selections], unitcell=unitcell)
+
+    def collect_chunk(self, chunk):
+        unitcells = _chunk_unitcells(chunk) if self.pbc else None
+        return measure.coords_dihedrals(*[s.chunk_centers(chunk) for s in self._selections], unitcell=unitcells)
+
+
+# Atoms of backbone torsions. Atoms of the previous and the next residue are prefixed by '-' and '+'.
+BACKBONE_TORSIONS = (
+    ('phi', ('-C', 'N', 'CA', 'C')),
+    ('psi', ('N', 'CA', 'C', '+N')),
+)
+# Atoms of side chain torsions chi1 and chi2 for residue names. Alternative atom names are separated by '|'.
+_HIS_TORSIONS = (('N', 'CA', 'CB', 'CG'), ('CA', 'CB', 'CG', 'ND1'))
+SIDECHAIN_TORSIONS = {
+    'ARG': (('N', 'CA', 'CB', 'CG'), ('CA', 'CB', 'CG', 'CD')),
+    'ASN': (('N', 'CA', 'CB', 'CG'), ('CA', 'CB', 'CG', 'OD1')),
+    'ASP': (('N', 'CA', 'CB', 'CG'), ('CA', 'CB', 'CG', 'OD1')),
+    'CYS': (('N', 'CA', 'CB', 'SG'), ),
+    'GLN': (('N', 'CA', 'CB', 'CG'), ('CA', 'CB', 'CG', 'CD')),
+    'GLU': (('N', 'CA', 'CB', 'CG'), ('CA', 'CB', 'CG', 'CD')),
+    'HIS': _HIS_TORSIONS,
+    'HSD': _HIS_TORSIONS,
+    'HSE': _HIS_TORSIONS,
+    'HSP': _HIS_TORSIONS,
+    'ILE': (('N', 'CA', 'CB', 'CG1'), ('CA', 'CB', 'CG1', 'CD1|CD')),
+    'LEU': (('N', 'CA', 'CB', 'CG'), ('CA', 'CB', 'CG', 'CD1')),
+    'LYS': (('N', 'CA', 'CB', 'CG'), ('CA', 'CB', 'CG', 'CD')),
+    'MET': (('N', 'CA', 'CB', 'CG'), ('CA', 'CB', 'CG', 'SD')),
+    'PHE': (('N', 'CA', 'CB', 'CG'), ('CA', 'CB', 'CG', 'CD1')),
+    'PRO': (('N', 'CA', 'CB', 'CG'), ('CA', 'CB', 'CG', 'CD')),
+    'SER': (('N', 'CA', 'CB', 'OG'), ),
+    'THR': (('N', 'CA', 'CB', 'OG1'), ),
+    'TRP': (('N', 'CA', 'CB', 'CG'), ('CA', 'CB', 'CG', 'CD1')),
+    'TYR': (('N', 'CA', 'CB', 'CG'), ('CA', 'CB', 'CG', 'CD1')),
+    'VAL': (('N', 'CA', 'CB', 'CG1'), ),
+}
+# Names of side chain torsions
+SIDECHAIN_NAMES = ('chi1', 'chi2')
+
+
+class TorsionCollector(Collector):
+    """
+    Collects backbone and optionally side chain torsions of all residues in the selection.
+
+    The torsions are found from names of atoms and residues when the analysis starts. Residues are connected if they
+    follow each other and belong to the same segment and chain. Torsions are computed at once for all residues.
+    Data are laid out by residues, columns are named '<residue>.<torsion>', e.g. 'ALA12.phi'. Residues are prefixed by
+    segment if the selection contains several segments and by chain if some segment contains several chains, e.g.
+    'PROA:B:ALA12.phi'. Torsions which don't exist in the residue, e.g. phi of the first residue, are NaN.
+    """
+    batch = True
+
+    def __init__(self, selection='protein', sidechain=False, block=False, name=None):
+        """
+        Creates torsion collector.
+
+        @param selection: Selection text of the residues
+        @type selection: String
+        @param sidechain: Whether to collect side chain torsions chi1 and chi2
+        @type sidechain: Boolean
+        @param block: Whether to store the torsions in a single field of shape (residues * torsions, ).
+        @type block: Boolean
+        """
+        super(TorsionCollector, self).__init__(name)
+        self.selection = selection
+        self.sidechain = sidechain
+        self.block = block
+        self.torsions = [t for t, atoms in BACKBONE_TORSIONS]
+        if sidechain:
+            self.torsions.extend(SIDECHAIN_NAMES)
+        # Columns are known once the topology is resolved
+        self.columns = []
+        self.columns_deferred = True
+        # Atom indexes of the torsions and their positions in the output
+        self._atoms = None
+        self._quadruplets = None
+        self._positions = None
+
+    def prepare(self, molecule):
+        sel = Selection(self.selection, molecule).atomsel
+        atoms = zip(sel, sel.get('name'), sel.get('residue'), sel.get('resid'), sel.get('resname'),
+                    sel.get('segname'), sel.get('chain'))
+        # Map residues to their atoms by names
+        residues = []
+        for index, atom_name, residue, resid, resname, segname, chain in atoms:
+            if not residues or residues[-1][0] != residue:
+                residues.append((residue, resid, resname, (segname, chain), {}))
+            residues[-1][4][atom_name] = index
+        if not residues:
+            raise ValueError("Selection '%s' doesn't match any atoms." % self.selection)
+
+        groups = set(r[3] for r in residues)
+        segments = set(segname for segname, chain in groups)
+        labels = []
+        quadruplets = []
+        positions = []
+        for position, (residue, resid, resname, group, names) in enumerate(residues):
+            label = '%s%d' % (resname, resid)
+            if len(groups) > len(segments):
+                label = '%s:%s' % (group[1], label)
+            if len(segments) > 1:
+                label = '%s:%s' % (group[0], label)
+            labels.append(label)
+            neighbors = {'': names}
+            if position and residues[position - 1][0] == residue - 1 and residues[position - 1][3] == group:
+                neighbors['-'] = residues[position - 1][4]
+            if position + 1 < len(residues) and residues[position + 1][0] == residue + 1 and \
+                    residues[position + 1][3] == group:
+                neighbors['+'] = residues[position + 1][4]
+
+            specs = [atoms for t, atoms in BACKBONE_TORSIONS]
+            if self.sidechain:
+                sidechain = SIDECHAIN_TORSIONS.get(resname, ())
+                specs.extend(sidechain[i] if i < len(sidechain) else None for i in xrange(len(SIDECHAIN_NAMES)))
+            for torsion, spec in enumerate(specs):
+                quadruplet = spec and self._resolve(spec, neighbors)
+                if quadruplet:
+                    quadruplets.append(quadruplet)
+                    positions.append(position * len(self.torsions) + torsion)
+
+        duplicates = sorted(set(label for label in labels if labels.count(label) > 1))
+        if duplicates:
+            raise ValueError("Selection '%s' contains several residues labeled %s." % (self.selection,
+                                                                                       ', '.join(duplicates)))
+        self.columns = ['%s.%s' % (label, torsion) for label in labels for torsion in self.torsions]
+        self.columns_deferred = False
+        # Only coordinates of atoms in torsions are gathered, quadruplets are stored as positions in `_atoms`
+        self._atoms, atom_positions = numpy.unique(numpy.array(quadruplets, dtype=int), return_inverse=True)
+        self._quadruplets = atom_positions.reshape(-1, 4)
+        self._positions = numpy.array(positions, dtype=int)
+        LOGGER.debug("Found %d torsions in %d residues of '%s'", len(quadruplets), len(residues), self.selection)
+
+    @staticmethod
+    def _resolve(spec, neighbors):
+        """
+        Returns atom indexes of the torsion or `None` if some atom doesn't exist.
+        """
+        result = []
+        for atom_name in spec:
+            prefix = atom_name[0] in '-+' and atom_name[0] or ''
+            names = neighbors.get(prefix)
+            if names is None:
+                return None
+            for alternative in atom_name[len(prefix):].split('|'):
+                if alternative in names:
+                    result.append(names[alternative])
+                    break
+            else:
+                return None
+        return result
+
+    def _compute(self, coords):
+        # Computes torsions from coordinates of torsion atoms of shape (..., atoms, 3) and places them in the output
+        quadruplets = self._quadruplets
+        torsions = measure.coords_dihedrals(*[coords[..., quadruplets[:, i], :] for i in xrange(4)])
+        result = numpy.full(coords.shape[:-2] + (len(self.columns), ), numpy.nan)
+        result[..., self._positions] = torsions
+        return result
+
+    def collect(self, step):
+        if self._quadruplets is None:
+            self.prepare(step.molecule)
+        return self._compute(step.coords[self._atoms])
+
+    def collect_chunk(self, chunk):
+        if self._quadruplets is None:
+            self.prepare(chunk.molecule)
+        return self._compute(chunk.atom_coords(self._atoms))
+
+
+class GyrationCollector(Collector):
+    """
+    Collects mass weighted radius of gyration, principal moments of gyration tensor and asphericity.
+
+    Principal moments are sorted in ascending order, asphericity is computed as m3 - (m1 + m2) / 2.
+    """
+    batch = True
+    columns = ('rg', 'moment1', 'moment2', 'moment3', 'asphericity')
+
+    def __init__(self, selection, name=None):
+        """
+        Creates gyration collector.
+
+        @param selection: Selection text for collector.
+        @type selection: String
+        """
+        super(GyrationCollector, self).__init__(name)
+        self.selection = selection
+        self._selection = CompiledSelection(selection)
+        # Masses of all atoms in the molecule
+        self._masses = None
+
+    def prepare(self, molecule):
+        self._selection.prepare(molecule)
+        self._masses = numpy.array(Selection('all', molecule).atomsel.get('mass'), dtype=float)
+
+    @staticmethod
+    def _compute(moments):
+        # Returns collected data from principal moments
+        result = numpy.empty(moments.shape[:-1] + (5, ))
+        result[..., 0] = numpy.sqrt(moments.sum(axis=-1))
+        result[..., 1:4] = moments
+        result[..., 4] = moments[..., 2] - (moments[..., 0] + moments[..., 1]) / 2
+        return result
+
+    def collect(self, step):
+        if self._masses is None:
+            self.prepare(step.molecule)
+        indices = self._selection.indices(step.molecule)
+        return self._compute(measure.coords_gyration(step.coords[indices], self._masses[indices]))
+
+    def collect_chunk(self, chunk):
+        if self._masses is None:
+            self.prepare(chunk.molecule)
+        indices = self._selection.chunk_indices(chunk)
+        if not self._selection.dynamic:
+            moments = measure.coords_gyration(chunk.atom_coords(indices), self._masses[indices])
+        else:
+            moments = numpy.array([measure.coords_gyration(chunk.frame_coords(index)[atoms], self._masses[atoms])
+                                   for index, atoms in enumerate(indices)]).reshape(-1, 3)
+        return self._compute(moments)
 
 
 class RMSDCollector(Collector):
     """
     Collects RMSD data.
+
+    The selection is fitted to the reference using Kabsch algorithm, the molecule is not modified.
     """
+    batch = True
+
     def __init__(self, selection, reference, name=None):
         """
         Creates RMSD collector.
 
         @param selection: Selection text for RMSD
         @type selection: String
-        @param reference: Reference for RMSD
+        @param reference: Reference for RMSD. Its coordinates are taken when the analysis starts.
         @type reference: Selection
         """
         assert isinstance(reference, Selection)
         super(RMSDCollector, self).__init__(name)
         self.selection = selection
         self.reference = reference
+        self._selection = CompiledSelection(selection)
+        # Centered coordinates of the reference
+        self._reference = None
+
+    def prepare(self, molecule):
+        self._selection.prepare(molecule)
+        ref = self.reference.atomsel
+        coords = numpy.array([ref.get('x'), ref.get('y'), ref.get('z')]).T
+        self._reference = coords - coords.mean(axis=0)
 
     def collect(self, step):
-        # Active frame number of the molecule.
-        cur_frame = step.molecule.frame
-        # Duplicate the trajectory frame because we will modify the coordinates.
-        # This also sets the molecule frame to the duplicated frame.
-        step.molecule.frames.copy()
-        # Duplicated frame number
-        dup_frame = step.molecule.frame
+        if self._reference is None:
+            self.prepare(step.molecule)
+        return measure.coords_fit_rmsd(self._selection.coords(step), self._reference)
 
-        all_atoms = Selection('all', step.molecule)
-        sel = Selection(self.selection, step.molecule)
+    def collect_chunk(self, chunk):
+        if self._reference is None:
+            self.prepare(chunk.molecule)
+        indices = self._selection.chunk_indices(chunk)
+        if not self._selection.dynamic:
+            return measure.coords_fit_rmsd(chunk.atom_coords(indices), self._reference)
+        return numpy.array([measure.coords_fit_rmsd(chunk.frame_coords(index)[atoms], self._reference)
+                            for index, atoms in enumerate(indices)])
 
-        # Align coordinates to the reference
-        all_atoms.atomsel.move(sel.atomsel.fit(self.reference.atomsel))
 
-        # Measure RMSD
-        rmsd = sel.atomsel.rmsd(self.reference.atomsel)
+class RMSFCollector(Collector):
+    """
+    Collects RMSF - root mean square fluctuation of atoms.
 
-        # Delete the duplicated frame and reset trajectory frame
-        del step.molecule.frames[dup_frame]
-        step.molecule.frame = cur_frame
+    Mean positions of atoms and their variances are accumulated by Welford's online algorithm, so the memory used
+    doesn't depend on the length of the trajectory. The collector doesn't add any columns to the dataset, the results
+    are available in `rmsf` and `table` once the analysis is finished.
+    Frames can be fitted to the reference using Kabsch algorithm prior to the accumulation, the molecule is not
+    modified.
 
-        # Return the RMSD value
-        return rmsd
+    @ivar count: Number of accumulated frames
+    @ivar mean: Mean positions of the atoms
+    """
+    batch = True
+    columns = ()
+
+    def __init__(self, selection, reference=None, name=None):
+        """
+        Creates RMSF collector.
+
+        @param selection: Selection text for RMSF
+        @type selection: String
+        @param reference: Reference for the fit. Its coordinates are taken when the analysis starts.
+        @type reference: Selection or None
+        """
+        assert reference is None or isinstance(reference, Selection)
+        super(RMSFCollector, self).__init__(name)
+        self.selection = selection
+        self.reference = reference
+        self._selection = CompiledSelection(selection)
+        # Centered coordinates of the reference
+        self._reference = None
+        # Atoms of the selection - indexes, residue numbers, residue names and names
+        self._atoms = None
+        self.count = 0
+        self.mean = None
+        # Sums of squared deviations from the mean
+        self._m2 = None
+
+    def prepare(self, molecule):
+        self._selection.prepare(molecule)
+        if self._selection.dynamic:
+            raise ValueError("RMSF can't be computed for selection '%s' which depends on coordinates." %
+                             self.selection)
+        atomsel = self._selection.atomsel(molecule)
+        self._atoms = (self._selection.indices(molecule), atomsel.get('resid'), atomsel.get('resname'),
+                       atomsel.get('name'))
+        if self.reference is not None:
+            ref = self.reference.atomsel
+            coords = numpy.array([ref.get('x'), ref.get('y'), ref.get('z')]).T
+            if len(coords) != len(atomsel):
+                raise ValueError("Reference doesn't match selection '%s'." % self.selection)
+            self._reference = coords - coords.mean(axis=0)
+        self.count = 0
+        self.mean = numpy.zeros((len(atomsel), 3))
+        self._m2 = numpy.zeros(len(atomsel))
+
+    def _merge(self, count, mean, m2):
+        """
+        Merges the accumulated data with data from other frames.
+        """
+        if not count:
+            return
+        total = self.count + count
+        delta = mean - self.mean
+        self.mean += delta * (float(count) / total)
+        self._m2 += m2 + (delta ** 2).sum(axis=1) * (float(self.count) * count / total)
+        self.count = total
+
+    def _accumulate(self, coords):
+        """
+        Accumulates coordinates of the selection in frames.
+
+        @type coords: numpy array of shape (frames, atoms, 3)
+        """
+        if self.reference is not None:
+            coords = measure.coords_fit(coords, self._reference)
+        else:
+            coords = numpy.asarray(coords, dtype=float)
+        mean = coords.mean(axis=0)
+        self._merge(len(coords), mean, ((coords - mean) ** 2).sum(axis=(0, 2)))
+
+    def collect(self, step):
+        self._accumulate(self._selection.coords(step)[None])
+
+    def collect_chunk(self, chunk):
+        if len(chunk):
+            self._accumulate(chunk.atom_coords(self._selection.chunk_indices(chunk)))
+
+    def get_state(self):
+        return {'count': self.count, 'mean': self.mean.copy(), 'm2': self._m2.copy()}
+
+    def set_state(self, state):
+        self.count = state['count']
+        self.mean = state['mean'].copy()
+        self._m2 = state['m2'].copy()
+
+    def merge_state(self, state):
+        self._merge(state['count'], state['mean'], state['m2'])
+
+    @property
+    def rmsf(self):
+        """
+        Returns RMSF of the atoms or `None` if no frames were accumulated.
+
+        @rtype: numpy array of shape (atoms, )
+        """
+        if not self.count:
+            return None
+        return numpy.sqrt(self._m2 / self.count)
+
+    @property
+    def table(self):
+        """
+        Returns table with RMSF of the atoms or `None` if no frames were accumulated.
+
+        @return: Structured array with fields 'index', 'resid', 'resname', 'name' and 'rmsf'
+        """
+        if not self.count:
+            return None
+        table = numpy.empty(len(self.mean), dtype=[('index', int), ('resid', int), ('resname', 'S8'), ('name', 'S8'),
+                                                   ('rmsf', float)])
+        for field, values in zip(('index', 'resid', 'resname', 'name'), self._atoms):
+            table[field] = values
+        table['rmsf'] = self.rmsf
+        return table
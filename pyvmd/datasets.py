@@ -2,100 +2,563 @@
 Data sets to collect and store data from trajectory analysis.
 """
 import logging
+import os
+import struct
+import time
+import zipfile
+from collections import OrderedDict
+from io import BytesIO
 
 import numpy
+from numpy.lib.format import dtype_to_descr, MAGIC_PREFIX, read_array_header_1_0, read_array_header_2_0, read_magic, \
+    write_array
 
 from .collectors import Collector, FrameCollector
 
-__all__ = ['DataSet']
+__all__ = ['DataSet', 'FORMAT_COLUMNS', 'FORMAT_NPY', 'FORMAT_NPZ', 'FORMAT_TEXT', 'StreamDataSet', 'load_data']
 
 LOGGER = logging.getLogger(__name__)
 
+# Output formats
+# Text columns
+FORMAT_TEXT = 'text'
+# NPY file with structured array with a field for each column
+FORMAT_NPY = 'npy'
+# Compressed NPZ file with array for each column
+FORMAT_NPZ = 'npz'
+# Uncompressed NPZ file with array for each column, columns can be memory mapped
+FORMAT_COLUMNS = 'columns'
+FORMATS = (FORMAT_TEXT, FORMAT_NPY, FORMAT_NPZ, FORMAT_COLUMNS)
+
+# Magic string of NPY file format version 1.0
+NPY_MAGIC = MAGIC_PREFIX + '\x01\x00'
+# Magic string of NPY file format version 2.0, which allows headers longer than 64 kB
+NPY_MAGIC_2 = MAGIC_PREFIX + '\x02\x00'
+# Alignment of data in NPY file
+NPY_ALIGN = 64
+
 
 class DataSet(object):
     """
     Basic data set. Collects and stores data extracted from trajectory.
     """
-    # Number of rows added when increasing size of data array
+    # Initial number of rows of data array
     step = 1000
+    # Factor by which the data array is enlarged when it is full
+    growth = 2
 
     def __init__(self):
-        # Array with data
+        # Structured array with data, it contains a field for each collector.
         self._data = None
         # List of collectors
         self.collectors = []
+        # Data type of the rows
+        self._dtype = None
         # Number of rows filled with data
         self._rows = 0
+        # Rows of the current chunk with data from batch collectors, which wait for data from other collectors
+        self._chunk = None
+        # Number of rows of the current chunk filled with data
+        self._chunk_rows = 0
+        # Cached 2D array of floats returned by `data`
+        self._data_array = None
 
         # Register the frame collector
         self.add_collector(FrameCollector('frame'))
 
     @property
-    def data(self):
+    def dtype(self):
+        """
+        Returns data type of the rows. It contains a field for each column of each collector or a single field of shape
+        (columns, ) for collectors which store the columns in a block, see `Collector.fields`.
+
+        @raise ValueError: If columns of some collector are not known until it's prepared for the molecule.
+        """
+        if self._dtype is None:
+            fields = []
+            for collector in self.collectors:
+                if collector.columns_deferred:
+                    raise ValueError("Columns of collector '%s' are not known until the analysis starts." %
+                                     collector.name)
+                if collector.block:
+                    fields.append((collector.name, collector.dtype, (len(collector.columns), )))
+                else:
+                    fields.extend((f, collector.dtype) for f in collector.fields)
+            self._dtype = numpy.dtype(fields)
+        return self._dtype
+
+    @property
+    def records(self):
         """
-        Returns collected data.
+        Returns collected data as structured array with data type of each collector.
         """
+        if self._data is None:
+            return numpy.empty(0, dtype=self.dtype)
         # Return only the collected data, not the pre-allocated space.
         return self._data[:self._rows]
 
+    @property
+    def data(self):
+        """
+        Returns collected data as 2D array with a column for each column of each collector.
+
+        If all collectors have the same data type and none of them stores its columns in a block, the array is a view
+        of `records` with that data type. Otherwise the data are copied into array of floats, which is read-only and
+        it's cached until new rows or collectors are added. Use `records` to access the data without a copy.
+        """
+        dtypes = set(numpy.dtype(c.dtype) for c in self.collectors)
+        if len(dtypes) == 1 and not any(c.block for c in self.collectors):
+            records = self.records
+            return records.view(dtypes.pop()).reshape(len(records), len(records.dtype.names))
+        if self._data_array is None:
+            records = self._columns(self.records)
+            data = numpy.empty((len(records), len(records.dtype.names)))
+            for index, name in enumerate(records.dtype.names):
+                data[:, index] = records[name]
+            data.flags.writeable = False
+            self._data_array = data
+        return self._data_array
+
     def add_collector(self, collector):
         """
         Registers collector into this dataset.
+
+        @raise ValueError: If the name of the collector or some of its columns is already used in the dataset. They
+                           are used as field names of `records`, so they have to be unique.
         """
         assert isinstance(collector, Collector)
+        if collector.name in (c.name for c in self.collectors):
+            raise ValueError("Dataset already contains collector named '%s'." % collector.name)
+        names = set(n for c in self.collectors for n in c.column_names + c.fields)
+        names = names.intersection(collector.column_names + collector.fields)
+        if names:
+            raise ValueError("Dataset already contains columns named %s." % ', '.join(sorted(names)))
         self.collectors.append(collector)
+        self._dtype = None
+        self._data_array = None
         LOGGER.debug("Added collector '%s' to dataset '%s'", collector.name, self)
 
+    def prepare(self, molecule):
+        """
+        Prepares collectors for the analysis of the molecule. Called by Analyzer when the analysis starts.
+        """
+        for collector in self.collectors:
+            collector.prepare(molecule)
+        # Columns of some collectors depend on the molecule
+        self._dtype = None
+        self._data_array = None
+
     def collect(self, step):
         """
         Retrieves data from collectors and store them. Callback for Analyzer.
+
+        If the chunk is being collected, only collectors which do not support batches are called.
+        """
+        if self._chunk is None:
+            # Store the data directly into the data array
+            self._grow(self._rows + 1)
+            row = self._data[self._rows:self._rows + 1]
+            for collector in self.collectors:
+                self._store(row, collector, collector.collect(step))
+            self._rows += 1
+            self._rows_added()
+            return
+
+        row = self._chunk[self._chunk_rows:self._chunk_rows + 1]
+        for collector in self.collectors:
+            if not collector.batch:
+                self._store(row, collector, collector.collect(step))
+        self._chunk_rows += 1
+        if self._chunk_rows == len(self._chunk):
+            # The chunk is complete
+            self._add_rows(self._chunk)
+            self._chunk = None
+
+    def collect_chunk(self, chunk):
+        """
+        Retrieves data for the whole chunk from collectors which support batches. Chunk callback for Analyzer.
+
+        Data from other collectors are retrieved by `collect`, which has to be called for each frame of the chunk.
+        The rows are stored once the data for the last frame of the chunk are collected.
+        """
+        if not len(chunk):
+            return
+        rows = numpy.empty(len(chunk), dtype=self.dtype)
+        for collector in self.collectors:
+            if collector.batch:
+                self._store(rows, collector, collector.collect_chunk(chunk))
+        self._chunk = rows
+        self._chunk_rows = 0
+
+    def flush(self):
+        """
+        Writes the collected data into the output of the dataset, if it has any. Called by Analyzer when the analysis
+        finishes.
         """
-        row = [collector.collect(step) for collector in self.collectors]
-        self._add_row(row)
+        pass
 
-    def _add_row(self, row):
+    def get_state(self):
         """
-        Stores new row with data.
+        Returns state of the dataset and its collectors, which can be pickled. Used for checkpoints of the analysis.
         """
-        num_columns = len(self.collectors)
-        num_rows = self._rows + 1
+        return {'records': self.records.copy(), 'collectors': [c.get_state() for c in self.collectors]}
 
-        # Create array if it doesn't exist
+    def set_state(self, state):
+        """
+        Restores the state of the dataset and its collectors.
+        """
+        if state['records'].dtype != self.dtype:
+            raise ValueError("State doesn't match collectors of the dataset.")
+        self._data = None
+        self._rows = 0
+        self._chunk = None
+        self._data_array = None
+        if len(state['records']):
+            self._add_rows(state['records'])
+        for collector, collector_state in zip(self.collectors, state['collectors']):
+            collector.set_state(collector_state)
+
+    def _store(self, rows, collector, values):
+        """
+        Stores data from the collector into its fields of the rows.
+
+        @param rows: Structured array with data type of the dataset
+        @param values: Data returned by the collector
+        """
+        if collector.columns is None or collector.block:
+            rows[collector.name] = values
+        else:
+            values = numpy.asarray(values)
+            for index, field in enumerate(collector.fields):
+                rows[field] = values[..., index]
+
+    def reserve(self, rows):
+        """
+        Allocates space for the expected number of new rows, so the data array doesn't have to be enlarged.
+
+        @param rows: Number of rows expected to be added
+        @type rows: Non-negative integer
+        """
+        assert rows >= 0
+        num_rows = self._rows + rows
+        if self._data is None or num_rows > len(self._data):
+            self._resize(max(num_rows, 1))
+
+    def _resize(self, size):
+        """
+        Changes number of rows of the data array and copies the stored data.
+        """
         if self._data is None:
-            shape = (self.step, num_columns)
-            LOGGER.debug("Creating array %s", shape)
-            self._data = numpy.empty(shape)
-        # Check if the array is large enough. If not, enlarge
-        # Get number of rows in data array
-        data_rows = self._data.shape[0]
-        if num_rows > data_rows:
-            # The existing array is not big enough. Create new larger one and copy data.
-            shape = (data_rows + self.step, num_columns)
-            LOGGER.debug("Enlarging array %s to %s", self._data.shape, shape)
-            new_data = numpy.empty(shape)
-            new_data[:data_rows] = self._data
+            LOGGER.debug("Creating array of %d rows", size)
+            self._data = numpy.empty(size, dtype=self.dtype)
+        else:
+            LOGGER.debug("Enlarging array of %d rows to %d rows", len(self._data), size)
+            new_data = numpy.empty(size, dtype=self.dtype)
+            new_data[:self._rows] = self._data[:self._rows]
             self._data = new_data
 
-        # Store the new data
-        self._data[self._rows] = row  # Since arrays use 0-based index, row number equals the old number of rows.
+    def _grow(self, num_rows):
+        """
+        Enlarges the data array, if it's not large enough for the number of rows.
+
+        The array is enlarged geometrically, so the data are copied only logarithmic number of times.
+        """
+        if self._data is None:
+            self._resize(max(self.step, num_rows))
+        elif num_rows > len(self._data):
+            self._resize(max(len(self._data) * self.growth, num_rows))
+
+    def _add_rows(self, rows):
+        """
+        Stores new rows with data.
+
+        @param rows: Structured array with data type of the dataset, see `dtype`.
+        """
+        assert rows.dtype == self.dtype
+        num_rows = self._rows + len(rows)
+        self._grow(num_rows)
+        # Store the new data. Since arrays use 0-based index, first new row number equals the old number of rows.
+        self._data[self._rows:num_rows] = rows
         self._rows = num_rows
+        self._rows_added()
+
+    def _rows_added(self):
+        """
+        Called when new rows are stored.
+        """
+        self._data_array = None
+
+    def _columns(self, records):
+        """
+        Returns view of the records with a field for each column, i.e. the blocks are split into columns.
+        """
+        if not any(c.block for c in self.collectors):
+            return records
+        names = []
+        formats = []
+        offsets = []
+        for collector in self.collectors:
+            for field in collector.fields:
+                base, offset = records.dtype.fields[field][:2]
+                if collector.block:
+                    names.extend(collector.column_names)
+                    formats.extend([base.base] * len(collector.columns))
+                    offsets.extend(offset + index * base.base.itemsize for index in xrange(len(collector.columns)))
+                else:
+                    names.append(field)
+                    formats.append(base)
+                    offsets.append(offset)
+        dtype = numpy.dtype({'names': names, 'formats': formats, 'offsets': offsets,
+                             'itemsize': records.dtype.itemsize})
+        return records.view(dtype)
+
+    def _write_header(self, out):
+        """
+        Writes header of text output.
+        """
+        names = [n for c in self.collectors for n in c.column_names]
+        header_fmt = ' '.join([c.header_fmt for c in self.collectors for n in c.column_names])
+        out.write(header_fmt % tuple(names))
+        out.write('\n')
+
+    def _write_rows(self, out, rows):
+        """
+        Writes rows into text output.
+        """
+        formats = [c.data_fmt for c in self.collectors for n in c.column_names]
+        numpy.savetxt(out, self._columns(rows), formats)
 
-    def write(self, output):
+    def write(self, output, fmt=FORMAT_TEXT):
         """
         Writes data into output.
 
+        Every format contains a column for each column of each collector, i.e. the blocks are split into columns.
+
         @param output: Filename or file-like object
+        @param fmt: Format of the output, see `load_data` for loading binary formats.
         """
+        assert fmt in FORMATS
         if isinstance(output, basestring):
-            out = open(output, 'w')
+            with open(output, fmt == FORMAT_TEXT and 'w' or 'wb') as out:
+                self.write(out, fmt)
+            return
+
+        if fmt == FORMAT_TEXT:
+            self._write_header(output)
+            self._write_rows(output, self.records)
+        elif fmt == FORMAT_NPY:
+            write_array(output, self._columns(self.records))
         else:
-            out = output
+            compression = fmt == FORMAT_NPZ and zipfile.ZIP_DEFLATED or zipfile.ZIP_STORED
+            columns = self._columns(self.records)
+            with zipfile.ZipFile(output, 'w', compression, allowZip64=True) as archive:
+                for name in columns.dtype.names:
+                    buf = BytesIO()
+                    write_array(buf, numpy.ascontiguousarray(columns[name]))
+                    archive.writestr(name + '.npy', buf.getvalue())
 
-        # Write header
-        header_fmt = ' '.join([c.header_fmt for c in self.collectors])
-        out.write(header_fmt % tuple(c.name for c in self.collectors))
-        out.write('\n')
 
-        # Write data
-        formats = [c.data_fmt for c in self.collectors]
-        numpy.savetxt(out, self.data, formats)
+def _npy_header(dtype, rows):
+    """
+    Returns header of NPY file.
+
+    Header has always the same length for the data type, so it can be rewritten when more rows are added.
+    Version 2.0 of the format is used only if the header doesn't fit into version 1.0, e.g. for data types with many
+    fields.
+    """
+    header = "{'descr': %r, 'fortran_order': False, 'shape': (%20d,), }" % (dtype_to_descr(dtype), rows)
+    for magic, length_fmt in ((NPY_MAGIC, '<H'), (NPY_MAGIC_2, '<I')):
+        # Align the data, the header ends with a newline.
+        size = len(magic) + struct.calcsize(length_fmt) + len(header) + 1
+        padded = header + ' ' * (-size % NPY_ALIGN) + '\n'
+        if len(padded) < 2 ** (8 * struct.calcsize(length_fmt)):
+            return magic + struct.pack(length_fmt, len(padded)) + padded
+    raise ValueError("Data type is too large for NPY header.")
+
+
+class StreamDataSet(DataSet):
+    """
+    Data set which continuously writes the collected data into output.
+
+    Rows are kept in memory only until they are flushed into the output, so the memory footprint doesn't depend on the
+    length of the trajectory. Property `data` contains only rows which were not flushed yet.
+
+    Supported output formats are
+     * `FORMAT_TEXT` - text columns as written by `DataSet.write`.
+     * `FORMAT_NPY` - binary NPY file with the structured array of `records`, blocks are split into columns. Header
+       of the file is updated on every flush, so the file can be loaded by `numpy.load` at any time.
+    """
+    def __init__(self, output, fmt=FORMAT_TEXT, flush_rows=1000, flush_time=None):
+        """
+        @param output: Filename or file-like object. `FORMAT_NPY` and restoring the state require output which can
+                       seek. The file is created when the first data are written.
+        @param fmt: Format of the output
+        @param flush_rows: Flush the data when this number of rows is collected.
+        @type flush_rows: Positive integer
+        @param flush_time: Flush the data when this number of seconds elapsed since the last flush.
+        @type flush_time: Positive number or None
+        """
+        assert fmt in (FORMAT_TEXT, FORMAT_NPY)
+        assert flush_rows > 0
+        assert flush_time is None or flush_time > 0
+        super(StreamDataSet, self).__init__()
+        self.fmt = fmt
+        self.flush_rows = flush_rows
+        self.flush_time = flush_time
+        self.step = min(self.step, flush_rows)
+        if isinstance(output, basestring):
+            # The file is opened when the data are written, so the data aren't lost if the analysis is resumed.
+            self._filename = output
+            self._out = None
+        else:
+            self._filename = None
+            self._out = output
+        # Number of rows written into output, `None` until the header is written.
+        self._written = None
+        self._flushed_at = time.time()
+        # Only the process which created the dataset writes the output.
+        # Worker processes of ParallelAnalyzer keep their rows, they are written when merged in the main process.
+        self._pid = os.getpid()
+
+    def _open(self, mode):
+        """
+        Opens the output file.
+        """
+        self._out = open(self._filename, mode + (self.fmt == FORMAT_NPY and 'b' or ''))
+
+    def get_state(self):
+        # Flush the rows, the state contains only the position in the output.
+        self.flush()
+        state = super(StreamDataSet, self).get_state()
+        state['written'] = self._written
+        state['position'] = self._out.tell()
+        return state
+
+    def set_state(self, state):
+        # Drop anything written after the state was saved
+        if self._out is None:
+            self._open('r+')
+        self._out.seek(state['position'])
+        self._out.truncate()
+        self._written = state['written']
+        super(StreamDataSet, self).set_state(state)
+
+    def reserve(self, rows):
+        # Only rows between flushes are kept in memory
+        super(StreamDataSet, self).reserve(min(rows, self.flush_rows))
+
+    def _rows_added(self):
+        super(StreamDataSet, self)._rows_added()
+        if self._rows >= self.flush_rows or \
+                (self.flush_time is not None and time.time() - self._flushed_at >= self.flush_time):
+            self.flush()
+
+    def flush(self):
+        """
+        Writes the collected rows into the output.
+        """
+        if os.getpid() != self._pid:
+            return
+        if self._out is None:
+            self._open('w')
+        if self._written is None:
+            if self.fmt == FORMAT_TEXT:
+                self._write_header(self._out)
+            else:
+                self._out.write(_npy_header(self._columns(self.records).dtype, 0))
+            self._written = 0
+
+        if self._rows:
+            rows = self.records
+            if self.fmt == FORMAT_TEXT:
+                self._write_rows(self._out, rows)
+            else:
+                # Blocks are split into columns only in the header, the data are the same.
+                rows = self._columns(rows)
+                self._out.write(rows.tobytes())
+                # Update number of rows in the header
+                self._out.seek(0)
+                self._out.write(_npy_header(rows.dtype, self._written + self._rows))
+                self._out.seek(0, os.SEEK_END)
+            self._written += self._rows
+            self._rows = 0
+            self._data_array = None
+        self._out.flush()
+        self._flushed_at = time.time()
+
+    def close(self):
+        """
+        Flushes the remaining rows and closes the output if it was opened by the dataset.
+        """
+        self.flush()
+        if self._filename is not None:
+            self._out.close()
+            self._out = None
+
+
+def _map_member(filename, info):
+    """
+    Returns memory map of the NPY file stored in ZIP archive without compression.
+    """
+    if info.compress_type != zipfile.ZIP_STORED:
+        raise ValueError("Column '%s' in '%s' is compressed and can't be memory mapped." % (info.filename, filename))
+    with open(filename, 'rb') as handle:
+        # Skip the local file header, it contains the file name and the extra field.
+        handle.seek(info.header_offset)
+        header = handle.read(30)
+        name_size, extra_size = struct.unpack('<HH', header[26:30])
+        handle.seek(info.header_offset + 30 + name_size + extra_size)
+        if read_magic(handle) == (1, 0):
+            shape, fortran_order, dtype = read_array_header_1_0(handle)
+        else:
+            shape, fortran_order, dtype = read_array_header_2_0(handle)
+        offset = handle.tell()
+    if not numpy.prod(shape):
+        return numpy.empty(shape, dtype=dtype)
+    return numpy.memmap(filename, dtype=dtype, mode='r', offset=offset, shape=shape,
+                        order=fortran_order and 'F' or 'C')
+
+
+def load_data(filename, mmap=False):
+    """
+    Loads data written by dataset.
+
+    The format is detected from the content of the file. The result is the same for all formats, except the data types
+    of the columns, which are stored only in binary formats. Columns from text files are floats, except the frame
+    column, which is always integer.
+
+    @param filename: Name of the file
+    @param mmap: Whether to memory map the data instead of loading them. Not supported for text and `FORMAT_NPZ`.
+    @type mmap: Boolean
+    @return: Ordered dictionary with data of columns by their names, each one is an array of shape (rows, ). First one
+             is the frame column.
+    @rtype: OrderedDict
+    """
+    with open(filename, 'rb') as handle:
+        magic = handle.read(len(MAGIC_PREFIX))
+
+    if magic == MAGIC_PREFIX:
+        records = numpy.load(filename, mmap_mode=mmap and 'r' or None)
+        return OrderedDict((name, records[name]) for name in records.dtype.names)
+
+    if zipfile.is_zipfile(filename):
+        result = OrderedDict()
+        with zipfile.ZipFile(filename) as archive:
+            for info in archive.infolist():
+                name = os.path.splitext(info.filename)[0]
+                if mmap:
+                    result[name] = _map_member(filename, info)
+                else:
+                    result[name] = numpy.load(BytesIO(archive.read(info)))
+        return result
+
+    if mmap:
+        raise ValueError("Text file '%s' can't be memory mapped." % filename)
+    with open(filename) as handle:
+        names = handle.readline().split()
+        data = numpy.loadtxt(handle, ndmin=2)
+    if not len(data):
+        data = numpy.empty((0, len(names)))
+    result = OrderedDict((name, data[:, index]) for index, name in enumerate(names))
+    result[names[0]] = result[names[0]].astype(FrameCollector.dtype)
+    return result
@@ -0,0 +1,276 @@
+"""
+Native reader of DCD trajectory files.
+"""
+import logging
+import math
+import os
+import struct
+
+import numpy
+from numpy.lib.stride_tricks import as_strided
+
+__all__ = ['DCDReader']
+
+
+LOGGER = logging.getLogger(__name__)
+
+
+# Size of the DCD header record
+HEADER_SIZE = 84
+# Size of the unit cell record - 6 doubles
+UNITCELL_SIZE = 48
+# Size of the record marker
+MARKER_SIZE = 4
+# Conversion factor from AKMA time units to picoseconds
+AKMA_TO_PS = 0.04888821
+
+
+class DCDReader(object):
+    """
+    Reads DCD trajectory files.
+
+    The frames are not loaded into the memory, they are accessible through memory mapped file instead.
+
+    @ivar filename: Name of the trajectory file
+    @ivar numatoms: Number of atoms
+    @ivar numframes: Number of frames in the file
+    @ivar istart: Number of the first timestep in the file
+    @ivar nsavc: Number of timesteps between frames
+    @ivar timestep: Length of the timestep in picoseconds
+    @ivar has_unitcell: Whether frames contain unit cell
+    @ivar fixed: Indexes of fixed atoms
+    """
+    def __init__(self, filename):
+        """
+        Opens DCD file and reads its header.
+
+        @param filename: Name of the trajectory file
+        """
+        self.filename = filename
+        with open(filename, 'rb') as handle:
+            self._read_header(handle)
+        self._map = None
+
+    def __repr__(self):
+        return "<%s: '%s'>" % (type(self).__name__, self.filename)
+
+    def __len__(self):
+        return self.numframes
+
+    def _unpack(self, handle, fmt):
+        # Reads and unpacks the data from file
+        fmt = self._endian + fmt
+        buf = handle.read(struct.calcsize(fmt))
+        if len(buf) != struct.calcsize(fmt):
+            raise ValueError("Unexpected end of DCD file '%s'" % self.filename)
+        return struct.unpack(fmt, buf)
+
+    def _read_record(self, handle):
+        # Reads the whole record and returns its content
+        size, = self._unpack(handle, 'i')
+        content = handle.read(size)
+        end, = self._unpack(handle, 'i')
+        if len(content) != size or end != size:
+            raise ValueError("Corrupted record in DCD file '%s'" % self.filename)
+        return content
+
+    def _read_header(self, handle):
+        """
+        Reads the DCD header and computes the frame layout.
+        """
+        # Detect endianness from the size of the first record
+        buf = handle.read(MARKER_SIZE)
+        if len(buf) == MARKER_SIZE and struct.unpack('<i', buf)[0] == HEADER_SIZE:
+            self._endian = '<'
+        elif len(buf) == MARKER_SIZE and struct.unpack('>i', buf)[0] == HEADER_SIZE:
+            self._endian = '>'
+        else:
+            raise ValueError("File '%s' is not a DCD file" % self.filename)
+        handle.seek(0)
+
+        header = self._read_record(handle)
+        if header[:4] != 'CORD':
+            raise ValueError("File '%s' is not a DCD file" % self.filename)
+        icntrl = struct.unpack(self._endian + '20i', header[4:])
+        charmm = icntrl[19] != 0
+        self.istart = icntrl[1]
+        self.nsavc = icntrl[2]
+        numfixed = icntrl[8]
+        if charmm:
+            delta, = struct.unpack(self._endian + 'f', header[40:44])
+            self.has_unitcell = icntrl[10] != 0
+            if icntrl[11]:
+                raise ValueError("DCD file '%s' contains 4D coordinates, which are not supported" % self.filename)
+        else:
+            # X-PLOR format stores the timestep in double precision
+            delta, = struct.unpack(self._endian + 'd', header[40:48])
+            self.has_unitcell = False
+        self.timestep = delta * AKMA_TO_PS
+
+        # Title record
+        self._read_record(handle)
+
+        # Number of atoms
+        self.numatoms, = struct.unpack(self._endian + 'i', self._read_record(handle))
+
+        # Free atoms
+        if numfixed:
+            free = numpy.frombuffer(self._read_record(handle), dtype=self._endian + 'i4') - 1
+            mask = numpy.ones(self.numatoms, dtype=bool)
+            mask[free] = False
+            self.fixed = numpy.flatnonzero(mask)
+            self._free = free
+        else:
+            self.fixed = numpy.empty(0, dtype=int)
+            self._free = None
+
+        self._offset = handle.tell()
+        # Size of frames in bytes - first frame always contains all atoms
+        cell_size = self.has_unitcell and UNITCELL_SIZE + 2 * MARKER_SIZE or 0
+        self._first_frame_size = cell_size + 3 * (4 * self.numatoms + 2 * MARKER_SIZE)
+        self._frame_size = cell_size + 3 * (4 * (self.numatoms - numfixed) + 2 * MARKER_SIZE)
+
+        # Number of frames in the header may not be reliable, compute it from the file size
+        data_size = os.path.getsize(self.filename) - self._offset
+        if data_size < self._first_frame_size:
+            self.numframes = 0
+        else:
+            self.numframes = 1 + (data_size - self._first_frame_size) // self._frame_size
+        if self.numframes != icntrl[0]:
+            LOGGER.warning("DCD file '%s' contains %d frames, header claims %d.", self.filename, self.numframes,
+                           icntrl[0])
+
+    def close(self):
+        """
+        Closes the memory mapped file.
+        """
+        self._map = None
+
+    @property
+    def map(self):
+        """
+        Returns memory map of the frame data.
+        """
+        if self._map is None:
+            size = self._first_frame_size + (self.numframes - 1) * self._frame_size if self.numframes else 0
+            if size:
+                self._map = numpy.memmap(self.filename, dtype=numpy.uint8, mode='r', offset=self._offset,
+                                         shape=(size, ))
+            else:
+                self._map = numpy.empty(0, dtype=numpy.uint8)
+        return self._map
+
+    def _view(self, offset, numatoms, numframes, frame_size):
+        # Returns strided view of coordinates in frames which starts at offset
+        # Coordinates are stored in records per dimension, skip the unit cell and the record marker.
+        if self.has_unitcell:
+            offset += UNITCELL_SIZE + 2 * MARKER_SIZE
+        offset += MARKER_SIZE
+        dim_size = 4 * numatoms + 2 * MARKER_SIZE
+        # Create view of the first element in data type of coordinates
+        base = self.map[offset:offset + 4].view(self._endian + 'f4')
+        return as_strided(base, shape=(numframes, numatoms, 3), strides=(frame_size, 4, dim_size))
+
+    @property
+    def coords(self):
+        """
+        Returns memory mapped coordinates without copying.
+
+        @rtype: numpy array of shape (frames, atoms, 3)
+        """
+        if self._free is not None:
+            raise ValueError("Coordinates of DCD file '%s' with fixed atoms can not be mapped." % self.filename)
+        if not self.numframes:
+            return numpy.empty((0, self.numatoms, 3), dtype=self._endian + 'f4')
+        return self._view(0, self.numatoms, self.numframes, self._frame_size)
+
+    def read(self, start=0, stop=None, step=1):
+        """
+        Returns coordinates of the frames.
+
+        Returns view of the memory map if possible.
+
+        @param start: First frame
+        @type start: Non-negative integer
+        @param stop: Stop frame, not included. Default is end of file.
+        @type stop: Non-negative integer or None
+        @param step: Return every step'th frame
+        @type step: Positive integer
+        @rtype: numpy array of shape (frames, atoms, 3)
+        """
+        assert start >= 0
+        assert stop is None or stop >= 0
+        assert step > 0
+        if self._free is None:
+            return self.coords[start:stop:step]
+
+        # Assemble frames with fixed atoms
+        frames = xrange(*slice(start, stop, step).indices(self.numframes))
+        result = numpy.empty((len(frames), self.numatoms, 3), dtype=numpy.float32)
+        if not len(frames):
+            return result
+        first = self._view(0, self.numatoms, 1, self._first_frame_size)[0]
+        result[:] = first
+        if self.numframes > 1:
+            free = self._view(self._first_frame_size, len(self._free), self.numframes - 1, self._frame_size)
+            for i, frame in enumerate(frames):
+                if frame:
+                    result[i, self._free] = free[frame - 1]
+        return result
+
+    def frame_offsets(self):
+        """
+        Returns positions of the frames in the file.
+
+        @return: Byte offsets of the frames, followed by offset of the end of the last frame.
+        @rtype: numpy array of length numframes + 1
+        """
+        offsets = numpy.arange(self.numframes + 1, dtype=numpy.int64) * self._frame_size
+        # First frame may be larger
+        offsets[1:] += self._first_frame_size - self._frame_size
+        return offsets + self._offset
+
+    def unitcell(self, frame):
+        """
+        Returns unit cell of the frame.
+
+        @param frame: Frame number
+        @type frame: Non-negative integer
+        @return: Tuple (a, b, c, alpha, beta, gamma) or None if trajectory doesn't contain unit cell.
+        """
+        assert 0 <= frame < self.numframes
+        if not self.has_unitcell:
+            return None
+        if frame:
+            offset = self._first_frame_size + (frame - 1) * self._frame_size
+        else:
+            offset = 0
+        offset += MARKER_SIZE
+        # Unit cell is stored as A, gamma, B, beta, alpha, C
+        cell = self.map[offset:offset + UNITCELL_SIZE].view(self._endian + 'f8')
+        a, gamma, b, beta, alpha, c = [float(i) for i in cell]
+        if all(-1.0 <= i <= 1.0 for i in (alpha, beta, gamma)):
+            # Angles are stored as cosines
+            alpha, beta, gamma = [90.0 - math.degrees(math.asin(i)) for i in (alpha, beta, gamma)]
+        return a, b, c, alpha, beta, gamma
+
+    def unitcells(self, start=0, stop=None, step=1):
+        """
+        Returns unit cells of the frames.
+
+        @param start: First frame
+        @type start: Non-negative integer
+        @param stop: Stop frame, not included. Default is end of file.
+        @type stop: Non-negative integer or None
+        @param step: Return every step'th frame
+        @type step: Positive integer
+        @return: Unit cells (a, b, c, alpha, beta, gamma) or None if trajectory doesn't contain unit cell.
+        @rtype: numpy array of shape (frames, 6) or None
+        """
+        assert start >= 0
+        assert stop is None or stop >= 0
+        assert step > 0
+        if not self.has_unitcell:
+            return None
+        frames = xrange(*slice(start, stop, step).indices(self.numframes))
+        return numpy.array([self.unitcell(frame) for frame in frames], dtype=float).reshape(len(frames), 6)
@@ -0,0 +1,183 @@
+"""
+Index of frames in trajectory files.
+"""
+import logging
+import os
+import struct
+
+import numpy
+
+from .dcd import DCDReader
+
+__all__ = ['FrameIndex', 'get_frame_index']
+
+
+LOGGER = logging.getLogger(__name__)
+
+
+# Suffix of the cache file with the index, it's stored next to the trajectory file.
+INDEX_SUFFIX = '.pyvmd-index'
+# Magic number of XTC frames
+XTC_MAGIC = 1995
+# Size of XTC frame header - magic, number of atoms, step, time, box and number of atoms again
+XTC_HEADER_SIZE = 56
+# Size of the header of compressed coordinates - precision, minimal and maximal integers, small index and byte count
+XTC_COORDS_HEADER_SIZE = 36
+
+
+class FrameIndex(object):
+    """
+    Index of frames in trajectory file.
+
+    @ivar filename: Name of the trajectory file
+    @ivar offsets: Positions of frames in the file in bytes
+    @ivar end: Position of the end of the last frame
+    @ivar timestep: Time between frames in picoseconds or `None` if not known
+    """
+    def __init__(self, filename, offsets, end, timestep=None):
+        self.filename = filename
+        self.offsets = offsets
+        self.end = end
+        self.timestep = timestep
+
+    def __repr__(self):
+        return "<%s: '%s'>" % (type(self).__name__, self.filename)
+
+    def __len__(self):
+        return len(self.offsets)
+
+    @property
+    def numframes(self):
+        """
+        Returns number of frames in the file.
+        """
+        return len(self.offsets)
+
+    def byte_range(self, start, stop=None):
+        """
+        Returns position and size of the frames in the file.
+
+        @param start: First frame
+        @type start: Non-negative integer
+        @param stop: Stop frame, not included. Default is end of file.
+        @type stop: Non-negative integer or None
+        @return: Tuple (offset, size)
+        """
+        assert start >= 0
+        numframes = len(self)
+        start = min(start, numframes)
+        stop = numframes if stop is None else min(stop, numframes)
+        offset = self.offsets[start] if start < numframes else self.end
+        end = self.offsets[stop] if stop < numframes else self.end
+        return int(offset), int(max(end - offset, 0))
+
+    def save(self, filename):
+        """
+        Saves the index into the file.
+        """
+        stat = os.stat(self.filename)
+        with open(filename, 'wb') as handle:
+            numpy.savez(handle, offsets=self.offsets, end=self.end,
+                        timestep=numpy.nan if self.timestep is None else self.timestep,
+                        size=stat.st_size, mtime=stat.st_mtime)
+
+    @classmethod
+    def load(cls, filename, index_filename):
+        """
+        Loads the index of the trajectory file from the index file.
+
+        @return: Index or `None` if the index file doesn't match the trajectory file.
+        """
+        stat = os.stat(filename)
+        with numpy.load(index_filename) as data:
+            if data['size'] != stat.st_size or data['mtime'] != stat.st_mtime:
+                return None
+            timestep = float(data['timestep'])
+            return cls(filename, data['offsets'], int(data['end']), None if numpy.isnan(timestep) else timestep)
+
+
+def _index_dcd(filename):
+    """
+    Returns index of DCD file. Frames in DCD files have the same size, so their positions are computed from header.
+    """
+    reader = DCDReader(filename)
+    offsets = reader.frame_offsets()
+    return FrameIndex(filename, offsets[:-1], int(offsets[-1]), reader.timestep)
+
+
+def _index_xtc(filename):
+    """
+    Returns index of XTC file. Frames in XTC files are compressed, so the whole file is scanned.
+    """
+    size = os.path.getsize(filename)
+    offsets = []
+    times = []
+    offset = 0
+    with open(filename, 'rb') as handle:
+        while offset + XTC_HEADER_SIZE <= size:
+            handle.seek(offset)
+            header = handle.read(XTC_HEADER_SIZE)
+            magic, numatoms, dummy_step, time = struct.unpack('>iiif', header[:16])
+            if magic != XTC_MAGIC:
+                raise ValueError("Invalid frame at position %d in XTC file '%s'" % (offset, filename))
+            if numatoms <= 9:
+                # Small systems are stored uncompressed
+                frame_size = XTC_HEADER_SIZE + 12 * numatoms
+            else:
+                coords_header = handle.read(XTC_COORDS_HEADER_SIZE)
+                if len(coords_header) < XTC_COORDS_HEADER_SIZE:
+                    break
+                byte_count, = struct.unpack('>i', coords_header[-4:])
+                # Data are padded to 4 bytes
+                frame_size = XTC_HEADER_SIZE + XTC_COORDS_HEADER_SIZE + (byte_count + 3) // 4 * 4
+            if offset + frame_size > size:
+                # The last frame is incomplete
+                break
+            offsets.append(offset)
+            times.append(time)
+            offset += frame_size
+    timestep = times[1] - times[0] if len(times) > 1 else None
+    return FrameIndex(filename, numpy.array(offsets, dtype=numpy.int64), offset, timestep)
+
+
+# Functions which create index for file types
+INDEXERS = {
+    '.dcd': _index_dcd,
+    '.xtc': _index_xtc,
+}
+
+
+def get_frame_index(filename, cache=True):
+    """
+    Returns index of frames in the trajectory file.
+
+    The index is built once and cached in file next to the trajectory file. It's rebuilt if the trajectory file changes.
+
+    @param filename: Name of the trajectory file. Supported formats are DCD and XTC.
+    @param cache: Whether to use the cache file.
+    @type cache: Boolean
+    @rtype: FrameIndex
+    """
+    extension = os.path.splitext(filename)[1].lower()
+    if extension not in INDEXERS:
+        raise ValueError("Frame index is not supported for file '%s'." % filename)
+
+    index_filename = filename + INDEX_SUFFIX
+    if cache and os.path.exists(index_filename):
+        try:
+            index = FrameIndex.load(filename, index_filename)
+        except (IOError, ValueError, KeyError) as error:
+            LOGGER.warning("Frame index '%s' can't be loaded: %s", index_filename, error)
+            index = None
+        if index is not None:
+            return index
+
+    LOGGER.debug("Building frame index of '%s'", filename)
+    index = INDEXERS[extension](filename)
+    if cache:
+        try:
+            index.save(index_filename)
+        except IOError as error:
+            # Index is only an optimization, it can be built again.
+            LOGGER.warning("Frame index '%s' can't be saved: %s", index_filename, error)
+    return index
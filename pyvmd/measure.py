@@ -1,23 +1,73 @@
 """
 Utilities for simple strucural analysis.
 """
-import math
+import itertools
 
-from numpy import array, cross
-from numpy.linalg import norm
+import numpy
+from numpy import arctan2, array, asarray, cross, degrees, einsum, matmul, maximum, sign, sqrt
+from numpy.linalg import det, eigvalsh, inv, norm, svd
 
 from .atoms import Atom, SelectionBase
 
-__all__ = ['angle', 'center', 'dihedral', 'distance']
+__all__ = ['NeighborSearch', 'angle', 'center', 'dihedral', 'distance', 'unitcell_vectors']
 
 
-def coords_distance(a, b):
+def coords_minimum_image(vectors, unitcell):
+    """
+    Returns vectors in minimum image convention of the unit cell.
+
+    Vectors are shifted by the cell vectors, so their fractional coordinates lie within (-0.5, 0.5). This is the
+    shortest image in orthorhombic cells and in triclinic cells for vectors shorter than half of the cell width.
+
+    @type vectors: numpy array of shape (..., 3)
+    @param unitcell: Unit cell (a, b, c, alpha, beta, gamma) or unit cells of the vectors
+    @type unitcell: Sequence or numpy array of shape (..., 6)
+    @rtype: numpy array of shape (..., 3)
+    """
+    vectors = asarray(vectors, dtype=float)
+    cell = unitcell_vectors(unitcell)
+    fractional = matmul(vectors[..., None, :], inv(cell))[..., 0, :]
+    fractional -= numpy.round(fractional)
+    return matmul(fractional[..., None, :], cell)[..., 0, :]
+
+
+def _difference(a, b, unitcell):
+    """
+    Returns vector b-->a, in minimum image convention if unit cell is defined.
+    """
+    diff = a - b
+    if unitcell is not None:
+        diff = coords_minimum_image(diff, unitcell)
+    return diff
+
+
+def coords_distances(a, b, unitcell=None):
+    """
+    Returns distances between two arrays of coordinates.
+
+    Arrays are broadcast against each other, e.g. coordinates of shape (frames, atoms, 3) can be measured against
+    coordinates of shape (atoms, 3).
+
+    @type a: numpy array of shape (..., 3)
+    @type b: numpy array of shape (..., 3)
+    @param unitcell: Unit cell (a, b, c, alpha, beta, gamma) or unit cells for minimum image convention
+    @type unitcell: Sequence, numpy array of shape (..., 6) or None
+    @rtype: numpy array of shape (...)
+    """
+    diff = _difference(asarray(a), asarray(b), unitcell)
+    return sqrt(einsum('...i,...i', diff, diff))
+
+
+def coords_distance(a, b, unitcell=None):
     """
     Returns distance between two coordinates.
+
+    @param unitcell: Unit cell (a, b, c, alpha, beta, gamma) for minimum image convention
+    @type unitcell: Sequence or None
     """
     assert a.shape == (3, )
     assert b.shape == (3, )
-    return norm(a - b)
+    return float(coords_distances(a, b, unitcell))
 
 
 def distance(a, b):
@@ -29,21 +79,42 @@ def distance(a, b):
     return coords_distance(a.coords, b.coords)
 
 
-def coords_angle(a, b, c):
+def coords_angles(a, b, c, unitcell=None):
+    """
+    Returns angles between three arrays of coordinates a--b--c in degrees.
+
+    Arrays are broadcast against each other, e.g. coordinates of shape (frames, atoms, 3) can be measured against
+    coordinates of shape (atoms, 3).
+
+    @type a: numpy array of shape (..., 3)
+    @type b: numpy array of shape (..., 3)
+    @type c: numpy array of shape (..., 3)
+    @param unitcell: Unit cell (a, b, c, alpha, beta, gamma) or unit cells for minimum image convention
+    @type unitcell: Sequence, numpy array of shape (..., 6) or None
+    @rtype: numpy array of shape (...)
+    """
+    a, b, c = asarray(a), asarray(b), asarray(c)
+    # Get vectors b-->a and b-->c
+    vec_1 = _difference(a, b, unitcell)
+    vec_2 = _difference(c, b, unitcell)
+    # Compute angles between the vectors
+    cross_prod = cross(vec_1, vec_2)
+    sine = sqrt(einsum('...i,...i', cross_prod, cross_prod))
+    cosine = einsum('...i,...i', vec_1, vec_2)
+    return degrees(arctan2(sine, cosine))
+
+
+def coords_angle(a, b, c, unitcell=None):
     """
     Returns angle between three coordinates a--b--c in degrees.
+
+    @param unitcell: Unit cell (a, b, c, alpha, beta, gamma) for minimum image convention
+    @type unitcell: Sequence or None
     """
     assert a.shape == (3, )
     assert b.shape == (3, )
     assert c.shape == (3, )
-    # Get vectors b-->a and b-->c
-    vec_1 = a - b
-    vec_2 = c - b
-    # Compute angle between the two vectors
-    cross_prod = cross(vec_1, vec_2)
-    sine = math.sqrt(cross_prod.dot(cross_prod))
-    cosine = vec_1.dot(vec_2)
-    return math.degrees(math.atan2(sine, cosine))
+    return float(coords_angles(a, b, c, unitcell))
 
 
 def angle(a, b, c):
@@ -56,24 +127,46 @@ def angle(a, b, c):
     return coords_angle(a.coords, b.coords, c.coords)
 
 
-def coords_dihedral(a, b, c, d):
+def coords_dihedrals(a, b, c, d, unitcell=None):
+    """
+    Returns dihedral angles of four arrays of coordinates a--b--c--d in degrees.
+
+    Arrays are broadcast against each other, e.g. coordinates of shape (frames, atoms, 3) can be measured against
+    coordinates of shape (atoms, 3).
+
+    @type a: numpy array of shape (..., 3)
+    @type b: numpy array of shape (..., 3)
+    @type c: numpy array of shape (..., 3)
+    @type d: numpy array of shape (..., 3)
+    @param unitcell: Unit cell (a, b, c, alpha, beta, gamma) or unit cells for minimum image convention
+    @type unitcell: Sequence, numpy array of shape (..., 6) or None
+    @rtype: numpy array of shape (...)
+    """
+    a, b, c, d = asarray(a), asarray(b), asarray(c), asarray(d)
+    # Get vectors a-->b, b-->c and c-->d
+    vec_1 = _difference(b, a, unitcell)
+    vec_2 = _difference(c, b, unitcell)
+    vec_3 = _difference(d, c, unitcell)
+    # Compute the dihedrals of the vectors
+    norm_1 = cross(vec_1, vec_2)
+    norm_2 = cross(vec_2, vec_3)
+    sine = einsum('...i,...i', norm_1, vec_3) * sqrt(einsum('...i,...i', vec_2, vec_2))
+    cosine = einsum('...i,...i', norm_1, norm_2)
+    return degrees(arctan2(sine, cosine))
+
+
+def coords_dihedral(a, b, c, d, unitcell=None):
     """
     Returns dihedral angle of four coordinates a--b--c--d in degrees.
+
+    @param unitcell: Unit cell (a, b, c, alpha, beta, gamma) for minimum image convention
+    @type unitcell: Sequence or None
     """
     assert a.shape == (3, )
     assert b.shape == (3, )
     assert c.shape == (3, )
     assert d.shape == (3, )
-    # Get vectors a-->b, b-->c and c-->d
-    vec_1 = b - a
-    vec_2 = c - b
-    vec_3 = d - c
-    # Compute the dihedral of the three vectors
-    norm_1 = cross(vec_1, vec_2)
-    norm_2 = cross(vec_2, vec_3)
-    sine = norm_1.dot(vec_3) * norm(vec_2)
-    cosine = norm_1.dot(norm_2)
-    return math.degrees(math.atan2(sine, cosine))
+    return float(coords_dihedrals(a, b, c, d, unitcell))
 
 
 def dihedral(a, b, c, d):
@@ -95,6 +188,81 @@ def dihedral(a, b, c, d):
     return coords_dihedral(a.coords, b.coords, c.coords, d.coords)
 
 
+def coords_fit_rmsd(coords, reference):
+    """
+    Returns RMSD between coordinates and reference after their optimal superposition.
+
+    The superposition is computed by Kabsch algorithm, coordinates are not modified.
+
+    @param coords: Coordinates, possibly for multiple frames.
+    @type coords: numpy array of shape (..., atoms, 3)
+    @param reference: Reference coordinates centered at the origin.
+    @type reference: numpy array of shape (atoms, 3)
+    @rtype: Number or numpy array of shape (...)
+    """
+    coords = asarray(coords, dtype=float)
+    assert coords.shape[-2:] == reference.shape
+    # Center the coordinates
+    coords = coords - coords.mean(axis=-2)[..., None, :]
+    # Covariance matrix
+    covariance = einsum('...ni,nj->...ij', coords, reference)
+    # The optimal rotation minimizes the sum of squared deviations to E0 - 2 * (s1 + s2 + d * s3), where s are
+    # singular values of the covariance matrix and d is a sign of its determinant, which excludes reflections.
+    singular = svd(covariance, compute_uv=False)
+    singular[..., 2] *= sign(det(covariance))
+    deviation = einsum('...ni,...ni', coords, coords) + einsum('ni,ni', reference, reference) - \
+        2 * singular.sum(axis=-1)
+    # Rounding errors may produce small negative numbers
+    return sqrt(maximum(deviation, 0) / reference.shape[0])
+
+
+def coords_fit(coords, reference):
+    """
+    Returns coordinates optimally superposed onto the reference.
+
+    The superposition is computed by Kabsch algorithm, coordinates are not modified.
+
+    @param coords: Coordinates, possibly for multiple frames.
+    @type coords: numpy array of shape (..., atoms, 3)
+    @param reference: Reference coordinates centered at the origin.
+    @type reference: numpy array of shape (atoms, 3)
+    @rtype: numpy array of shape (..., atoms, 3)
+    """
+    coords = asarray(coords, dtype=float)
+    assert coords.shape[-2:] == reference.shape
+    # Center the coordinates
+    coords = coords - coords.mean(axis=-2)[..., None, :]
+    # The optimal rotation is derived from singular value decomposition of the covariance matrix.
+    covariance = einsum('...ni,nj->...ij', coords, reference)
+    left, dummy, right = svd(covariance)
+    # Exclude reflections
+    left[..., :, 2] *= sign(det(einsum('...ij,...jk->...ik', left, right)))[..., None]
+    rotation = einsum('...ij,...jk->...ik', left, right)
+    return einsum('...ni,...ij->...nj', coords, rotation)
+
+
+def coords_gyration(coords, masses):
+    """
+    Returns principal moments of mass weighted gyration tensor.
+
+    Radius of gyration is a square root of their sum.
+
+    @param coords: Coordinates, possibly for multiple frames.
+    @type coords: numpy array of shape (..., atoms, 3)
+    @param masses: Masses of the atoms
+    @type masses: numpy array of shape (atoms, )
+    @return: Principal moments in ascending order
+    @rtype: numpy array of shape (..., 3)
+    """
+    coords = asarray(coords, dtype=float)
+    weights = asarray(masses, dtype=float)
+    weights = weights / weights.sum()
+    # Center of mass
+    coords = coords - einsum('n,...ni->...i', weights, coords)[..., None, :]
+    tensor = einsum('n,...ni,...nj->...ij', weights, coords, coords)
+    return eigvalsh(tensor)
+
+
 def center(selection):
     """
     Returns geometic center of selection or atom iterable.
@@ -114,3 +282,179 @@ def center(selection):
             sum_coords += atom.coords
             count += 1
         return sum_coords / count
+
+
+def unitcell_vectors(unitcell):
+    """
+    Returns vectors of the unit cell.
+
+    The first vector is parallel to x axis, the second one lies in xy plane.
+
+    @param unitcell: Unit cell (a, b, c, alpha, beta, gamma), lengths in angstroms and angles in degrees, or array of
+                     unit cells.
+    @type unitcell: Sequence or numpy array of shape (..., 6)
+    @rtype: numpy array of shape (..., 3, 3) with a vector in each row
+    """
+    unitcell = asarray(unitcell, dtype=float)
+    a, b, c = unitcell[..., 0], unitcell[..., 1], unitcell[..., 2]
+    cos_alpha, cos_beta, cos_gamma = [numpy.cos(numpy.radians(unitcell[..., i])) for i in (3, 4, 5)]
+    sin_gamma = numpy.sin(numpy.radians(unitcell[..., 5]))
+    vectors = numpy.zeros(unitcell.shape[:-1] + (3, 3))
+    vectors[..., 0, 0] = a
+    vectors[..., 1, 0] = b * cos_gamma
+    vectors[..., 1, 1] = b * sin_gamma
+    vectors[..., 2, 0] = c * cos_beta
+    vectors[..., 2, 1] = c * (cos_alpha - cos_beta * cos_gamma) / sin_gamma
+    vectors[..., 2, 2] = sqrt(maximum(c * c - vectors[..., 2, 0] ** 2 - vectors[..., 2, 1] ** 2, 0.0))
+    # Remove rounding errors of right angles
+    vectors[abs(vectors) < 1e-6 * unitcell[..., :3].max(axis=-1)[..., None, None]] = 0.0
+    return vectors
+
+
+class NeighborSearch(object):
+    """
+    Grid based search of atoms within a distance.
+
+    Atoms are sorted into cells, which are at least as large as the cutoff, so only atoms in the neighboring cells are
+    checked. The grid is built once for the coordinates and it can answer many queries, the time of building the grid
+    and of the queries grows linearly with number of atoms.
+
+    If unit cell is provided, the search uses minimum image convention in orthorhombic or triclinic cell.
+    The cutoff should be less than half of the width of the cell.
+
+    @ivar coords: Coordinates of the atoms
+    @ivar cutoff: Maximal distance of the search
+    @ivar vectors: Vectors of the unit cell or `None` if the search isn't periodic
+    """
+    def __init__(self, coords, cutoff, unitcell=None):
+        """
+        Builds the grid.
+
+        @param coords: Coordinates of the atoms
+        @type coords: numpy array of shape (atoms, 3)
+        @param cutoff: Maximal distance of the search
+        @type cutoff: Positive number
+        @param unitcell: Unit cell (a, b, c, alpha, beta, gamma) for periodic search
+        @type unitcell: Sequence or None
+        """
+        assert cutoff > 0
+        self.coords = asarray(coords, dtype=float)
+        assert self.coords.ndim == 2 and self.coords.shape[1] == 3
+        self.cutoff = cutoff
+        if unitcell is None:
+            self.vectors = None
+            self._inverse = None
+            self._origin = self.coords.min(axis=0) if len(self.coords) else numpy.zeros(3)
+            extent = self.coords.max(axis=0) - self._origin if len(self.coords) else numpy.zeros(3)
+            self._shape = numpy.maximum((extent // cutoff).astype(int) + 1, 1)
+        else:
+            self.vectors = unitcell_vectors(unitcell)
+            self._inverse = inv(self.vectors)
+            # Widths of the cell perpendicular to the planes of the other two vectors
+            volume = abs(det(self.vectors))
+            widths = [volume / norm(cross(self.vectors[i - 2], self.vectors[i - 1])) for i in xrange(3)]
+            self._shape = numpy.maximum((numpy.array(widths) // cutoff).astype(int), 1)
+        cells = self._cells(self.coords)
+        self._order = numpy.argsort(cells, kind='mergesort')
+        # Start of each cell in the sorted atoms
+        self._starts = numpy.searchsorted(cells[self._order], numpy.arange(self._shape.prod() + 1))
+
+    def _grid(self, coords):
+        """
+        Returns positions of the coordinates in the grid, in units of cells.
+        """
+        if self.vectors is None:
+            return (coords - self._origin) / self.cutoff
+        fractional = coords.dot(self._inverse)
+        return (fractional - numpy.floor(fractional)) * self._shape
+
+    def _cells(self, coords):
+        """
+        Returns numbers of cells of the coordinates.
+        """
+        position = numpy.minimum(self._grid(coords).astype(int), self._shape - 1)
+        return numpy.ravel_multi_index(position.T, self._shape, mode='clip')
+
+    def _offsets(self):
+        """
+        Returns offsets of the neighboring cells.
+        """
+        if self.vectors is None:
+            return itertools.product((-1, 0, 1), repeat=3)
+        # Periodic grid may contain less than 3 cells in a dimension, don't visit the same cell twice
+        return itertools.product(*[sorted(set(i % size for i in (-1, 0, 1))) for size in self._shape])
+
+    def minimum_image(self, vectors):
+        """
+        Returns vectors in minimum image convention. Vectors are not modified if the search isn't periodic.
+
+        @type vectors: numpy array of shape (..., 3)
+        """
+        vectors = asarray(vectors, dtype=float)
+        if self.vectors is None:
+            return vectors
+        fractional = vectors.dot(self._inverse)
+        return (fractional - numpy.round(fractional)).dot(self.vectors)
+
+    def search(self, points, radius=None, distances=False):
+        """
+        Returns pairs of points and atoms within the radius.
+
+        @param points: Coordinates of the query points
+        @type points: numpy array of shape (points, 3)
+        @param radius: Distance of the search, the cutoff by default. It can't be larger than the cutoff.
+        @type radius: Positive number or None
+        @param distances: Whether to return also the distances
+        @return: Tuple of arrays with indexes of the points and indexes of the atoms and optionally their distances
+        """
+        if radius is None:
+            radius = self.cutoff
+        assert 0 < radius <= self.cutoff
+        points = asarray(points, dtype=float).reshape(-1, 3)
+        position = numpy.minimum(self._grid(points).astype(int), self._shape - 1)
+        result_points = []
+        result_atoms = []
+        result_distances = []
+        for offset in self._offsets():
+            cell = position + offset
+            if self.vectors is None:
+                # Skip cells outside of the grid
+                valid = ((cell >= 0) & (cell < self._shape)).all(axis=1)
+            else:
+                cell %= self._shape
+                valid = numpy.ones(len(points), dtype=bool)
+            point_indices = numpy.flatnonzero(valid)
+            cells = numpy.ravel_multi_index(cell[valid].T, self._shape)
+            starts = self._starts[cells]
+            counts = self._starts[cells + 1] - starts
+            # Expand the pairs of points and atoms in the cells
+            pair_points = numpy.repeat(point_indices, counts)
+            first = numpy.cumsum(counts) - counts
+            pair_atoms = self._order[numpy.arange(counts.sum()) - numpy.repeat(first - starts, counts)]
+            diff = self.minimum_image(self.coords[pair_atoms] - points[pair_points])
+            pair_distances = sqrt(einsum('...i,...i', diff, diff))
+            within = pair_distances <= radius
+            result_points.append(pair_points[within])
+            result_atoms.append(pair_atoms[within])
+            result_distances.append(pair_distances[within])
+
+        result_points = numpy.concatenate(result_points)
+        result_atoms = numpy.concatenate(result_atoms)
+        # Sort the pairs
+        order = numpy.lexsort((result_atoms, result_points))
+        if distances:
+            return result_points[order], result_atoms[order], numpy.concatenate(result_distances)[order]
+        return result_points[order], result_atoms[order]
+
+    def pairs(self, radius=None, distances=False):
+        """
+        Returns pairs of atoms within the radius. Each pair is returned once, first index is smaller.
+
+        @param radius: Distance of the search, the cutoff by default. It can't be larger than the cutoff.
+        @type radius: Positive number or None
+        @param distances: Whether to return also the distances
+        @return: Tuple of arrays with indexes of the atoms and optionally their distances
+        """
+        result = self.search(self.coords, radius, distances)
+        unique = result[0] < result[1]
+        return tuple(r[unique] for r in result)
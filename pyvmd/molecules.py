@@ -4,9 +4,16 @@ Objects for manipulation with VMD molecules.
 import logging
 import os.path
 
+import numpy
+from atomsel import atomsel as _atomsel
 from Molecule import Molecule as _Molecule
 from VMD import molecule as _molecule, molrep as _molrep
 
+try:
+    import vmdnumpy as _vmdnumpy
+except ImportError:
+    _vmdnumpy = None
+
 __all__ = ['Frames', 'Molecule', 'FORMAT_DCD', 'FORMAT_PARM7', 'FORMAT_PDB', 'FORMAT_PSF', 'FORMATS', 'MOLECULES']
 
 
@@ -233,6 +240,54 @@ class Molecule(object):
 
     frame = property(_get_frame, _set_frame, doc="Molecule's frame")
 
+    def get_coords(self, frame=None):
+        """
+        Returns coordinates of all atoms in the frame.
+
+        If `vmdnumpy` is available, the array is a view of the VMD timestep, which is valid only until the frame is
+        deleted. Otherwise the coordinates are copied.
+
+        @param frame: Frame, active frame if not defined or `None`
+        @type frame: Non-negative integer or `None`
+        @rtype: numpy array of shape (atoms, 3)
+        """
+        if frame is None:
+            frame = self.frame
+        else:
+            assert frame >= 0
+        if _vmdnumpy is not None:
+            return _vmdnumpy.timestep(self.molid, frame)
+        sel = _atomsel('all', frame=frame, molid=self.molid)
+        coords = numpy.empty((len(sel), 3), dtype=numpy.float32)
+        for dim, name in enumerate(('x', 'y', 'z')):
+            coords[:, dim] = sel.get(name)
+        return coords
+
+    def get_unitcell(self, frame=None):
+        """
+        Returns unit cell of the frame.
+
+        @param frame: Frame, active frame if not defined or `None`
+        @type frame: Non-negative integer or `None`
+        @return: Tuple (a, b, c, alpha, beta, gamma) or None if the frame doesn't have periodic cell.
+        """
+        if frame is None:
+            frame = self.frame
+        else:
+            assert frame >= 0
+        cell = _molecule.get_periodic(self.molid, frame)
+        unitcell = tuple(float(cell[key]) for key in ('a', 'b', 'c', 'alpha', 'beta', 'gamma'))
+        if not all(unitcell[:3]):
+            return None
+        return unitcell
+
+    @property
+    def numatoms(self):
+        """
+        Returns number of atoms in the molecule.
+        """
+        return _molecule.numatoms(self.molid)
+
     @property
     def frames(self):
         """
@@ -0,0 +1,34 @@
+"""
+Utilities for tests which write DCD files.
+
+This module doesn't require VMD, so it can be used by tests of the DCD reader.
+"""
+import struct
+
+
+def _record(fmt, *values):
+    # Returns binary record for DCD file
+    content = struct.pack(fmt, *values)
+    return struct.pack('<i', len(content)) + content + struct.pack('<i', len(content))
+
+
+def write_dcd(filename, frames, fixed=(), unitcells=None):
+    """
+    Writes simple DCD file.
+    """
+    numframes, numatoms, dummy = frames.shape
+    icntrl = [numframes, 0, 1, numframes, 0, 0, 0, 0, len(fixed), 0, int(unitcells is not None)] + [0] * 8 + [24]
+    header = struct.pack('<4s9if10i', 'CORD', *(icntrl[:9] + [0.5] + icntrl[10:]))
+    free = [i for i in xrange(numatoms) if i not in fixed]
+    with open(filename, 'wb') as out:
+        out.write(struct.pack('<i', len(header)) + header + struct.pack('<i', len(header)))
+        out.write(_record('<i80s', 1, 'REMARKS test'))
+        out.write(_record('<i', numatoms))
+        if fixed:
+            out.write(_record('<%di' % len(free), *[i + 1 for i in free]))
+        for index, frame in enumerate(frames):
+            if unitcells is not None:
+                out.write(_record('<6d', *unitcells[index]))
+            atoms = frame if not index or not fixed else frame[free]
+            for dim in xrange(3):
+                out.write(_record('<%df' % len(atoms), *atoms[:, dim]))
@@ -1,12 +1,24 @@
 """
 Tests for trajectory analysis utilities.
 """
+import os
+import shutil
+import signal
+from datetime import timedelta
+from tempfile import mkdtemp, mkstemp
+
+import numpy
 import VMD
-from mock import sentinel
+from mock import patch, sentinel
 
-from pyvmd.analyzer import Analyzer
+from pyvmd.analyzer import AnalysisError, Analyzer, log_progress, ParallelAnalyzer, Progress, ProgressCallback
+from pyvmd.atoms import Selection
+from pyvmd.collectors import DistanceCollector, FrameCollector, RMSFCollector, XCoordCollector
+from pyvmd.datasets import DataSet, FORMAT_NPY, StreamDataSet
+from pyvmd.dcd import DCDReader
 from pyvmd.molecules import Molecule
 
+from .dcd_utils import write_dcd
 from .utils import data, PyvmdTestCase
 
 
@@ -57,6 +69,191 @@ class TestAnalyzer(PyvmdTestCase):
         self.assertAlmostEqualSeqs(self.coords, result)
         self.assertEqual(self.frames, range(24))
 
+    def test_analyze_stats(self):
+        # Test analyzer collects timing statistics
+        dset = DataSet()
+        analyzer = Analyzer(self.mol, [data('water.1.dcd'), data('water.2.dcd')], chunk=10)
+        analyzer.add_callback(self._get_status)
+        analyzer.add_dataset(dset)
+        analyzer.analyze()
+        stats = analyzer.stats
+        self.assertEqual(stats.frames, 24)
+        self.assertEqual(stats.chunks, 4)
+        self.assertEqual([(c.name, c.calls) for c in stats.chunk_callbacks], [('DataSet.collect_chunk', 4)])
+        self.assertEqual([(c.name, c.calls) for c in stats.callbacks],
+                         [('TestAnalyzer._get_status', 24), ('DataSet.collect', 24)])
+        self.assertGreater(stats.time, 0)
+        self.assertGreater(stats.load_time, 0)
+        self.assertGreaterEqual(stats.time, stats.load_time + stats.delete_time + stats.compute_time)
+        self.assertGreater(stats.fps, 0)
+        self.assertIn('24 frames', str(stats))
+        self.assertIn('callback DataSet.collect: 24 calls', stats.report())
+        self.assertEqual(stats.chunk_size, 10)
+        self.assertIn('chunk size 10 frames', stats.report())
+
+    def test_analyze_memory(self):
+        # Test chunk size is derived from the memory budget - 21 atoms take 1276 bytes per frame
+        sizes = []
+        analyzer = Analyzer(self.mol, [data('water.1.dcd'), data('water.2.dcd')], memory=1276 * 5)
+        analyzer.add_chunk_callback(lambda chunk: sizes.append(len(chunk)))
+        analyzer.add_callback(self._get_status)
+        # Loaded frames take the expected memory, resident memory of the process depends on other tests
+        with patch('pyvmd.analyzer._memory_usage', return_value=1000000):
+            analyzer.analyze()
+        self.assertEqual(self.frames, range(24))
+        self.assertEqual(sizes, [5, 5, 2, 5, 5, 2])
+        self.assertEqual(analyzer.stats.chunk_size, 5)
+        self.assertGreater(analyzer.stats.peak_memory, 0)
+
+    def test_analyze_memory_adapt(self):
+        # Test chunk size is reduced if frames use more memory than expected
+        def memory_usage():
+            # Every loaded frame takes 3000 bytes
+            return 3000 * len(self.mol.frames)
+
+        sizes = []
+        analyzer = Analyzer(self.mol, [data('water.1.dcd'), data('water.2.dcd')], memory=1276 * 5)
+        analyzer.add_chunk_callback(lambda chunk: sizes.append(len(chunk)))
+        analyzer.add_callback(self._get_status)
+        with patch('pyvmd.analyzer._memory_usage', side_effect=memory_usage):
+            analyzer.analyze()
+        self.assertEqual(self.frames, range(24))
+        self.assertEqual(sizes, [5, 2, 2, 2, 1, 2, 2, 2, 2, 2, 2])
+        self.assertEqual(analyzer.stats.chunk_size, 2)
+
+    def test_analyze_memory_adapt_grow(self):
+        # Test chunk size is enlarged again if frames use less memory
+        frame_memory = [3000]
+
+        def callback(step):
+            if step.frame == 11:
+                # Frames from the second file take only 500 bytes
+                frame_memory[0] = 500
+
+        sizes = []
+        analyzer = Analyzer(self.mol, [data('water.1.dcd'), data('water.2.dcd')], memory=1276 * 5)
+        analyzer.add_chunk_callback(lambda chunk: sizes.append(len(chunk)))
+        analyzer.add_callback(callback)
+        analyzer.add_callback(self._get_status)
+        with patch('pyvmd.analyzer._memory_usage', side_effect=lambda: frame_memory[0] * len(self.mol.frames)):
+            analyzer.analyze()
+        self.assertEqual(self.frames, range(24))
+        # Chunk is reduced by the first file and enlarged back to the initial estimate by the second one
+        self.assertEqual(sizes, [5, 2, 2, 2, 1, 2, 5, 5])
+        self.assertEqual(analyzer.stats.chunk_size, 5)
+
+    def test_progress(self):
+        # Test progress is reported
+        progress = []
+        analyzer = Analyzer(self.mol, [data('water.1.dcd'), data('water.2.dcd')], chunk=5, reader=DCDReader)
+        analyzer.add_progress_callback(progress.append, frames=8)
+        analyzer.analyze()
+        # Files are read by chunks of 5, 5 and 2 frames
+        self.assertEqual([(p.frames, p.total) for p in progress], [(10, 24), (22, 24), (24, 24)])
+        self.assertGreater(progress[0].fps, 0)
+        self.assertIsNotNone(progress[0].eta)
+
+    def test_progress_estimate(self):
+        # Test number of frames is estimated if trajectory is loaded by VMD
+        progress = []
+        analyzer = Analyzer(self.mol, [data('water.1.dcd'), data('water.2.dcd')], chunk=5)
+        analyzer.add_progress_callback(progress.append, frames=100)
+        analyzer.analyze()
+        # Progress is reported at the end of analysis
+        self.assertEqual([(p.frames, p.total) for p in progress], [(24, 24)])
+        # Estimate is only approximate
+        self.assertGreater(analyzer._estimate_frames([(data('water.1.dcd'), 0, None, 1)]), 0)
+        self.assertEqual(analyzer._estimate_frames([(data('water.1.dcd'), 2, 8, 1)]), 6)
+
+    def test_progress_interval(self):
+        # Test progress is reported every interval
+        progress = []
+        callback = ProgressCallback(progress.append, None, 10)
+        for frames, elapsed in ((10, 4.0), (20, 9.0), (30, 10.0), (40, 15.0), (50, 21.0)):
+            callback.update(Progress(frames, None, elapsed))
+        self.assertEqual([p.frames for p in progress], [30, 50])
+
+    def test_log_progress(self):
+        with patch('pyvmd.analyzer.LOGGER') as logger:
+            log_progress(Progress(10, 100, 5.0))
+            log_progress(Progress(10, None, 5.0))
+        self.assertEqual(logger.info.call_args_list[0][0][-1], timedelta(seconds=45))
+        self.assertEqual(logger.info.call_args_list[1][0][1:], (10, 2.0))
+
+    def _test_resume(self, reader):
+        # Test analysis resumed from checkpoint gives the same results as uninterrupted analysis
+        dummy, checkpoint = mkstemp(prefix='pyvmd_test_')
+        os.unlink(checkpoint)
+        self.addCleanup(lambda: os.path.exists(checkpoint) and os.unlink(checkpoint))
+        dummy, output = mkstemp(prefix='pyvmd_test_')
+        self.addCleanup(lambda: os.unlink(output))
+
+        def create_analyzer(**kwargs):
+            analyzer = Analyzer(self.mol, [data('water.1.dcd'), data('water.2.dcd')], step=2, chunk=2, reader=reader,
+                                **kwargs)
+            dset = DataSet()
+            dset.add_collector(XCoordCollector('index 0', 'x'))
+            stream = StreamDataSet(output, fmt=FORMAT_NPY, flush_rows=3)
+            stream.add_collector(XCoordCollector('index 0', 'x'))
+            analyzer.add_dataset(dset)
+            analyzer.add_dataset(stream)
+            return analyzer, dset, stream
+
+        analyzer, dset, stream = create_analyzer()
+        analyzer.analyze()
+        stream.close()
+        result = dset.records
+        self.assertEqual(len(result), 12)
+        self.assertTrue(numpy.array_equal(numpy.load(output), result))
+
+        # Analysis crashes
+        def crash(step):
+            if step.frame == 7:
+                raise ValueError('Crash')
+
+        analyzer, dset, stream = create_analyzer(checkpoint=checkpoint, checkpoint_interval=1e-9)
+        analyzer.add_callback(crash)
+        self.assertRaises(ValueError, analyzer.analyze)
+        # Frames from the last chunk are written, but they are not in the checkpoint
+        stream.close()
+        self.assertEqual(len(numpy.load(output)), 8)
+
+        # Resume the analysis
+        analyzer, dset, stream = create_analyzer(checkpoint=checkpoint)
+        analyzer.resume()
+        stream.close()
+        self.assertEqual(analyzer.stats.frames, 6)
+        self.assertTrue(numpy.array_equal(dset.records, result))
+        self.assertTrue(numpy.array_equal(numpy.load(output), result))
+
+        # Resume the finished analysis
+        analyzer, dset, stream = create_analyzer(checkpoint=checkpoint)
+        analyzer.resume()
+        stream.close()
+        self.assertEqual(analyzer.stats.frames, 0)
+        self.assertTrue(numpy.array_equal(dset.records, result))
+        self.assertTrue(numpy.array_equal(numpy.load(output), result))
+
+    def test_resume(self):
+        self._test_resume(None)
+
+    def test_resume_reader(self):
+        self._test_resume(DCDReader)
+
+    def test_resume_no_checkpoint(self):
+        # Test resume without checkpoint runs the analysis
+        dummy, checkpoint = mkstemp(prefix='pyvmd_test_')
+        os.unlink(checkpoint)
+        self.addCleanup(lambda: os.unlink(checkpoint))
+        analyzer = Analyzer(self.mol, [data('water.1.dcd'), data('water.2.dcd')], checkpoint=checkpoint)
+        analyzer.add_callback(self._get_status)
+        analyzer.resume()
+        self.assertEqual(self.frames, range(24))
+
+        # Checkpoint doesn't match
+        analyzer = Analyzer(self.mol, [data('water.1.dcd')], checkpoint=checkpoint)
+        self.assertRaises(ValueError, analyzer.resume)
+
     def test_analyze_params(self):
         # Test load every other frame, all 12 at once
         self.coords = []
@@ -69,3 +266,370 @@ class TestAnalyzer(PyvmdTestCase):
                   -1.2036057, -1.174916, -1.1705244, -1.1759951]
         self.assertAlmostEqualSeqs(self.coords, result)
         self.assertEqual(self.frames, range(12))
+
+    def test_analyze_prefetch(self):
+        # Test prefetching analyzer provides the same results
+        analyzer = Analyzer(self.mol, [data('water.1.dcd'), data('water.2.dcd')], chunk=5, prefetch=True)
+        analyzer.add_callback(self._get_status)
+        analyzer.add_callback(self._get_x)
+        analyzer.analyze()
+        result = [-1.4911567, -1.4851371, -1.4858487, -1.4773947, -1.4746015, -1.4673382, -1.4535547, -1.4307435,
+                  -1.4120502, -1.3853478, -1.3674825, -1.3421925, -1.3177859, -1.2816998, -1.2579591, -1.2262495,
+                  -1.2036057, -1.1834533, -1.174916, -1.1693807, -1.1705244, -1.1722997, -1.1759951, -1.175245]
+        self.assertAlmostEqualSeqs(self.coords, result)
+        self.assertEqual(self.frames, range(24))
+
+    def test_prefetch_byte_range(self):
+        # Test prefetched positions of frames are exact
+        analyzer = Analyzer(self.mol, [data('water.1.dcd')], chunk=5, prefetch=True)
+        offsets = DCDReader(data('water.1.dcd')).frame_offsets()
+        self.assertEqual(analyzer._byte_range(data('water.1.dcd'), 2, 7), (offsets[2], offsets[7] - offsets[2]))
+        self.assertEqual(analyzer._byte_range(data('water.1.dcd'), 10, 15), (offsets[10], offsets[12] - offsets[10]))
+        self.assertEqual(analyzer._byte_range(data('water.1.dcd'), 15, 20), (offsets[12], 0))
+        # Positions of frames in other formats are not known without the index
+        self.assertIsNone(analyzer._byte_range(data('water.pdb'), 0, 5))
+        with patch('pyvmd.analyzer.Prefetcher.request') as request:
+            analyzer = Analyzer(self.mol, [data('water.pdb')], prefetch=True)
+            analyzer.analyze()
+        self.assertEqual(request.call_count, 0)
+
+    def _test_ranges(self, **kwargs):
+        # Test analysis of frame ranges from files
+        analyzer = Analyzer(self.mol, [(data('water.1.dcd'), 2, 10, 3), (data('water.2.dcd'), 5, None)], chunk=2,
+                            **kwargs)
+        analyzer.add_callback(self._get_x)
+        analyzer.analyze()
+        # Frames 2, 5 and 8 from the first file and frames 5 to 11 from the second one
+        result = [-1.4858487, -1.4673382, -1.4120502, -1.1834533, -1.174916, -1.1693807, -1.1705244, -1.1722997,
+                  -1.1759951, -1.175245]
+        self.assertAlmostEqualSeqs(self.coords, result)
+
+    def test_ranges(self):
+        self._test_ranges()
+
+    def test_ranges_reader(self):
+        self._test_ranges(reader=DCDReader)
+
+    def test_ranges_prefetch(self):
+        self._test_ranges(prefetch=True)
+
+    def test_analyze_index(self):
+        # Test analyzer with frame indexes
+        tmpdir = mkdtemp(prefix='pyvmd_test_')
+        self.addCleanup(lambda: shutil.rmtree(tmpdir))
+        traj_files = []
+        for filename in ('water.1.dcd', 'water.2.dcd'):
+            shutil.copy(data(filename), tmpdir)
+            traj_files.append(os.path.join(tmpdir, filename))
+
+        dset = DataSet()
+        analyzer = Analyzer(self.mol, traj_files, chunk=5, prefetch=True, index=True)
+        analyzer.add_callback(self._get_status)
+        analyzer.add_dataset(dset)
+        analyzer.analyze()
+        self.assertEqual(self.frames, range(24))
+        # Number of frames is known in advance
+        self.assertEqual(dset._data.shape, (24, ))
+        self.assertTrue(os.path.exists(traj_files[0] + '.pyvmd-index'))
+
+    def test_analyze_reader(self):
+        # Test analyzer with native DCD reader
+        coords = []
+
+        def callback(step):
+            coords.append(step.coords[0, 0])
+
+        analyzer = Analyzer(self.mol, [data('water.1.dcd'), data('water.2.dcd')], step=2, chunk=4, reader=DCDReader)
+        analyzer.add_callback(self._get_status)
+        analyzer.add_callback(self._get_x)
+        analyzer.add_callback(callback)
+        analyzer.analyze()
+        result = [-1.4911567, -1.4858487, -1.4746015, -1.4535547, -1.4120502, -1.3674825, -1.3177859, -1.2579591,
+                  -1.2036057, -1.174916, -1.1705244, -1.1759951]
+        self.assertAlmostEqualSeqs(coords, result)
+        self.assertAlmostEqualSeqs(self.coords, result)
+        self.assertEqual(self.frames, range(12))
+        # Molecule contains only single frame
+        self.assertEqual(len(self.mol.frames), 1)
+
+    def test_step_coords(self):
+        # Test step provides coordinates of the frame loaded by VMD
+        coords = []
+
+        def callback(step):
+            coords.append(step.coords[0, 0])
+
+        analyzer = Analyzer(self.mol, [data('water.1.dcd')], step=2, chunk=4)
+        analyzer.add_callback(callback)
+        analyzer.analyze()
+        result = [-1.4911567, -1.4858487, -1.4746015, -1.4535547, -1.4120502, -1.3674825]
+        self.assertAlmostEqualSeqs(coords, result)
+
+    def test_step_coords_vmdnumpy(self):
+        # Test step provides view of the VMD timestep if vmdnumpy is available
+        timesteps = []
+
+        def timestep(molid, frame):
+            self.assertEqual(molid, self.mol.molid)
+            timesteps.append(frame)
+            return numpy.full((self.mol.numatoms, 3), frame, dtype=numpy.float32)
+
+        coords = []
+
+        def callback(step):
+            coords.append(step.coords[0, 0])
+            # Coordinates are cached for the frame
+            coords.append(step.coords[1, 0])
+
+        analyzer = Analyzer(self.mol, [data('water.1.dcd')], chunk=5)
+        analyzer.add_callback(callback)
+        with patch('pyvmd.molecules._vmdnumpy') as vmdnumpy:
+            vmdnumpy.timestep.side_effect = timestep
+            analyzer.analyze()
+        self.assertEqual(timesteps, [0, 1, 2, 3, 4, 0, 1, 2, 3, 4, 0, 1])
+        self.assertEqual(coords, [0, 0, 1, 1, 2, 2, 3, 3, 4, 4, 0, 0, 1, 1, 2, 2, 3, 3, 4, 4, 0, 0, 1, 1])
+
+    def test_chunk_coords(self):
+        # Test chunk provides coordinates of the atoms and of the frames
+        indices = numpy.array([0, 5, 10])
+        for reader in (None, DCDReader):
+            coords = []
+            atom_coords = []
+            frame_coords = []
+
+            def chunk_callback(chunk):
+                atom_coords.append(chunk.atom_coords(indices))
+                frame_coords.extend(numpy.array(chunk.frame_coords(index)) for index in xrange(len(chunk)))
+                coords.append(numpy.array(chunk.coords))
+
+            analyzer = Analyzer(self.mol, [data('water.1.dcd')], step=2, chunk=4, reader=reader)
+            analyzer.add_chunk_callback(chunk_callback)
+            analyzer.analyze()
+            self.assertEqual([c.shape for c in atom_coords], [(4, 3, 3), (2, 3, 3)])
+            coords = numpy.concatenate(coords)
+            numpy.testing.assert_array_equal(numpy.concatenate(atom_coords), coords[:, indices])
+            numpy.testing.assert_array_equal(frame_coords, coords)
+            self.assertAlmostEqualSeqs(list(coords[:, 0, 0]), [-1.4911567, -1.4858487, -1.4746015, -1.4535547,
+                                                               -1.4120502, -1.3674825])
+
+    def test_unitcell(self):
+        # Test step and chunk provide unit cells of the frames
+        dummy, filename = mkstemp(prefix='pyvmd_test_', suffix='.dcd')
+        self.addCleanup(lambda: os.unlink(filename))
+        coords = DCDReader(data('water.1.dcd')).read()
+        # Unit cells are stored in the order A, gamma, B, beta, alpha, C
+        write_dcd(filename, coords, unitcells=[(10.0 + i, 90.0, 20.0, 90.0, 90.0, 30.0) for i in xrange(len(coords))])
+        unitcells = []
+        chunk_unitcells = []
+
+        def callback(step):
+            unitcells.append(step.unitcell)
+
+        def chunk_callback(chunk):
+            chunk_unitcells.append(chunk.unitcells)
+
+        analyzer = Analyzer(self.mol, [filename], step=2, chunk=4, reader=DCDReader)
+        analyzer.add_callback(callback)
+        analyzer.add_chunk_callback(chunk_callback)
+        analyzer.analyze()
+        self.assertEqual(unitcells, [(10.0 + i, 20.0, 30.0, 90.0, 90.0, 90.0) for i in xrange(0, 12, 2)])
+        self.assertEqual([c.shape for c in chunk_unitcells], [(4, 6), (2, 6)])
+        numpy.testing.assert_array_equal(numpy.concatenate(chunk_unitcells), unitcells)
+
+        # Frames loaded by VMD don't have unit cells
+        del unitcells[:]
+        del chunk_unitcells[:]
+        analyzer = Analyzer(self.mol, [data('water.1.dcd')], chunk=5)
+        analyzer.add_callback(callback)
+        analyzer.add_chunk_callback(chunk_callback)
+        analyzer.analyze()
+        self.assertEqual(unitcells, [None] * 12)
+        self.assertEqual(chunk_unitcells, [None] * 3)
+
+    def test_analyze_reader_reserve(self):
+        # Test analyzer with native reader allocates the datasets at once
+        dset = DataSet()
+        analyzer = Analyzer(self.mol, [data('water.1.dcd'), data('water.2.dcd')], step=2, chunk=4, reader=DCDReader)
+        analyzer.add_dataset(dset)
+        analyzer.analyze()
+        self.assertEqual(dset.data.shape, (12, 1))
+        self.assertEqual(dset._data.shape, (12, ))
+
+    def test_analyze_reader_no_sync(self):
+        # Test frames read by native reader are not copied into the molecule if only batch collectors are used
+        dset = DataSet()
+        dset.add_collector(XCoordCollector('index 0'))
+        analyzer = Analyzer(self.mol, [data('water.1.dcd')], step=2, chunk=4, reader=DCDReader)
+        analyzer.add_dataset(dset)
+        with patch('pyvmd.analyzer._CoordsWriter.write') as write:
+            analyzer.analyze()
+        self.assertEqual(write.call_count, 0)
+        self.assertAlmostEqualSeqs(list(dset.data[:, 1]), [-1.4911567, -1.4858487, -1.4746015, -1.4535547, -1.4120502,
+                                                           -1.3674825])
+
+    def test_analyze_reader_sync(self):
+        # Test frames read by native reader are copied into the molecule for frame callbacks
+        analyzer = Analyzer(self.mol, [data('water.1.dcd')], step=2, chunk=4, reader=DCDReader)
+        analyzer.add_callback(self._get_x)
+        with patch('pyvmd.analyzer.Selection', wraps=Selection) as selection:
+            analyzer.analyze()
+        # Atomsel is created only once
+        self.assertEqual(selection.call_count, 1)
+        self.assertAlmostEqualSeqs(self.coords, [-1.4911567, -1.4858487, -1.4746015, -1.4535547, -1.4120502,
+                                                 -1.3674825])
+
+    def test_analyze_reader_sync_vmdnumpy(self):
+        # Test frames read by native reader are written directly into the VMD timestep if vmdnumpy is available
+        timestep = numpy.zeros((self.mol.numatoms, 3), dtype=numpy.float32)
+        coords = []
+
+        def callback(step):
+            coords.append(timestep[0, 0])
+
+        analyzer = Analyzer(self.mol, [data('water.1.dcd')], step=2, chunk=4, reader=DCDReader)
+        analyzer.add_callback(callback)
+        with patch('pyvmd.analyzer._vmdnumpy') as vmdnumpy:
+            vmdnumpy.timestep.return_value = timestep
+            analyzer.analyze()
+        vmdnumpy.timestep.assert_called_with(self.mol.molid, 0)
+        self.assertAlmostEqualSeqs(coords, [-1.4911567, -1.4858487, -1.4746015, -1.4535547, -1.4120502, -1.3674825])
+
+
+class StepFrameCollector(FrameCollector):
+    """
+    Collects frame number of steps.
+    """
+    batch = False
+
+
+class TestParallelAnalyzer(PyvmdTestCase):
+    """
+    Test `ParallelAnalyzer` class.
+    """
+    def setUp(self):
+        self.mol = Molecule.create()
+        self.mol.load(data('water.psf'))
+
+    def _analyze(self, analyzer):
+        # Run analysis and return dataset data
+        dset = DataSet()
+        dset.add_collector(XCoordCollector('index 0'))
+        dset.add_collector(DistanceCollector('index 0', 'index 3'))
+        analyzer.add_dataset(dset)
+        analyzer.analyze()
+        return dset.data
+
+    def test_analyze_files(self):
+        # Test trajectory split by files
+        result = self._analyze(Analyzer(self.mol, [data('water.1.dcd'), data('water.2.dcd')], step=3, chunk=2))
+        analyzer = ParallelAnalyzer(self.mol, [data('water.1.dcd'), data('water.2.dcd')], step=3, chunk=2,
+                                    processes=2)
+        self.assertTrue(numpy.array_equal(self._analyze(analyzer), result))
+
+    def test_analyze_frames(self):
+        # Test trajectory split by frame ranges
+        result = self._analyze(Analyzer(self.mol, [data('water.1.dcd'), data('water.2.dcd')], chunk=2))
+        analyzer = ParallelAnalyzer(self.mol, [data('water.1.dcd'), data('water.2.dcd')], chunk=2,
+                                    reader=DCDReader, processes=5)
+        self.assertEqual(len(analyzer._tasks()), 6)
+        self.assertTrue(numpy.allclose(self._analyze(analyzer), result))
+        # Statistics from workers are merged
+        self.assertEqual(analyzer.stats.frames, 24)
+        self.assertEqual(analyzer.stats.chunks, 12)
+        self.assertEqual([c.calls for c in analyzer.stats.callbacks], [24])
+
+    def test_analyze_ranges(self):
+        # Test frame ranges are split into tasks
+        traj_files = [(data('water.1.dcd'), 2, None, 3), (data('water.2.dcd'), 1, 9)]
+        result = self._analyze(Analyzer(self.mol, traj_files, chunk=2))
+        analyzer = ParallelAnalyzer(self.mol, traj_files, chunk=2, reader=DCDReader, processes=3)
+        self.assertEqual(analyzer._tasks(), [[(data('water.1.dcd'), 2, 8, 3)], [(data('water.1.dcd'), 8, 12, 3)],
+                                             [(data('water.2.dcd'), 1, 7, 1)], [(data('water.2.dcd'), 7, 9, 1)]])
+        self.assertTrue(numpy.allclose(self._analyze(analyzer), result))
+
+    def test_analyze_merge_state(self):
+        # Test states of collectors are merged from workers
+        def analyze(analyzer):
+            dset = DataSet()
+            collector = RMSFCollector('all')
+            dset.add_collector(collector)
+            analyzer.add_dataset(dset)
+            analyzer.analyze()
+            return collector
+
+        result = analyze(Analyzer(self.mol, [data('water.1.dcd'), data('water.2.dcd')]))
+        collector = analyze(ParallelAnalyzer(self.mol, [data('water.1.dcd'), data('water.2.dcd')], chunk=2,
+                                             reader=DCDReader, processes=5))
+        self.assertEqual(collector.count, 24)
+        self.assertTrue(numpy.allclose(collector.mean, result.mean))
+        self.assertTrue(numpy.allclose(collector.rmsf, result.rmsf))
+
+    def test_analyze_error(self):
+        # Test errors in workers are reported
+        def callback(step):
+            if step.frame == 5:
+                raise ValueError('Gazpacho!')
+
+        analyzer = ParallelAnalyzer(self.mol, [data('water.1.dcd'), data('water.2.dcd')], processes=2)
+        analyzer.add_callback(callback)
+        with self.assertRaisesRegexp(AnalysisError, 'Gazpacho!'):
+            analyzer.analyze()
+
+    def test_analyze_worker_died(self):
+        # Test workers which die are reported
+        def exit_callback(step):
+            if step.frame == 5:
+                os._exit(3)
+
+        def kill_callback(step):
+            if step.frame == 5:
+                os.kill(os.getpid(), signal.SIGKILL)
+
+        for callback, message in ((exit_callback, 'exited with code 3'), (kill_callback, 'killed by signal 9')):
+            analyzer = ParallelAnalyzer(self.mol, [data('water.1.dcd'), data('water.2.dcd')], processes=2)
+            analyzer.add_callback(callback)
+            with self.assertRaisesRegexp(AnalysisError, message):
+                analyzer.analyze()
+
+    def test_analyze_stream(self):
+        # Test stream datasets are flushed when the analysis finishes
+        handle, output = mkstemp()
+        os.close(handle)
+        self.addCleanup(os.unlink, output)
+        traj_files = [data('water.1.dcd'), data('water.2.dcd')]
+        for analyzer in (Analyzer(self.mol, traj_files), ParallelAnalyzer(self.mol, traj_files, processes=2)):
+            dset = StreamDataSet(output, fmt=FORMAT_NPY, flush_rows=1000)
+            dset.add_collector(XCoordCollector('index 0', 'x'))
+            analyzer.add_dataset(dset)
+            analyzer.analyze()
+            self.assertEqual(len(dset.records), 0)
+            self.assertEqual(numpy.load(output)['frame'].tolist(), range(24))
+            dset.close()
+
+    def test_analyze_frame_numbers(self):
+        # Test tasks number frames from the start of the trajectory if it's known
+        for reader in (None, DCDReader):
+            analyzer = ParallelAnalyzer(self.mol, [data('water.1.dcd'), data('water.2.dcd')], chunk=2, reader=reader,
+                                        processes=3)
+            dset = DataSet()
+            dset.add_collector(StepFrameCollector())
+            dset.add_collector(FrameCollector())
+            analyzer.add_dataset(dset)
+            analyzer.analyze()
+            columns = dset.data.T
+            self.assertEqual(columns[0].tolist(), range(24))
+            if reader is None:
+                # Frames are numbered from the start of the task
+                self.assertEqual(columns[1].tolist(), range(12) * 2)
+                self.assertEqual(columns[2].tolist(), range(12) * 2)
+            else:
+                self.assertEqual(columns[1].tolist(), range(24))
+                self.assertEqual(columns[2].tolist(), range(24))
+
+    def test_checkpoint(self):
+        # Test parallel analysis refuses checkpoints
+        with self.assertRaises(TypeError):
+            ParallelAnalyzer(self.mol, [data('water.1.dcd')], checkpoint='checkpoint')
+        analyzer = ParallelAnalyzer(self.mol, [data('water.1.dcd')], processes=2)
+        with self.assertRaisesRegexp(TypeError, "ParallelAnalyzer doesn't support checkpoints"):
+            analyzer.resume()
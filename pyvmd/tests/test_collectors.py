@@ -1,15 +1,24 @@
 """
 Tests for data collectors.
 """
+import os
 from cStringIO import StringIO
+from tempfile import mkstemp
 
+import numpy
+from mock import patch
+
+from pyvmd import measure
 from pyvmd.analyzer import Analyzer
 from pyvmd.atoms import Selection
-from pyvmd.collectors import (AngleCollector, DihedralCollector, DistanceCollector, RMSDCollector, XCoordCollector,
-                              YCoordCollector, ZCoordCollector)
+from pyvmd.collectors import (AngleCollector, Collector, CompiledSelection, DihedralCollector, DistanceCollector,
+                              GyrationCollector, MultiXYZCollector, PairDistanceCollector, RMSDCollector, RMSFCollector,
+                              TorsionCollector, XCoordCollector, XYZCollector, YCoordCollector, ZCoordCollector)
 from pyvmd.datasets import DataSet
+from pyvmd.dcd import DCDReader
 from pyvmd.molecules import Molecule
 
+from .dcd_utils import write_dcd
 from .utils import data, PyvmdTestCase
 
 
@@ -22,8 +31,30 @@ class TestCollectors(PyvmdTestCase):
         self.mol = Molecule.create()
         self.mol.load(data('water.psf'))
 
+    def _test_readers(self, test):
+        # Runs the test with trajectory loaded by VMD and with native reader
+        for reader in (None, DCDReader):
+            # Restore automatic names of collectors for each run
+            Collector.auto_name_counter = 0
+            test(reader)
+
+    def _test_chunk_collection(self, collectors, reader=None, atol=1e-8):
+        # Tests collectors provide the same data for chunks as for separate frames
+        chunks = []
+        steps = []
+        analyzer = Analyzer(self.mol, [data('water.1.dcd')], chunk=5, reader=reader)
+        analyzer.add_chunk_callback(lambda chunk: chunks.append([c.collect_chunk(chunk) for c in collectors]))
+        analyzer.add_callback(lambda step: steps.append([c.collect(step) for c in collectors]))
+        analyzer.analyze()
+        for index in xrange(len(collectors)):
+            self.assertTrue(numpy.allclose(numpy.concatenate([c[index] for c in chunks]), [s[index] for s in steps],
+                                           atol=atol, equal_nan=True))
+
     def test_coordinate_collectors(self):
         # Test coordinate collector
+        self._test_readers(self._test_coordinate_collectors)
+
+    def _test_coordinate_collectors(self, reader):
         dset = DataSet()
         dset.add_collector(XCoordCollector('index 0'))
         dset.add_collector(XCoordCollector('all'))
@@ -31,7 +62,7 @@ class TestCollectors(PyvmdTestCase):
         dset.add_collector(YCoordCollector('all'))
         dset.add_collector(ZCoordCollector('index 0'))
         dset.add_collector(ZCoordCollector('all'))
-        analyzer = Analyzer(self.mol, [data('water.1.dcd')])
+        analyzer = Analyzer(self.mol, [data('water.1.dcd')], chunk=5, reader=reader)
         analyzer.add_dataset(dset)
         analyzer.analyze()
 
@@ -41,8 +72,43 @@ class TestCollectors(PyvmdTestCase):
         # Check the result
         self.assertEqual(buf.getvalue(), open(data('coords.dat')).read())
 
+    def test_xyz_collectors(self):
+        # Test collectors of all coordinates provide the same data as collectors of single coordinates
+        self._test_readers(self._test_xyz_collectors)
+
+    def _test_xyz_collectors(self, reader):
+        selections = ['index 0', 'all', 'resid 2', 'x < 0']
+        dset = DataSet()
+        for index, selection in enumerate(selections):
+            dset.add_collector(XCoordCollector(selection, name='x%d' % index))
+            dset.add_collector(YCoordCollector(selection, name='y%d' % index))
+            dset.add_collector(ZCoordCollector(selection, name='z%d' % index))
+            dset.add_collector(XYZCollector(selection, name='xyz%d' % index))
+        dset.add_collector(MultiXYZCollector(selections[:3], name='static'))
+        dset.add_collector(MultiXYZCollector(selections, labels=['a', 'b', 'c', 'd'], name='dynamic'))
+        analyzer = Analyzer(self.mol, [data('water.1.dcd')], chunk=5, reader=reader)
+        analyzer.add_dataset(dset)
+        analyzer.analyze()
+
+        records = dset.records
+        self.assertEqual(len(records), 12)
+        for index, label in enumerate('abcd'):
+            for dim in 'xyz':
+                expected = records['%s%d' % (dim, index)]
+                self.assertTrue(numpy.allclose(records['xyz%d.%s' % (index, dim)], expected, atol=1e-6))
+                self.assertTrue(numpy.allclose(records['dynamic.%s.%s' % (label, dim)], expected, atol=1e-6))
+                if index < 3:
+                    self.assertTrue(numpy.allclose(records['static.%d.%s' % (index, dim)], expected, atol=1e-6))
+
+        # Test frame collection provides the same data
+        collectors = [XYZCollector('resid 2'), MultiXYZCollector(selections[:3]), MultiXYZCollector(selections)]
+        self._test_chunk_collection(collectors, reader, atol=1e-6)
+
     def test_geometry_collectors(self):
         # Test geometry collectors - distance, angle, dihedral and improper.
+        self._test_readers(self._test_geometry_collectors)
+
+    def _test_geometry_collectors(self, reader):
         dset = DataSet()
         dset.add_collector(DistanceCollector('index 0', 'index 1'))
         dset.add_collector(DistanceCollector('resid 1', 'all'))
@@ -50,7 +116,7 @@ class TestCollectors(PyvmdTestCase):
         dset.add_collector(AngleCollector('resid 1', 'resid 2', 'resid 3'))
         dset.add_collector(DihedralCollector('index 0', 'index 1', 'index 2', 'index 3'))
         dset.add_collector(DihedralCollector('resid 1', 'resid 2', 'resid 3', 'resid 4'))
-        analyzer = Analyzer(self.mol, [data('water.1.dcd')])
+        analyzer = Analyzer(self.mol, [data('water.1.dcd')], chunk=5, reader=reader)
         analyzer.add_dataset(dset)
         analyzer.analyze()
 
@@ -60,6 +126,295 @@ class TestCollectors(PyvmdTestCase):
         # Check the result
         self.assertEqual(buf.getvalue(), open(data('geometry.dat')).read())
 
+    def test_pair_distance_collector(self):
+        # Test pair distance collector provides the same data as distance collectors
+        self._test_readers(self._test_pair_distance_collector)
+
+    def _test_pair_distance_collector(self, reader):
+        index_pairs = [(0, 1), (0, 5), (20, 3), (7, 7)]
+        selection_pairs = [('resid 1', 'all'), ('resid 1', 'x > 0'), ('index 4', 'resid 2')]
+        dset = DataSet()
+        for index, (first, second) in enumerate(index_pairs):
+            dset.add_collector(DistanceCollector('index %d' % first, 'index %d' % second, name='index%d' % index))
+        for index, (first, second) in enumerate(selection_pairs):
+            dset.add_collector(DistanceCollector(first, second, name='selection%d' % index))
+        dset.add_collector(PairDistanceCollector(numpy.array(index_pairs), name='indexes'))
+        dset.add_collector(PairDistanceCollector(selection_pairs, labels=['a', 'b', 'c'], name='selections'))
+        dset.add_collector(PairDistanceCollector(index_pairs, block=True, name='block'))
+        analyzer = Analyzer(self.mol, [data('water.1.dcd')], chunk=5, reader=reader)
+        analyzer.add_dataset(dset)
+        analyzer.analyze()
+
+        records = dset.records
+        self.assertEqual(records['block'].shape, (12, 4))
+        for index in xrange(len(index_pairs)):
+            self.assertTrue(numpy.allclose(records['indexes.%d' % index], records['index%d' % index], atol=1e-6))
+            self.assertTrue(numpy.allclose(records['block'][:, index], records['index%d' % index], atol=1e-6))
+        for index, label in enumerate('abc'):
+            self.assertTrue(numpy.allclose(records['selections.%s' % label], records['selection%d' % index],
+                                           atol=1e-6))
+
+        # Test frame collection provides the same data
+        self._test_chunk_collection(dset.collectors[-3:], reader, atol=1e-6)
+
+    def test_pair_distance_collector_error(self):
+        self._test_collector_error(PairDistanceCollector([(0, 1), (2, 21)]))
+
+    def test_torsion_collector(self):
+        # Test torsion collector provides the same data as dihedral collectors
+        self._test_readers(self._test_torsion_collector)
+
+    def _test_torsion_collector(self, reader):
+        # Rename water atoms to backbone atoms, so every water is a residue of a chain.
+        sel = Selection('all', self.mol).atomsel
+        sel.set('name', ['N', 'CA', 'C'] * 7)
+        dset = DataSet()
+        # Residues are connected only within segments W1 (residues 1-4), W2 (residue 5) and Y1 (residues 6-7).
+        phi = {1: 'W1:TIP32', 2: 'W1:TIP33', 3: 'W1:TIP34', 6: 'Y1:TIP37'}
+        psi = {0: 'W1:TIP31', 1: 'W1:TIP32', 2: 'W1:TIP33', 5: 'Y1:TIP36'}
+        for residue in phi:
+            dset.add_collector(DihedralCollector(*['index %d' % i for i in xrange(3 * residue - 1, 3 * residue + 3)],
+                                                 name='phi%d' % residue))
+        for residue in psi:
+            dset.add_collector(DihedralCollector(*['index %d' % i for i in xrange(3 * residue, 3 * residue + 4)],
+                                                 name='psi%d' % residue))
+        dset.add_collector(TorsionCollector('all', sidechain=True, name='torsions'))
+        dset.add_collector(TorsionCollector('all', block=True, name='block'))
+        # Columns are not known until the analysis starts
+        with self.assertRaisesRegexp(ValueError, "Columns of collector 'torsions' are not known"):
+            dset.dtype
+        analyzer = Analyzer(self.mol, [data('water.1.dcd')], chunk=5, reader=reader)
+        analyzer.add_dataset(dset)
+        analyzer.analyze()
+
+        records = dset.records
+        self.assertEqual(dset.collectors[-2].columns[:4], ['W1:TIP31.phi', 'W1:TIP31.psi', 'W1:TIP31.chi1',
+                                                            'W1:TIP31.chi2'])
+        self.assertEqual(records['block'].shape, (12, 14))
+        for residue, label in phi.items():
+            self.assertTrue(numpy.allclose(records['torsions.%s.phi' % label], records['phi%d' % residue]))
+            self.assertTrue(numpy.allclose(records['block'][:, 2 * residue], records['phi%d' % residue]))
+        for residue, label in psi.items():
+            self.assertTrue(numpy.allclose(records['torsions.%s.psi' % label], records['psi%d' % residue]))
+            self.assertTrue(numpy.allclose(records['block'][:, 2 * residue + 1], records['psi%d' % residue]))
+        # Other torsions don't exist
+        self.assertTrue(numpy.isnan(records['torsions.W2:TIP35.phi']).all())
+        self.assertTrue(numpy.isnan(records['torsions.W1:TIP34.psi']).all())
+        self.assertTrue(numpy.isnan(records['torsions.W1:TIP32.chi1']).all())
+        self.assertEqual(numpy.isnan(records['block']).sum(), 12 * 6)
+
+        # Test frame collection provides the same data
+        self._test_chunk_collection(dset.collectors[-2:], reader)
+
+    def test_torsion_collector_chains(self):
+        # Test residues of different chains are not connected and they are labeled by chain
+        sel = Selection('all', self.mol).atomsel
+        sel.set('name', ['N', 'CA', 'C'] * 7)
+        sel.set('segname', 'W1')
+        # Chain A contains residues 1-4, chain B residues 1-3
+        sel.set('chain', ['A'] * 12 + ['B'] * 9)
+        sel.set('resid', [resid for resid in (1, 2, 3, 4, 1, 2, 3) for i in xrange(3)])
+        dset = DataSet()
+        dset.add_collector(DihedralCollector(*['index %d' % i for i in xrange(14, 18)], name='phi'))
+        collector = TorsionCollector('all', name='torsions')
+        dset.add_collector(collector)
+        analyzer = Analyzer(self.mol, [data('water.1.dcd')])
+        analyzer.add_dataset(dset)
+        analyzer.analyze()
+
+        self.assertEqual(collector.columns[6:10], ['A:TIP34.phi', 'A:TIP34.psi', 'B:TIP31.phi', 'B:TIP31.psi'])
+        records = dset.records
+        self.assertTrue(numpy.isnan(records['torsions.A:TIP34.psi']).all())
+        self.assertTrue(numpy.isnan(records['torsions.B:TIP31.phi']).all())
+        self.assertTrue(numpy.allclose(records['torsions.B:TIP32.phi'], records['phi']))
+
+        # Residues with the same labels are refused
+        sel.set('chain', 'A')
+        with self.assertRaisesRegexp(ValueError, 'several residues labeled TIP31, TIP32, TIP33'):
+            TorsionCollector('all').prepare(self.mol)
+
+    def test_rmsf_collector(self):
+        # Test RMSF collector
+        self._test_readers(self._test_rmsf_collector)
+
+    def _test_rmsf_collector(self, reader):
+        ref = Molecule.create()
+        ref.load(data('water.psf'))
+        ref.load(data('water.pdb'))
+        dset = DataSet()
+        rmsf = RMSFCollector('noh')
+        dset.add_collector(rmsf)
+        fitted = RMSFCollector('noh', Selection('noh', ref))
+        dset.add_collector(fitted)
+        analyzer = Analyzer(self.mol, [data('water.1.dcd'), data('water.2.dcd')], chunk=5, reader=reader)
+        analyzer.add_dataset(dset)
+        analyzer.analyze()
+        # Collectors don't add any columns
+        self.assertEqual(dset.dtype.names, ('frame', ))
+        self.assertEqual(len(dset.records), 24)
+
+        coords = numpy.concatenate([DCDReader(data('water.1.dcd')).read(), DCDReader(data('water.2.dcd')).read()])
+        coords = coords[:, ::3].astype(float)
+        self.assertEqual(rmsf.count, 24)
+        self.assertTrue(numpy.allclose(rmsf.mean, coords.mean(axis=0)))
+        expected = numpy.sqrt(((coords - coords.mean(axis=0)) ** 2).sum(axis=2).mean(axis=0))
+        self.assertTrue(numpy.allclose(rmsf.rmsf, expected))
+
+        ref_sel = Selection('noh', ref).atomsel
+        reference = numpy.array([ref_sel.get('x'), ref_sel.get('y'), ref_sel.get('z')]).T
+        coords = measure.coords_fit(coords, reference - reference.mean(axis=0))
+        expected = numpy.sqrt(((coords - coords.mean(axis=0)) ** 2).sum(axis=2).mean(axis=0))
+        self.assertTrue(numpy.allclose(fitted.rmsf, expected))
+        self.assertLess(fitted.rmsf.mean(), rmsf.rmsf.mean())
+
+        table = rmsf.table
+        self.assertEqual(list(table['index']), range(0, 21, 3))
+        self.assertEqual(list(table['resid']), range(1, 8))
+        self.assertEqual(list(table['name']), ['OH2'] * 7)
+        self.assertTrue(numpy.allclose(table['rmsf'], rmsf.rmsf))
+
+        # Test states of partial analyses can be merged
+        partial = RMSFCollector('noh')
+        analyzer = Analyzer(self.mol, [data('water.1.dcd')], chunk=5, reader=reader)
+        analyzer.add_callback(partial.collect)
+        partial.prepare(self.mol)
+        analyzer.analyze()
+        state = partial.get_state()
+        analyzer = Analyzer(self.mol, [data('water.2.dcd')], chunk=5, reader=reader)
+        analyzer.add_callback(partial.collect)
+        partial.prepare(self.mol)
+        analyzer.analyze()
+        partial.merge_state(state)
+        self.assertEqual(partial.count, 24)
+        self.assertTrue(numpy.allclose(partial.rmsf, rmsf.rmsf))
+
+    def test_rmsf_collector_errors(self):
+        self._test_collector_error(RMSFCollector('x > 0'))
+        ref = Molecule.create()
+        ref.load(data('water.psf'))
+        self._test_collector_error(RMSFCollector('noh', Selection('all', ref)))
+
+    def test_gyration_collector(self):
+        # Test gyration collector
+        self._test_readers(self._test_gyration_collector)
+
+    def _test_gyration_collector(self, reader):
+        dset = DataSet()
+        dset.add_collector(GyrationCollector('all', name='all'))
+        dset.add_collector(GyrationCollector('x > 0', name='dynamic'))
+        analyzer = Analyzer(self.mol, [data('water.1.dcd')], chunk=5, reader=reader)
+        analyzer.add_dataset(dset)
+        analyzer.analyze()
+
+        records = dset.records
+        coords = DCDReader(data('water.1.dcd')).read().astype(float)
+        masses = numpy.array([15.9994, 1.008, 1.008] * 7)
+        com = (coords * masses[:, None]).sum(axis=1) / masses.sum()
+        rg = numpy.sqrt((((coords - com[:, None]) ** 2).sum(axis=2) * masses).sum(axis=1) / masses.sum())
+        self.assertTrue(numpy.allclose(records['all.rg'], rg))
+        moments = numpy.array([records['all.moment%d' % i] for i in (1, 2, 3)]).T
+        self.assertTrue(numpy.allclose(moments.sum(axis=1), rg ** 2))
+        self.assertTrue((numpy.diff(moments, axis=1) >= 0).all())
+        self.assertTrue(numpy.allclose(records['all.asphericity'], moments[:, 2] - moments[:, :2].mean(axis=1)))
+
+        # Test frame collection provides the same data
+        self._test_chunk_collection(dset.collectors[1:], reader)
+
+    def test_batch_collectors(self):
+        # Test batch collectors provide the same data as collectors for frames
+        ref = Molecule.create()
+        ref.load(data('water.psf'))
+        ref.load(data('water.pdb'))
+        collectors = [XCoordCollector('resid 2'), YCoordCollector('resid 2'), ZCoordCollector('resid 2'),
+                      DistanceCollector('index 0', 'resid 3'), AngleCollector('index 0', 'resid 2', 'index 5'),
+                      DihedralCollector('resid 1', 'index 4', 'resid 3', 'index 10'),
+                      RMSDCollector('noh', Selection('noh', ref))]
+        self._test_chunk_collection(collectors)
+
+    def test_shared_results(self):
+        # Test collectors with the same selections compute the centers only once per frame or chunk
+        dset = DataSet()
+        dset.add_collector(XCoordCollector('resid 2'))
+        dset.add_collector(YCoordCollector('resid 2'))
+        dset.add_collector(DistanceCollector('resid 2', 'x > 0'))
+        dset.add_collector(AngleCollector('x > 0', 'resid 2', 'index 0'))
+        analyzer = Analyzer(self.mol, [data('water.1.dcd')], chunk=5)
+        analyzer.add_dataset(dset)
+        with patch.object(CompiledSelection, '_chunk_centers', autospec=True,
+                          side_effect=CompiledSelection._chunk_centers) as chunk_centers:
+            with patch.object(CompiledSelection, '_chunk_indices', autospec=True,
+                              side_effect=CompiledSelection._chunk_indices) as chunk_indices:
+                analyzer.analyze()
+        # 3 selections in 3 chunks
+        self.assertEqual(chunk_centers.call_count, 9)
+        # Single dynamic selection in 3 chunks
+        self.assertEqual(chunk_indices.call_count, 3)
+
+        # Results are the same as with separate computations
+        for collector in dset.collectors[1:]:
+            single = DataSet()
+            single.add_collector(collector)
+            analyzer = Analyzer(self.mol, [data('water.1.dcd')], chunk=5)
+            analyzer.add_dataset(single)
+            analyzer.analyze()
+            self.assertTrue(numpy.allclose(single.records[collector.name], dset.records[collector.name]))
+
+    def test_shared_results_step(self):
+        # Test centers are computed only once per frame
+        centers = []
+        selections = [CompiledSelection('resid 2'), CompiledSelection('resid 2'), CompiledSelection('x > 0')]
+
+        def callback(step):
+            centers.append([s.center(step) for s in selections])
+
+        analyzer = Analyzer(self.mol, [data('water.1.dcd')], chunk=5)
+        analyzer.add_callback(callback)
+        with patch.object(CompiledSelection, '_center', autospec=True,
+                          side_effect=CompiledSelection._center) as center:
+            analyzer.analyze()
+        self.assertEqual(center.call_count, 24)
+        self.assertTrue(all(numpy.array_equal(c[0], c[1]) for c in centers))
+
+    def test_compiled_selection(self):
+        # Test detection of selections which depend on coordinates
+        self.assertFalse(CompiledSelection('all').dynamic)
+        self.assertFalse(CompiledSelection('resid 1 to 4 and noh').dynamic)
+        self.assertFalse(CompiledSelection('same residue as name OH2').dynamic)
+        self.assertTrue(CompiledSelection('within 3 of resid 1').dynamic)
+        self.assertTrue(CompiledSelection('exwithin 3 of resid 1').dynamic)
+        self.assertTrue(CompiledSelection('same residue as (within 3 of resid 1)').dynamic)
+        self.assertTrue(CompiledSelection('x < 0').dynamic)
+        self.assertTrue(CompiledSelection('sqr(z) > 4').dynamic)
+
+        # Test the indexes are resolved once for the static selection
+        sel = CompiledSelection('resid 2')
+        sel.prepare(self.mol)
+        self.assertEqual(list(sel.indices(self.mol)), [3, 4, 5])
+
+    def test_dynamic_selections(self):
+        # Test collectors with selections which depend on coordinates
+        self._test_readers(self._test_dynamic_selections)
+
+    def _test_dynamic_selections(self, reader):
+        dset = DataSet()
+        dset.add_collector(XCoordCollector('x < 0'))
+        dset.add_collector(DistanceCollector('index 0', 'x > 0'))
+        centers = []
+
+        def callback(step):
+            # Compute the data from scratch
+            center0 = measure.center(Selection('index 0', step.molecule))
+            center1 = measure.center(Selection('x < 0', step.molecule))
+            center2 = measure.center(Selection('x > 0', step.molecule))
+            centers.append([step.frame, center1[0], measure.coords_distance(center0, center2)])
+
+        analyzer = Analyzer(self.mol, [data('water.1.dcd')], chunk=5, reader=reader)
+        analyzer.add_dataset(dset)
+        analyzer.add_callback(callback)
+        analyzer.analyze()
+
+        self.assertTrue(numpy.allclose(dset.data, centers))
+
     def _test_collector_error(self, collector):
         dset = DataSet()
         dset.add_collector(collector)
@@ -82,8 +437,52 @@ class TestCollectors(PyvmdTestCase):
         self._test_collector_error(DihedralCollector('index 0', 'index 1', 'none', 'index 2'))
         self._test_collector_error(DihedralCollector('index 0', 'index 1', 'index 2', 'none'))
 
+    def _test_periodic_collectors(self, filename, unitcells, reader):
+        # Compare periodic collectors with measure functions
+        dset = DataSet()
+        dset.add_collector(DistanceCollector('index 0', 'index 4', pbc=True, name='distance'))
+        dset.add_collector(AngleCollector('index 0', 'index 4', 'index 9', pbc=True, name='angle'))
+        dset.add_collector(DihedralCollector('index 0', 'index 4', 'index 9', 'index 13', pbc=True, name='dihedral'))
+        analyzer = Analyzer(self.mol, [filename], chunk=5, reader=reader)
+        analyzer.add_dataset(dset)
+        analyzer.analyze()
+
+        atoms = DCDReader(filename).coords[:, [0, 4, 9, 13]].transpose(1, 0, 2)
+        numpy.testing.assert_allclose(dset.records['distance'],
+                                      measure.coords_distances(atoms[0], atoms[1], unitcells), rtol=1e-5)
+        numpy.testing.assert_allclose(dset.records['angle'],
+                                      measure.coords_angles(*atoms[:3], unitcell=unitcells), rtol=1e-5)
+        numpy.testing.assert_allclose(dset.records['dihedral'],
+                                      measure.coords_dihedrals(*atoms, unitcell=unitcells), rtol=1e-5)
+        # Periodic images are closer
+        self.assertTrue((dset.records['distance'] < measure.coords_distances(atoms[0], atoms[1])).all())
+
+    def test_periodic_collectors(self):
+        # Test collectors with periodic boundary conditions
+        dummy, filename = mkstemp(prefix='pyvmd_test_', suffix='.dcd')
+        self.addCleanup(lambda: os.unlink(filename))
+        coords = DCDReader(data('water.1.dcd')).read()
+        # Unit cells are smaller than the system, store them with angles in the order of DCD file
+        unitcells = numpy.array([(3.0 + 0.1 * i, 3.5, 4.0, 80.0, 90.0, 100.0) for i in xrange(len(coords))])
+        write_dcd(filename, coords, unitcells=unitcells[:, [0, 5, 1, 4, 3, 2]])
+        self._test_periodic_collectors(filename, unitcells, DCDReader)
+
+        # Unit cells of frames loaded by VMD
+        unitcell = {'a': 3.0, 'b': 3.5, 'c': 4.0, 'alpha': 80.0, 'beta': 90.0, 'gamma': 100.0}
+        with patch('pyvmd.molecules._molecule.get_periodic', return_value=unitcell):
+            self._test_periodic_collectors(filename, (3.0, 3.5, 4.0, 80.0, 90.0, 100.0), None)
+
+    def test_periodic_collectors_error(self):
+        # Test periodic collectors raise error if trajectory doesn't have unit cell
+        self._test_collector_error(DistanceCollector('index 0', 'index 4', pbc=True))
+        self._test_collector_error(AngleCollector('index 0', 'index 4', 'index 9', pbc=True))
+        self._test_collector_error(DihedralCollector('index 0', 'index 4', 'index 9', 'index 13', pbc=True))
+
     def test_rmsd_collector(self):
         # Test RMSD collector
+        self._test_readers(self._test_rmsd_collector)
+
+    def _test_rmsd_collector(self, reader):
         ref = Molecule.create()
         ref.load(data('water.psf'))
         ref.load(data('water.pdb'))
@@ -91,8 +490,11 @@ class TestCollectors(PyvmdTestCase):
         dset.add_collector(RMSDCollector('all', Selection('all', ref)))
         dset.add_collector(RMSDCollector('all and name OH2', Selection('all and name OH2', ref)))
         dset.add_collector(RMSDCollector('all and noh', Selection('all and noh', ref), name='noh'))
-        analyzer = Analyzer(self.mol, [data('water.1.dcd')])
+        analyzer = Analyzer(self.mol, [data('water.1.dcd')], chunk=5, reader=reader)
         analyzer.add_dataset(dset)
+        # Check the molecule frames are not modified
+        frames = []
+        analyzer.add_callback(lambda step: frames.append(len(step.molecule.frames)))
         analyzer.analyze()
 
         # Write data to check result
@@ -100,3 +502,4 @@ class TestCollectors(PyvmdTestCase):
         dset.write(buf)
         # Check the result
         self.assertEqual(buf.getvalue(), open(data('rmsd.dat')).read())
+        self.assertEqual(frames, [5] * 10 + [2] * 2 if reader is None else [1] * 12)
@@ -2,14 +2,16 @@
 Tests for data sets.
 """
 import os
+import struct
 from cStringIO import StringIO
 from tempfile import mkstemp
 
 import numpy
-from mock import Mock
+from mock import Mock, patch
+from numpy.lib.format import read_magic
 
 from pyvmd.collectors import Collector
-from pyvmd.datasets import DataSet
+from pyvmd.datasets import DataSet, FORMAT_COLUMNS, FORMAT_NPY, FORMAT_NPZ, FORMAT_TEXT, load_data, StreamDataSet
 
 from .utils import data, PyvmdTestCase
 
@@ -26,6 +28,25 @@ class SimpleTestCollector(Collector):
         return self.results.pop(0)
 
 
+class SimpleBatchCollector(Collector):
+    """
+    Simple collector which returns given data for chunks.
+    """
+    batch = True
+
+    def __init__(self, results, name):
+        super(SimpleBatchCollector, self).__init__(name)
+        self.results = results
+
+    def collect(self, step):
+        raise AssertionError("Batch collector shouldn't be called for frames.")
+
+    def collect_chunk(self, chunk):
+        result = self.results[:len(chunk)]
+        del self.results[:len(chunk)]
+        return result
+
+
 class TestDataSet(PyvmdTestCase):
     """
     Test `DataSet` object.
@@ -78,6 +99,199 @@ class TestDataSet(PyvmdTestCase):
                               [4, -15.4, 0.5]))
         self.assertTrue(numpy.array_equal(dset.data, result))
 
+    def test_collect_chunk(self):
+        # Test dataset with both batch and frame collectors
+        dset = DataSet()
+        dset.add_collector(SimpleTestCollector([5.0, -0.9, -42.0, -204.54], 'first'))
+        dset.add_collector(SimpleBatchCollector([3.5, 0.5, 0.01, 0.1], 'second'))
+
+        # Collect the data
+        dset.collect_chunk(Mock(frames=[0, 1, 2], __len__=lambda self: 3))
+        dset.collect(Mock(frame=0))
+        dset.collect(Mock(frame=1))
+        # Data are stored at the end of chunk
+        self.assertEqual(len(dset.data), 0)
+        dset.collect(Mock(frame=2))
+        dset.collect_chunk(Mock(frames=[3], __len__=lambda self: 1))
+        dset.collect(Mock(frame=3))
+
+        result = numpy.array(([0, 5.0, 3.5],
+                              [1, -0.9, 0.5],
+                              [2, -42.0, 0.01],
+                              [3, -204.54, 0.1]))
+        self.assertTrue(numpy.array_equal(dset.data, result))
+
+    def test_add_rows(self):
+        # Test adding block of rows larger than the array size step.
+        dset = DataSet()
+        dset.step = 2
+        dset.add_collector(SimpleTestCollector([], 'first'))
+
+        dset._add_rows(numpy.array([(0, 5.0), (1, -0.9), (2, -42.0)], dtype=dset.dtype))
+        dset._add_rows(numpy.empty(0, dtype=dset.dtype))
+        dset._add_rows(numpy.array([(3, -204.54)], dtype=dset.dtype))
+
+        result = numpy.array(([0, 5.0], [1, -0.9], [2, -42.0], [3, -204.54]))
+        self.assertTrue(numpy.array_equal(dset.data, result))
+
+    def test_dtype(self):
+        # Test data are stored in data types of collectors
+        dset = DataSet()
+        first = SimpleTestCollector([0.1, 0.2], 'first')
+        first.dtype = numpy.float32
+        dset.add_collector(first)
+        dset.add_collector(SimpleBatchCollector([3.5, 0.5], 'second'))
+        self.assertEqual(dset.dtype, numpy.dtype([('frame', numpy.int64), ('first', numpy.float32),
+                                                  ('second', numpy.float64)]))
+
+        # Frame numbers which can't be represented by floats are stored exactly
+        dset.collect_chunk(Mock(frames=[2 ** 60, 2 ** 60 + 1], __len__=lambda self: 2))
+        dset.collect(Mock(frame=2 ** 60))
+        dset.collect(Mock(frame=2 ** 60 + 1))
+
+        records = dset.records
+        self.assertEqual(records.dtype, dset.dtype)
+        self.assertEqual(list(records['frame']), [2 ** 60, 2 ** 60 + 1])
+        self.assertEqual(list(records['first']), [numpy.float32(0.1), numpy.float32(0.2)])
+        self.assertEqual(list(records['second']), [3.5, 0.5])
+        self.assertEqual(dset.data.dtype, numpy.float64)
+        self.assertEqual(dset.data.shape, (2, 3))
+
+    def test_data_cache(self):
+        # Test data array is cached until new rows are added
+        dset = DataSet()
+        dset.add_collector(SimpleTestCollector([0.5, 1.5, 2.5], 'value'))
+        dset.collect(Mock(frame=0))
+        data = dset.data
+        self.assertIs(dset.data, data)
+        self.assertFalse(data.flags.writeable)
+        dset.collect(Mock(frame=1))
+        self.assertIsNot(dset.data, data)
+        self.assertTrue(numpy.array_equal(dset.data, [[0, 0.5], [1, 1.5]]))
+        dset.set_state(dset.get_state())
+        self.assertTrue(numpy.array_equal(dset.data, [[0, 0.5], [1, 1.5]]))
+
+    def test_data_view(self):
+        # Test data array is a view of records if all collectors have the same data type
+        dset = DataSet()
+        dset.collectors[0].dtype = numpy.float64
+        dset.add_collector(SimpleTestCollector([0.5, 1.5], 'value'))
+        self.assertEqual(dset.data.shape, (0, 2))
+        dset.collect(Mock(frame=0))
+        dset.collect(Mock(frame=1))
+        data = dset.data
+        self.assertTrue(numpy.array_equal(data, [[0, 0.5], [1, 1.5]]))
+        self.assertTrue(numpy.shares_memory(data, dset.records))
+        data[1, 1] = 2.5
+        self.assertEqual(list(dset.records['value']), [0.5, 2.5])
+
+        # Data are copied if collectors store columns in a block
+        block = SimpleBatchCollector([], 'block')
+        block.columns = ('a', 'b')
+        block.block = True
+        dset = DataSet()
+        dset.collectors[0].dtype = numpy.float64
+        dset.add_collector(block)
+        self.assertFalse(numpy.shares_memory(dset.data, dset.records))
+
+    def test_block_collectors(self):
+        # Test collectors which store columns in a block
+        dset = DataSet()
+        first = SimpleBatchCollector([(1.0, 2.0), (3.0, 4.0)], 'first')
+        first.columns = ('a', 'b')
+        first.block = True
+        first.dtype = numpy.float32
+        dset.add_collector(first)
+        dset.add_collector(SimpleTestCollector([7.0, 8.0], 'second'))
+        self.assertEqual(dset.dtype, numpy.dtype([('frame', numpy.int64), ('first', numpy.float32, (2, )),
+                                                  ('second', numpy.float64)]))
+
+        dset.collect_chunk(Mock(frames=[0, 1], __len__=lambda self: 2))
+        dset.collect(Mock(frame=0))
+        dset.collect(Mock(frame=1))
+
+        self.assertTrue(numpy.array_equal(dset.records['first'], [[1.0, 2.0], [3.0, 4.0]]))
+        self.assertTrue(numpy.array_equal(dset.data, [[0, 1.0, 2.0, 7.0], [1, 3.0, 4.0, 8.0]]))
+        buf = StringIO()
+        dset.write(buf)
+        self.assertEqual(buf.getvalue(), '   frame    first.a    first.b     second\n'
+                                         '       0     1.0000     2.0000     7.0000\n'
+                                         '       1     3.0000     4.0000     8.0000\n')
+        # Binary formats split the block into columns as well
+        for fmt in (FORMAT_NPY, FORMAT_COLUMNS):
+            dset.write(self.tmpfile, fmt=fmt)
+            result = load_data(self.tmpfile)
+            self.assertEqual(result.keys(), ['frame', 'first.a', 'first.b', 'second'])
+            self.assertEqual(list(result['first.a']), [1.0, 3.0])
+            self.assertEqual(list(result['first.b']), [2.0, 4.0])
+
+    def test_duplicate_name(self):
+        dset = DataSet()
+        dset.add_collector(SimpleTestCollector([], 'first'))
+        self.assertRaises(ValueError, dset.add_collector, SimpleTestCollector([], 'first'))
+        # Columns of collectors which return vectors can't clash either
+        dset.add_collector(SimpleTestCollector([], 'second.x'))
+        second = SimpleTestCollector([], 'second')
+        second.columns = ('x', 'y')
+        self.assertRaises(ValueError, dset.add_collector, second)
+
+    def test_vector_collectors(self):
+        # Test collectors which return vectors are expanded into columns
+        dset = DataSet()
+        first = SimpleTestCollector([(1.0, 2.0), (3.0, 4.0), (5.0, 6.0)], 'first')
+        first.columns = ('a', 'b')
+        dset.add_collector(first)
+        second = SimpleBatchCollector([(0.1, 0.2, 0.3), (0.4, 0.5, 0.6), (0.7, 0.8, 0.9)], 'second')
+        second.columns = ('x', 'y', 'z')
+        dset.add_collector(second)
+        dset.add_collector(SimpleTestCollector([7.0, 8.0, 9.0], 'third'))
+        self.assertEqual(dset.dtype.names, ('frame', 'first.a', 'first.b', 'second.x', 'second.y', 'second.z', 'third'))
+
+        dset.collect_chunk(Mock(frames=[0, 1], __len__=lambda self: 2))
+        dset.collect(Mock(frame=0))
+        dset.collect(Mock(frame=1))
+        dset.collect_chunk(Mock(frames=[2], __len__=lambda self: 1))
+        dset.collect(Mock(frame=2))
+
+        result = numpy.array(([0, 1.0, 2.0, 0.1, 0.2, 0.3, 7.0],
+                              [1, 3.0, 4.0, 0.4, 0.5, 0.6, 8.0],
+                              [2, 5.0, 6.0, 0.7, 0.8, 0.9, 9.0]))
+        self.assertTrue(numpy.array_equal(dset.data, result))
+
+        buf = StringIO()
+        dset.write(buf)
+        self.assertEqual(buf.getvalue().splitlines()[0].split(),
+                         ['frame', 'first.a', 'first.b', 'second.x', 'second.y', 'second.z', 'third'])
+
+    def test_growth(self):
+        # Test the data array grows geometrically
+        dset = DataSet()
+        dset.step = 2
+        for frame in xrange(5):
+            dset._add_rows(numpy.array([(frame, )], dtype=dset.dtype))
+        self.assertEqual(dset._data.shape, (8, ))
+        self.assertTrue(numpy.array_equal(dset.data, numpy.array(([0], [1], [2], [3], [4]))))
+
+    def test_reserve(self):
+        # Test pre-allocation of the data array
+        dset = DataSet()
+        dset.add_collector(SimpleTestCollector([5.0, -0.9, -42.0], 'first'))
+        dset.reserve(2)
+        self.assertEqual(dset._data.shape, (2, ))
+        self.assertEqual(dset.data.shape, (0, 2))
+
+        dset.collect(Mock(frame=0))
+        dset.collect(Mock(frame=1))
+        self.assertEqual(dset._data.shape, (2, ))
+        # Reserve space for more rows
+        dset.reserve(1)
+        self.assertEqual(dset._data.shape, (3, ))
+        dset.collect(Mock(frame=2))
+        self.assertEqual(dset._data.shape, (3, ))
+
+        result = numpy.array(([0, 5.0], [1, -0.9], [2, -42.0]))
+        self.assertTrue(numpy.array_equal(dset.data, result))
+
     def test_write(self):
         dset = DataSet()
 
@@ -104,3 +318,205 @@ class TestDataSet(PyvmdTestCase):
         buf = StringIO()
         dset.write(buf)
         self.assertEqual(buf.getvalue(), open(data('dataset.dat')).read())
+
+    def _create_dataset(self):
+        # Returns dataset with data
+        dset = DataSet()
+        dset.add_collector(SimpleTestCollector([5.0, -0.9, -42.0], 'first'))
+        dset.add_collector(SimpleTestCollector([3.5, 0.5, 0.01], 'second'))
+        for frame in xrange(3):
+            dset.collect(Mock(frame=frame))
+        return dset
+
+    def _test_load(self, result):
+        self.assertEqual(result.keys(), ['frame', 'first', 'second'])
+        self.assertEqual(list(result['frame']), [0, 1, 2])
+        self.assertEqual(list(result['first']), [5.0, -0.9, -42.0])
+        self.assertEqual(list(result['second']), [3.5, 0.5, 0.01])
+
+    def test_load_text(self):
+        dset = self._create_dataset()
+        dset.write(self.tmpfile)
+        result = load_data(self.tmpfile)
+        self.assertEqual(result.keys(), ['frame', 'first', 'second'])
+        self.assertEqual(list(result['frame']), [0, 1, 2])
+        self.assertEqual(list(result['second']), [3.5, 0.5, 0.01])
+        self.assertRaises(ValueError, load_data, self.tmpfile, mmap=True)
+
+    def test_npy(self):
+        dset = self._create_dataset()
+        dset.write(self.tmpfile, FORMAT_NPY)
+        self.assertEqual(list(numpy.load(self.tmpfile)['first']), [5.0, -0.9, -42.0])
+        self._test_load(load_data(self.tmpfile))
+        result = load_data(self.tmpfile, mmap=True)
+        self.assertIsInstance(result['first'], numpy.memmap)
+        self._test_load(result)
+
+    def test_npz(self):
+        dset = self._create_dataset()
+        dset.write(self.tmpfile, FORMAT_NPZ)
+        self.assertEqual(list(numpy.load(self.tmpfile)['first']), [5.0, -0.9, -42.0])
+        self._test_load(load_data(self.tmpfile))
+        self.assertRaises(ValueError, load_data, self.tmpfile, mmap=True)
+
+    def test_columns(self):
+        dset = self._create_dataset()
+        dset.write(self.tmpfile, FORMAT_COLUMNS)
+        self.assertEqual(list(numpy.load(self.tmpfile)['first']), [5.0, -0.9, -42.0])
+        self.assertEqual(numpy.load(self.tmpfile)['frame'].dtype, numpy.int64)
+        self._test_load(load_data(self.tmpfile))
+        result = load_data(self.tmpfile, mmap=True)
+        self.assertIsInstance(result['first'], numpy.memmap)
+        self._test_load(result)
+
+    def test_load_formats(self):
+        # Test data loaded from all formats are the same
+        def collect(dset):
+            block = SimpleBatchCollector([(1.0, 2.0), (3.0, 4.0)], 'block')
+            block.columns = ('a', 'b')
+            block.block = True
+            dset.add_collector(block)
+            vector = SimpleTestCollector([(5.0, 6.0), (7.0, 8.0)], 'vector')
+            vector.columns = ('c', 'd')
+            dset.add_collector(vector)
+            dset.collect_chunk(Mock(frames=[0, 1], __len__=lambda self: 2))
+            dset.collect(Mock(frame=0))
+            dset.collect(Mock(frame=1))
+
+        dset = DataSet()
+        collect(dset)
+        stream_file = self.tmpfile + '.npy'
+        self.addCleanup(lambda: os.unlink(stream_file))
+        stream = StreamDataSet(stream_file, fmt=FORMAT_NPY)
+        collect(stream)
+        stream.close()
+
+        results = [load_data(stream_file)]
+        for fmt in (FORMAT_TEXT, FORMAT_NPY, FORMAT_NPZ, FORMAT_COLUMNS):
+            dset.write(self.tmpfile, fmt)
+            results.append(load_data(self.tmpfile))
+        for result in results:
+            self.assertEqual(result.keys(), ['frame', 'block.a', 'block.b', 'vector.c', 'vector.d'])
+            self.assertEqual(result['frame'].dtype, numpy.int64)
+            self.assertEqual(list(result['frame']), [0, 1])
+            for name, values in result.items():
+                self.assertEqual(values.shape, (2, ))
+                self.assertTrue(numpy.array_equal(values, results[0][name]))
+
+    def test_columns_empty(self):
+        dset = DataSet()
+        dset.write(self.tmpfile, FORMAT_COLUMNS)
+        result = load_data(self.tmpfile, mmap=True)
+        self.assertEqual(result.keys(), ['frame'])
+        self.assertEqual(len(result['frame']), 0)
+
+
+class TestStreamDataSet(PyvmdTestCase):
+    """
+    Test `StreamDataSet` object.
+    """
+    def setUp(self):
+        dummy, filename = mkstemp(prefix='pyvmd_test_')
+        self.tmpfile = filename
+        self.addCleanup(lambda: os.unlink(self.tmpfile))
+
+    def _add_collectors(self, dset):
+        first = SimpleTestCollector([5.0, -0.9, -42.0, -204.54], 'first')
+        first.header_fmt = '%20s'
+        first.data_fmt = '% 20d'
+        dset.add_collector(first)
+        dset.add_collector(SimpleTestCollector([3.5, 0.5, 0.01, 0.1], 'second'))
+        dset.add_collector(SimpleTestCollector([2.9, 5.9, 8.9, 15.89], 'last'))
+
+    def test_text(self):
+        dset = StreamDataSet(self.tmpfile, flush_rows=2)
+        self._add_collectors(dset)
+        expected = open(data('dataset.dat')).read().splitlines(True)
+
+        dset.collect(Mock(frame=0))
+        self.assertEqual(open(self.tmpfile).read(), '')
+        dset.collect(Mock(frame=1))
+        # The rows are flushed
+        self.assertEqual(open(self.tmpfile).read(), ''.join(expected[:3]))
+        self.assertEqual(len(dset.data), 0)
+        dset.collect(Mock(frame=2))
+        self.assertEqual(len(dset.data), 1)
+        self.assertEqual(open(self.tmpfile).read(), ''.join(expected[:3]))
+        dset.collect(Mock(frame=3))
+        dset.close()
+        self.assertEqual(open(self.tmpfile).read(), ''.join(expected))
+
+    def test_file_like(self):
+        buf = StringIO()
+        dset = StreamDataSet(buf, flush_rows=3)
+        self._add_collectors(dset)
+        for frame in xrange(4):
+            dset.collect(Mock(frame=frame))
+        dset.close()
+        self.assertEqual(buf.getvalue(), open(data('dataset.dat')).read())
+
+    def test_empty(self):
+        dset = StreamDataSet(self.tmpfile)
+        self._add_collectors(dset)
+        dset.close()
+        self.assertEqual(open(self.tmpfile).read(), open(data('dataset.dat')).readline())
+
+    def test_npy(self):
+        dset = StreamDataSet(self.tmpfile, fmt=FORMAT_NPY, flush_rows=2)
+        self._add_collectors(dset)
+        dset.collect(Mock(frame=0))
+        dset.collect(Mock(frame=1))
+        dset.collect(Mock(frame=2))
+
+        # The file is valid after the flush
+        result = numpy.load(self.tmpfile)
+        self.assertEqual(result.dtype.names, ('frame', 'first', 'second', 'last'))
+        self.assertEqual(list(result['frame']), [0, 1])
+        self.assertEqual(list(result['second']), [3.5, 0.5])
+
+        dset.collect(Mock(frame=3))
+        dset.close()
+        result = load_data(self.tmpfile)
+        self.assertEqual(result.keys(), ['frame', 'first', 'second', 'last'])
+        self.assertEqual(list(result['frame']), [0, 1, 2, 3])
+        self.assertEqual(list(result['first']), [5.0, -0.9, -42.0, -204.54])
+        self.assertEqual(list(result['last']), [2.9, 5.9, 8.9, 15.89])
+
+    def test_npy_wide(self):
+        # Test NPY header of data type with many fields, which doesn't fit into version 1.0 of the format
+        dset = StreamDataSet(self.tmpfile, fmt=FORMAT_NPY, flush_rows=2)
+        wide = SimpleTestCollector([range(5000), range(1, 5001), range(2, 5002)], 'wide')
+        wide.columns = ['column%d' % index for index in xrange(5000)]
+        dset.add_collector(wide)
+        dset.collect(Mock(frame=0))
+        dset.collect(Mock(frame=1))
+        dset.collect(Mock(frame=2))
+        dset.close()
+        with open(self.tmpfile, 'rb') as handle:
+            self.assertEqual(read_magic(handle), (2, 0))
+            header_length, = struct.unpack('<I', handle.read(4))
+        # Data are aligned
+        self.assertEqual((12 + header_length) % 64, 0)
+        result = numpy.load(self.tmpfile)
+        self.assertEqual(len(result.dtype.names), 5001)
+        self.assertEqual(list(result['frame']), [0, 1, 2])
+        self.assertEqual(list(result['wide.column4999']), [4999, 5000, 5001])
+
+    def test_flush_time(self):
+        with patch('pyvmd.datasets.time.time', return_value=100):
+            dset = StreamDataSet(self.tmpfile, flush_time=10)
+        self._add_collectors(dset)
+        with patch('pyvmd.datasets.time.time', return_value=105):
+            dset.collect(Mock(frame=0))
+        self.assertEqual(len(dset.data), 1)
+        with patch('pyvmd.datasets.time.time', return_value=110):
+            dset.collect(Mock(frame=1))
+        self.assertEqual(len(dset.data), 0)
+        self.assertEqual(len(open(self.tmpfile).readlines()), 3)
+
+    def test_reserve(self):
+        # Stream dataset doesn't allocate space for more rows than flushed at once
+        dset = StreamDataSet(self.tmpfile, flush_rows=10)
+        dset.reserve(1000000)
+        self.assertEqual(dset._data.shape, (10, ))
+        dset.close()
@@ -0,0 +1,88 @@
+"""
+Tests for DCD reader.
+
+These tests do not require VMD.
+"""
+import os
+import unittest
+from tempfile import mkstemp
+
+import numpy
+
+from pyvmd.dcd import DCDReader
+
+from .dcd_utils import write_dcd
+
+# Do not import utils, they require VMD.
+DATA_DIR = os.path.join(os.path.dirname(__file__), 'data')
+
+
+class TestDCDReader(unittest.TestCase):
+    """
+    Test `DCDReader` class.
+    """
+    def setUp(self):
+        dummy, filename = mkstemp(prefix='pyvmd_test_', suffix='.dcd')
+        self.tmpfile = filename
+        self.addCleanup(lambda: os.unlink(self.tmpfile))
+
+    def test_header(self):
+        reader = DCDReader(os.path.join(DATA_DIR, 'water.1.dcd'))
+        self.assertEqual(reader.numatoms, 21)
+        self.assertEqual(reader.numframes, 12)
+        self.assertEqual(len(reader), 12)
+        self.assertEqual(reader.istart, 5)
+        self.assertEqual(reader.nsavc, 5)
+        self.assertAlmostEqual(reader.timestep, 0.001)
+        self.assertFalse(reader.has_unitcell)
+        self.assertEqual(list(reader.fixed), [])
+        self.assertIsNone(reader.unitcell(0))
+        self.assertIsNone(reader.unitcells())
+
+    def test_coords(self):
+        reader = DCDReader(os.path.join(DATA_DIR, 'water.1.dcd'))
+        coords = reader.coords
+        self.assertEqual(coords.shape, (12, 21, 3))
+        # Check the data are mapped, not copied
+        self.assertTrue(numpy.may_share_memory(coords, reader.map))
+        numpy.testing.assert_allclose(coords[0, 0], (-1.4911567, 1.9192669, 1.2570608))
+        numpy.testing.assert_allclose(coords[0].mean(axis=0), (-0.0017, -0.0030, 0.0019), atol=1e-4)
+        numpy.testing.assert_allclose(coords[-1, 0, 0], -1.3421925)
+
+        # Test read
+        numpy.testing.assert_allclose(reader.read(0, None, 2)[:, 0, 0],
+                                      [-1.4911567, -1.4858487, -1.4746015, -1.4535547, -1.4120502, -1.3674825])
+        self.assertEqual(reader.read(10, 20).shape, (2, 21, 3))
+        self.assertEqual(reader.read(20, 30).shape, (0, 21, 3))
+
+    def test_fixed_atoms(self):
+        frames = numpy.arange(4 * 5 * 3, dtype=numpy.float32).reshape(4, 5, 3)
+        # Fixed atoms do not move
+        frames[:, 1] = frames[0, 1]
+        frames[:, 3] = frames[0, 3]
+        write_dcd(self.tmpfile, frames, fixed=(1, 3))
+
+        reader = DCDReader(self.tmpfile)
+        self.assertEqual(reader.numframes, 4)
+        self.assertEqual(list(reader.fixed), [1, 3])
+        self.assertRaises(ValueError, getattr, reader, 'coords')
+        numpy.testing.assert_array_equal(reader.read(), frames)
+        numpy.testing.assert_array_equal(reader.read(1, 4, 2), frames[1:4:2])
+
+    def test_unitcell(self):
+        frames = numpy.arange(2 * 3 * 3, dtype=numpy.float32).reshape(2, 3, 3)
+        # First cell stores angles, second one cosines
+        unitcells = [(10.0, 90.0, 20.0, 90.0, 90.0, 30.0), (11.0, 0.5, 21.0, 0.0, 0.0, 31.0)]
+        write_dcd(self.tmpfile, frames, unitcells=unitcells)
+
+        reader = DCDReader(self.tmpfile)
+        self.assertTrue(reader.has_unitcell)
+        numpy.testing.assert_array_equal(reader.coords, frames)
+        numpy.testing.assert_allclose(reader.unitcell(0), (10.0, 20.0, 30.0, 90.0, 90.0, 90.0))
+        numpy.testing.assert_allclose(reader.unitcell(1), (11.0, 21.0, 31.0, 90.0, 90.0, 60.0))
+        numpy.testing.assert_allclose(reader.unitcells(),
+                                      [(10.0, 20.0, 30.0, 90.0, 90.0, 90.0), (11.0, 21.0, 31.0, 90.0, 90.0, 60.0)])
+        self.assertEqual(reader.unitcells(1, 1).shape, (0, 6))
+
+    def test_invalid_file(self):
+        self.assertRaises(ValueError, DCDReader, os.path.join(DATA_DIR, 'water.pdb'))
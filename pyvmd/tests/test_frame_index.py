@@ -0,0 +1,112 @@
+"""
+Tests for frame index.
+
+These tests do not require VMD.
+"""
+import os
+import shutil
+import struct
+import unittest
+from tempfile import mkdtemp
+
+import numpy
+from mock import patch
+
+from pyvmd.dcd import DCDReader
+from pyvmd.frame_index import get_frame_index
+
+# Do not import utils, they require VMD.
+DATA_DIR = os.path.join(os.path.dirname(__file__), 'data')
+
+
+def _write_xtc(filename, numatoms, sizes, time_step=0.5):
+    """
+    Writes XTC file with frames of given sizes of compressed data. Content of the compressed data is not valid.
+    """
+    with open(filename, 'wb') as out:
+        for index, size in enumerate(sizes):
+            out.write(struct.pack('>iiif', 1995, numatoms, index, index * time_step))
+            out.write(struct.pack('>9f', *([0.0] * 9)))
+            out.write(struct.pack('>i', numatoms))
+            if numatoms <= 9:
+                out.write(struct.pack('>%df' % (3 * numatoms), *([0.0] * 3 * numatoms)))
+            else:
+                out.write(struct.pack('>f7i', 1000.0, *([0] * 7)))
+                out.write(struct.pack('>i', size))
+                out.write('\0' * ((size + 3) // 4 * 4))
+
+
+class TestFrameIndex(unittest.TestCase):
+    """
+    Test frame index.
+    """
+    def setUp(self):
+        self.tmpdir = mkdtemp(prefix='pyvmd_test_')
+        self.addCleanup(lambda: shutil.rmtree(self.tmpdir))
+
+    def test_dcd(self):
+        filename = os.path.join(self.tmpdir, 'water.1.dcd')
+        shutil.copy(os.path.join(DATA_DIR, 'water.1.dcd'), filename)
+        index = get_frame_index(filename)
+        self.assertEqual(len(index), 12)
+        self.assertAlmostEqual(index.timestep, 0.001)
+        self.assertEqual(index.end, os.path.getsize(filename))
+        # Check the offsets point to the frames
+        reader = DCDReader(filename)
+        with open(filename, 'rb') as handle:
+            handle.seek(index.offsets[3] + 4)
+            x = numpy.frombuffer(handle.read(4 * reader.numatoms), dtype='<f4')
+        numpy.testing.assert_array_equal(x, reader.coords[3, :, 0])
+        frame_size = index.offsets[1] - index.offsets[0]
+        self.assertEqual(index.byte_range(2, 5), (index.offsets[2], 3 * frame_size))
+        self.assertEqual(index.byte_range(10), (index.offsets[10], 2 * frame_size))
+        self.assertEqual(index.byte_range(20, 30), (index.end, 0))
+
+    def test_xtc(self):
+        filename = os.path.join(self.tmpdir, 'test.xtc')
+        _write_xtc(filename, 20, [13, 16, 1])
+        index = get_frame_index(filename)
+        self.assertEqual(len(index), 3)
+        self.assertEqual(index.timestep, 0.5)
+        self.assertEqual(list(index.offsets), [0, 108, 216])
+        self.assertEqual(index.end, 312)
+
+        # Incomplete frame is ignored
+        _write_xtc(filename, 20, [13, 16, 1, 40])
+        with open(filename, 'r+b') as out:
+            out.truncate(330)
+        self.assertEqual(len(get_frame_index(filename, cache=False)), 3)
+
+    def test_xtc_small(self):
+        filename = os.path.join(self.tmpdir, 'test.xtc')
+        _write_xtc(filename, 3, [0, 0])
+        index = get_frame_index(filename)
+        self.assertEqual(list(index.offsets), [0, 92])
+        self.assertEqual(index.end, 184)
+
+    def test_xtc_invalid(self):
+        filename = os.path.join(self.tmpdir, 'test.xtc')
+        with open(filename, 'wb') as out:
+            out.write('\0' * 100)
+        self.assertRaises(ValueError, get_frame_index, filename)
+
+    def test_cache(self):
+        filename = os.path.join(self.tmpdir, 'test.xtc')
+        _write_xtc(filename, 20, [13, 16])
+        index = get_frame_index(filename)
+        self.assertTrue(os.path.exists(filename + '.pyvmd-index'))
+
+        # Index is loaded from the cache
+        with patch.dict('pyvmd.frame_index.INDEXERS', {'.xtc': None}):
+            cached = get_frame_index(filename)
+        numpy.testing.assert_array_equal(cached.offsets, index.offsets)
+        self.assertEqual(cached.end, index.end)
+        self.assertEqual(cached.timestep, index.timestep)
+
+        # Index is rebuilt if the file changes
+        _write_xtc(filename, 20, [13, 16, 4])
+        os.utime(filename, (0, 0))
+        self.assertEqual(len(get_frame_index(filename)), 3)
+
+    def test_unsupported(self):
+        self.assertRaises(ValueError, get_frame_index, os.path.join(DATA_DIR, 'water.pdb'))
@@ -1,10 +1,15 @@
 """
 Tests for measure.
 """
+import itertools
+
+import numpy
 import VMD
 
 from pyvmd.atoms import Atom, Residue, Selection
-from pyvmd.measure import angle, center, dihedral, distance
+from pyvmd.measure import (angle, center, coords_angle, coords_angles, coords_dihedral, coords_dihedrals,
+                           coords_distance, coords_distances, coords_fit, coords_fit_rmsd, coords_gyration,
+                           coords_minimum_image, dihedral, distance, NeighborSearch, unitcell_vectors)
 
 from .utils import data, PyvmdTestCase
 
@@ -55,6 +60,44 @@ class TestMeasure(PyvmdTestCase):
         self.assertAlmostEqual(dihedral(a, c, b, d), 80.113001)
         self.assertAlmostEqual(dihedral(d, b, c, a), 80.113001)
 
+    def test_array_geometry(self):
+        # Test array variants of measure functions
+        a, b, c, d = [Atom(i).coords for i in (0, 4, 7, 10)]
+        # Arrays of shape (atoms, 3)
+        first = numpy.array([a, d, c])
+        second = numpy.array([b, c, b])
+        third = numpy.array([c, b, a])
+        fourth = numpy.array([d, a, d])
+        distances = coords_distances(first, second)
+        self.assertEqual(distances.shape, (3, ))
+        numpy.testing.assert_allclose(distances, [coords_distance(*i) for i in zip(first, second)])
+        numpy.testing.assert_allclose(distances[0], 4.4765141, rtol=1e-6)
+        angles = coords_angles(first, second, third)
+        self.assertEqual(angles.shape, (3, ))
+        numpy.testing.assert_allclose(angles, [coords_angle(*i) for i in zip(first, second, third)])
+        numpy.testing.assert_allclose(angles[0], 54.0939249, rtol=1e-6)
+        dihedrals = coords_dihedrals(first, second, third, fourth)
+        self.assertEqual(dihedrals.shape, (3, ))
+        numpy.testing.assert_allclose(dihedrals, [coords_dihedral(*i) for i in zip(first, second, third, fourth)])
+        numpy.testing.assert_allclose(dihedrals[0], -80.113001, rtol=1e-6)
+
+        # Arrays of shape (frames, atoms, 3) are broadcast against arrays of shape (atoms, 3)
+        frames = numpy.array([first, first + 1.0, first * 2.0])
+        distances = coords_distances(frames, second)
+        self.assertEqual(distances.shape, (3, 3))
+        numpy.testing.assert_allclose(distances, [coords_distances(f, second) for f in frames])
+        angles = coords_angles(frames, second, third)
+        self.assertEqual(angles.shape, (3, 3))
+        numpy.testing.assert_allclose(angles, [coords_angles(f, second, third) for f in frames])
+        dihedrals = coords_dihedrals(frames, second, third, fourth)
+        self.assertEqual(dihedrals.shape, (3, 3))
+        numpy.testing.assert_allclose(dihedrals, [coords_dihedrals(f, second, third, fourth) for f in frames])
+
+        # Scalar functions return floats
+        self.assertIsInstance(coords_distance(a, b), float)
+        self.assertIsInstance(coords_angle(a, b, c), float)
+        self.assertIsInstance(coords_dihedral(a, b, c, d), float)
+
     def test_center(self):
         # Test `center` function.
         sel = Selection('all')
@@ -73,3 +116,147 @@ class TestMeasure(PyvmdTestCase):
         # The manuall computation seems to differ a bit from the `atomsel.center`
         self.assertAlmostEqualSeqs(list(center(iter(sel))), [-0.0001905, 0.0004762, -0.0001429])
         self.assertAlmostEqualSeqs(list(center((Atom(i) for i in xrange(10)))), [-0.146, 0.3756, 0.3972])
+
+    def test_coords_fit(self):
+        # Test `coords_fit` function
+        ref = numpy.array([[0.0, 0.0, 0.0], [1.0, 0.0, 0.0], [0.0, 2.0, 0.0], [0.0, 0.0, 3.0]])
+        ref -= ref.mean(axis=0)
+        # Rotate and translate the reference
+        rotation = numpy.array([[0.0, -1.0, 0.0], [1.0, 0.0, 0.0], [0.0, 0.0, 1.0]])
+        moved = ref.dot(rotation.T) + (5.0, -3.0, 1.0)
+        numpy.testing.assert_allclose(coords_fit(moved, ref), ref, atol=1e-10)
+        # Mirror image isn't reflected
+        mirror = coords_fit(ref * (1, 1, -1), ref)
+        self.assertGreater(numpy.abs(mirror - ref).max(), 0.1)
+        self.assertAlmostEqual(numpy.sqrt(((mirror - ref) ** 2).sum() / 4), coords_fit_rmsd(ref * (1, 1, -1), ref))
+        # Test multiple frames
+        shifted = moved.copy()
+        shifted[0] += (0.0, 0.0, 0.4)
+        result = coords_fit(numpy.array([moved, shifted]), ref)
+        self.assertEqual(result.shape, (2, 4, 3))
+        numpy.testing.assert_allclose(result[0], ref, atol=1e-10)
+        self.assertAlmostEqual(numpy.sqrt(((result[1] - ref) ** 2).sum() / 4), coords_fit_rmsd(shifted, ref))
+
+    def test_coords_gyration(self):
+        # Test `coords_gyration` function
+        # Atoms on the axes, heavier atoms are closer to the center
+        coords = numpy.array([[2.0, 0.0, 0.0], [-2.0, 0.0, 0.0], [0.0, 0.5, 0.0], [0.0, -0.5, 0.0]]) + (1.0, 2.0, 3.0)
+        masses = numpy.array([1.0, 1.0, 4.0, 4.0])
+        moments = coords_gyration(coords, masses)
+        numpy.testing.assert_allclose(moments, [0.0, 0.2, 0.8], atol=1e-12)
+        # Rotation doesn't change the moments
+        rotation = numpy.array([[0.0, -1.0, 0.0], [1.0, 0.0, 0.0], [0.0, 0.0, 1.0]])
+        result = coords_gyration(numpy.array([coords, coords.dot(rotation.T)]), masses)
+        self.assertEqual(result.shape, (2, 3))
+        numpy.testing.assert_allclose(result, [moments, moments], atol=1e-12)
+
+    def test_coords_fit_rmsd(self):
+        # Test `coords_fit_rmsd` function
+        ref = numpy.array([[0.0, 0.0, 0.0], [1.0, 0.0, 0.0], [0.0, 2.0, 0.0], [0.0, 0.0, 3.0]])
+        ref -= ref.mean(axis=0)
+        # Rotate and translate the reference
+        rotation = numpy.array([[0.0, -1.0, 0.0], [1.0, 0.0, 0.0], [0.0, 0.0, 1.0]])
+        moved = ref.dot(rotation.T) + (5.0, -3.0, 1.0)
+        self.assertAlmostEqual(coords_fit_rmsd(moved, ref), 0.0)
+        # Mirror image can't be superposed by rotation
+        self.assertGreater(coords_fit_rmsd(ref * (1, 1, -1), ref), 0.1)
+        # Test multiple frames
+        shifted = moved.copy()
+        shifted[0] += (0.0, 0.0, 0.4)
+        result = coords_fit_rmsd(numpy.array([moved, shifted]), ref)
+        self.assertEqual(result.shape, (2, ))
+        self.assertAlmostEqual(result[0], 0.0)
+        self.assertGreater(result[1], 0.0)
+
+    def test_unitcell_vectors(self):
+        # Test `unitcell_vectors` function
+        numpy.testing.assert_allclose(unitcell_vectors((10.0, 20.0, 30.0, 90.0, 90.0, 90.0)),
+                                      [[10.0, 0.0, 0.0], [0.0, 20.0, 0.0], [0.0, 0.0, 30.0]])
+        # Rhombic dodecahedron
+        vectors = unitcell_vectors((10.0, 10.0, 10.0, 60.0, 60.0, 90.0))
+        numpy.testing.assert_allclose(vectors, [[10.0, 0.0, 0.0], [0.0, 10.0, 0.0], [5.0, 5.0, numpy.sqrt(50)]])
+
+    def _brute_search(self, coords, points, radius, unitcell=None):
+        # Returns set of pairs within radius found by checking all pairs and images
+        images = [(0, 0, 0)]
+        if unitcell is not None:
+            images = numpy.array(list(itertools.product((-2, -1, 0, 1, 2), repeat=3))).dot(unitcell_vectors(unitcell))
+        diff = coords[None, :, None] - points[:, None, None] - images
+        dist = numpy.sqrt((diff ** 2).sum(axis=-1)).min(axis=-1)
+        return set(zip(*numpy.nonzero(dist <= radius)))
+
+    def test_neighbor_search(self):
+        # Test `NeighborSearch` class
+        random = numpy.random.RandomState(42)
+        coords = random.uniform(0.0, 20.0, (300, 3))
+        points = random.uniform(-2.0, 22.0, (40, 3))
+        search = NeighborSearch(coords, 3.0)
+        for radius in (3.0, 1.5):
+            result = search.search(points, radius)
+            self.assertEqual(set(zip(*result)), self._brute_search(coords, points, radius))
+        # Test distances
+        result = search.search(points, distances=True)
+        numpy.testing.assert_allclose(result[2], numpy.sqrt(((coords[result[1]] - points[result[0]]) ** 2).sum(axis=1)))
+        # Test pairs
+        first, second = search.pairs(2.0)
+        self.assertTrue((first < second).all())
+        self.assertEqual(set(zip(first, second)),
+                         set((a, b) for a, b in self._brute_search(coords, coords, 2.0) if a < b))
+        self.assertRaises(AssertionError, search.search, points, 3.5)
+
+    def test_neighbor_search_periodic(self):
+        # Test `NeighborSearch` class with periodic boundary conditions
+        random = numpy.random.RandomState(42)
+        # Orthorhombic, triclinic and cells with less than 3 grid cells in a dimension
+        for unitcell in ((20.0, 22.0, 25.0, 90.0, 90.0, 90.0), (20.0, 22.0, 25.0, 70.0, 80.0, 100.0),
+                         (20.0, 20.0, 20.0, 60.0, 60.0, 90.0), (7.0, 20.0, 9.0, 90.0, 90.0, 90.0)):
+            vectors = unitcell_vectors(unitcell)
+            # Coordinates are not wrapped into the cell
+            coords = random.uniform(-0.5, 1.5, (300, 3)).dot(vectors)
+            points = random.uniform(-0.5, 1.5, (40, 3)).dot(vectors)
+            search = NeighborSearch(coords, 3.0, unitcell)
+            result = search.search(points, distances=True)
+            self.assertEqual(set(zip(*result[:2])), self._brute_search(coords, points, 3.0, unitcell))
+            diff = search.minimum_image(coords[result[1]] - points[result[0]])
+            numpy.testing.assert_allclose(result[2], numpy.sqrt((diff ** 2).sum(axis=1)))
+
+    def test_coords_minimum_image(self):
+        # Test `coords_minimum_image` function
+        unitcell = (10.0, 20.0, 30.0, 90.0, 90.0, 90.0)
+        vectors = numpy.array([[9.0, -11.0, 1.0], [4.0, 5.0, 16.0], [-26.0, 39.0, -29.0]])
+        numpy.testing.assert_allclose(coords_minimum_image(vectors, unitcell),
+                                      [[-1.0, 9.0, 1.0], [4.0, 5.0, -14.0], [4.0, -1.0, 1.0]], atol=1e-12)
+        # Triclinic cell, vectors shifted by cell vectors
+        unitcell = (20.0, 22.0, 25.0, 70.0, 80.0, 100.0)
+        cell = unitcell_vectors(unitcell)
+        vectors = numpy.array([[1.0, 2.0, -3.0], [-4.0, 0.5, 2.0]])
+        shifted = vectors + numpy.array([[1, -2, 1], [0, 3, -1]]).dot(cell)
+        numpy.testing.assert_allclose(coords_minimum_image(shifted, unitcell), vectors, atol=1e-12)
+        # Unit cell for each vector
+        unitcells = numpy.array([(10.0, 10.0, 10.0, 90.0, 90.0, 90.0), (12.0, 12.0, 12.0, 90.0, 90.0, 90.0)])
+        numpy.testing.assert_allclose(coords_minimum_image([[8.0, 0.0, 0.0], [8.0, 0.0, 0.0]], unitcells),
+                                      [[-2.0, 0.0, 0.0], [-4.0, 0.0, 0.0]], atol=1e-12)
+
+    def test_periodic_geometry(self):
+        # Test measure functions with periodic boundary conditions
+        unitcell = (20.0, 22.0, 25.0, 70.0, 80.0, 100.0)
+        cell = unitcell_vectors(unitcell)
+        coords = numpy.array([[0.0, 0.0, 0.0], [1.5, 0.0, 0.0], [2.0, 1.4, 0.0], [3.0, 1.5, 1.2]])
+        # Move the atoms by cell vectors
+        images = coords + numpy.array([[0, 0, 0], [1, 0, 0], [0, -1, 2], [-1, 1, 1]]).dot(cell)
+        self.assertAlmostEqual(coords_distance(images[0], images[1], unitcell), 1.5)
+        self.assertAlmostEqual(coords_angle(*images[:3], unitcell=unitcell), coords_angle(*coords[:3]))
+        self.assertAlmostEqual(coords_dihedral(*images, unitcell=unitcell), coords_dihedral(*coords))
+        # Without unit cell, the images are far apart
+        self.assertGreater(coords_distance(images[0], images[1]), 10.0)
+
+        # Test arrays of frames with different unit cells
+        unitcells = numpy.array([unitcell, (30.0, 30.0, 30.0, 90.0, 90.0, 90.0)])
+        shifts = numpy.array([[[0, 0, 0], [1, 0, 0], [0, -1, 2], [-1, 1, 1]],
+                              [[1, 1, 1], [0, 0, 0], [0, 0, -1], [2, 0, 0]]])
+        frames = coords + numpy.einsum('fai,fij->faj', shifts, unitcell_vectors(unitcells))
+        # Split the frames into arrays of atoms
+        frames = frames.transpose(1, 0, 2)
+        numpy.testing.assert_allclose(coords_distances(frames[0], frames[1], unitcells), [1.5, 1.5])
+        numpy.testing.assert_allclose(coords_angles(*frames[:3], unitcell=unitcells), [coords_angle(*coords[:3])] * 2)
+        numpy.testing.assert_allclose(coords_dihedrals(*frames, unitcell=unitcells), [coords_dihedral(*coords)] * 2)
@@ -43,9 +43,23 @@ class TestMolecule(PyvmdTestCase):
         # Check molecule property
         self.assertIsInstance(mol.molecule, _Molecule)
 
+        # Check numatoms property
+        self.assertEqual(mol.numatoms, 21)
+
         # Check error if molecule does not exists
         self.assertRaises(ValueError, Molecule, 66000)
 
+    def test_get_unitcell(self):
+        # Test `get_unitcell` method
+        mol = Molecule(self.molid)
+        # Trajectory doesn't contain unit cell
+        self.assertIsNone(mol.get_unitcell())
+        VMD.molecule.set_periodic(self.molid, 4, a=10.0, b=20.0, c=30.0, alpha=90.0, beta=90.0, gamma=60.0)
+        self.assertEqual(mol.get_unitcell(4), (10.0, 20.0, 30.0, 90.0, 90.0, 60.0))
+        mol.frame = 4
+        self.assertEqual(mol.get_unitcell(), (10.0, 20.0, 30.0, 90.0, 90.0, 60.0))
+        self.assertIsNone(mol.get_unitcell(5))
+
     def test_visible_property(self):
         # Test `visible` property
         mol = Molecule(self.molid)